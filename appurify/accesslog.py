@@ -0,0 +1,121 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+"""
+import os
+import random
+import threading
+
+from . import codec
+from .utils import get_logger
+
+ACCESS_LOG_MAX_BYTES = 64 * 1024 * 1024     # rotate access log file once it grows beyond this size
+ACCESS_LOG_BACKUPS = 5                      # number of rotated files to keep (access.log.1 ... access.log.N)
+ACCESS_LOG_FLUSH_INTERVAL = 1000            # (in millis) buffered records are written at least this often
+ACCESS_LOG_BATCH_SIZE = 512                 # wake up writer early once this many records are buffered
+ACCESS_LOG_MAX_BUFFERED = 65536             # records buffered beyond this are dropped instead of growing memory
+
+access_log = get_logger('tunnel.accesslog')
+
+class AccessLog(threading.Thread):
+    """buffered writer of per-request records as size-rotated JSONL files.
+
+    Proxy threads only append a dict to an in-memory batch; serialization
+    and file I/O happen on this background thread. With sample_rate < 1
+    only that fraction of requests is recorded, call sample() before
+    building a record to skip the work for unsampled requests.
+    """
+
+    def __init__(self, path, sample_rate=1.0, max_bytes=ACCESS_LOG_MAX_BYTES, backups=ACCESS_LOG_BACKUPS,
+                 flush_interval=ACCESS_LOG_FLUSH_INTERVAL, batch_size=ACCESS_LOG_BATCH_SIZE):
+        super(AccessLog, self).__init__()
+        self.setDaemon(True)
+        self.path = path
+        self.sample_rate = float(sample_rate)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.records = []
+        self.dropped = 0
+        self.written = 0
+        self.running = True
+        self.file = None
+        self.size = 0
+
+    def sample(self):
+        if self.sample_rate >= 1: return True
+        return random.random() < self.sample_rate
+
+    def write(self, record):
+        with self.lock:
+            if len(self.records) >= ACCESS_LOG_MAX_BUFFERED:
+                self.dropped += 1
+                return
+            self.records.append(record)
+            pending = len(self.records)
+        if pending >= self.batch_size:
+            self.wakeup.set()
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                records, self.records = self.records, []
+            if not records:
+                return
+
+            data = ''.join(['%s\n' % codec.dumps(record) for record in records])
+            if self.file is None:
+                self.open()
+            if self.max_bytes and self.size > 0 and self.size + len(data) > self.max_bytes:
+                self.rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            self.written += len(records)
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        self.size = os.path.getsize(self.path)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval/1000.0)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception, e: # pragma: no cover
+                access_log.error("failed to write access log %s with reason %r", self.path, e)
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.isAlive():
+            self.join(self.flush_interval/1000.0)
+        self.flush()
+        with self.io_lock:
+            if self.file:
+                self.file.close()
+                self.file = None
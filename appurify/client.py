@@ -19,9 +19,13 @@ import requests
 
 from . import constants
 
-from .utils import log, wget
+from .utils import log, wget, get_logger
+from .codec import response_json, LazyJson
+from .tracing import tracer
 from .api import *
 
+poll_log = get_logger('client.poll')
+
 class AppurifyClientError(Exception):
     def __init__(self, message, exit_code=constants.EXIT_CODE_CLIENT_EXCEPTION):
         super(AppurifyClientError, self).__init__(message)
@@ -48,6 +52,12 @@ class AppurifyClient(object):
         else:
             self.verify_ssl = True
 
+        self.device_list_response = None
+
+        self.trace_file = self.args.get('trace_file', None) or os.environ.get('APPURIFY_TRACE_FILE', None)
+        if self.trace_file:
+            tracer.enable()
+
     def refreshAccessToken(self):
         if self.access_token is None:
             api_key = self.args.get('api_key', None)
@@ -57,16 +67,22 @@ class AppurifyClient(object):
             log('generating access token...')
             r = access_token_generate(api_key, api_secret)
             if r.status_code == 200:
-                access_token = r.json()['response']['access_token']
+                access_token = response_json(r)['response']['access_token']
                 log('access_token_generate success, access_token:%s' % access_token)
                 self.access_token = access_token
             else:
                 raise AppurifyClientError('access_token_generate failed with response %s' % r.text, exit_code=constants.EXIT_CODE_AUTH_FAILURE)
         return self.access_token
 
+    def getDeviceList(self):
+        """fetch device list once per client, checkDevice and checkAppCompatibility share it"""
+        if self.device_list_response is None:
+            self.device_list_response = devices_list(self.access_token)
+        return self.device_list_response
+
     def checkDevice(self):
-        response_device_list = devices_list(self.access_token)
-        data_device_list = json.loads(response_device_list.text.replace("'","\"")) 
+        response_device_list = self.getDeviceList()
+        data_device_list = response_json(response_device_list)
         device_id_list =[]
         
         for device in data_device_list["response"]:
@@ -79,8 +95,8 @@ class AppurifyClient(object):
                     raise AppurifyClientError("Current device list does not include device type: %s" % d, exit_code=constants.EXIT_CODE_DEVICE_NOT_FOUND)
 
     def checkAppCompatibility(self, app_src):
-        response_device_list = devices_list(self.access_token)
-        data_device_list = json.loads(response_device_list.text.replace("'","\"")) 
+        response_device_list = self.getDeviceList()
+        data_device_list = response_json(response_device_list)
         reservingDevice = -1
         
         for device in data_device_list["response"]:
@@ -122,7 +138,7 @@ class AppurifyClient(object):
             else:
                 r = apps_upload(self.access_token, app_src, app_src_type, app_src_type, app_name)
         if r.status_code == 200:
-            app_id = r.json()['response']['app_id']
+            app_id = response_json(r)['response']['app_id']
             log('apps_upload success, app_id:%s' % app_id)
             return app_id
         else:
@@ -146,7 +162,7 @@ class AppurifyClient(object):
         elif self.test_type in constants.NO_TEST_SOURCE:
             r = tests_upload(self.access_token, None, 'url', self.test_type)
         if r.status_code == 200:
-            test_id = r.json()['response']['test_id']
+            test_id = response_json(r)['response']['test_id']
             log('tests_upload success, test_id:%s' % test_id)
             return test_id
         else:
@@ -158,7 +174,7 @@ class AppurifyClient(object):
             r = config_upload(self.access_token, config_src_file, test_id)
             if r.status_code == 200:
                 log('config file upload success, test_id:%s' % test_id)
-                config_id = r.json()['response']['config_id']
+                config_id = response_json(r)['response']['config_id']
                 return config_id
             else:
                 raise AppurifyClientError('config file upload  failed with response %s' % r.text, exit_code=constants.EXIT_CODE_BAD_TEST)
@@ -166,7 +182,7 @@ class AppurifyClient(object):
     def runTest(self, app_id, test_id):
         r = tests_run(self.access_token, self.device_type_id, app_id, test_id, self.device_id)
         if r.status_code == 200:
-            test_response = r.json()['response']
+            test_response = response_json(r)['response']
             test_run_id = test_response['test_run_id']
             log('tests_run success scheduling test test_run_id:%s' % test_run_id)
 
@@ -185,7 +201,7 @@ class AppurifyClient(object):
     def abortTest(self, test_run_id, reason):
         r = tests_abort(self.access_token, test_run_id, reason)
         if r.status_code == 200:
-            response = r.json()['response']
+            response = response_json(r)['response']
             if response['status'] == 'aborting':
                 log("aborting test run id %s" % test_run_id)
             elif response['status'] == 'complete':
@@ -213,19 +229,19 @@ class AppurifyClient(object):
         while test_status != 'complete' and runtime < timeout_limit:
             time.sleep(self.poll_every)
             r = tests_check_result(self.access_token, test_run_id)
-            test_status_response = r.json()['response']
+            test_status_response = response_json(r)['response']
             test_status = test_status_response['status']
             if test_status == 'complete':
                 test_response = test_status_response['results']
-                log("**** COMPLETE - JSON SUMMARY FOLLOWS ****")
-                log(json.dumps(test_response))
-                log("**** COMPLETE - JSON SUMMARY ENDS ****")
+                poll_log.warning("**** COMPLETE - JSON SUMMARY FOLLOWS ****")
+                poll_log.warning("%s", LazyJson(test_response))
+                poll_log.warning("**** COMPLETE - JSON SUMMARY ENDS ****")
                 return test_status_response
             else:
-                log("%s sec elapsed (timeout in %s)" % (runtime, (timeout_limit - runtime)))
+                poll_log.warning("%s sec elapsed (timeout in %s)", runtime, timeout_limit - runtime)
                 if 'message' in test_status_response:
-                    log(test_status_response['message'])
-                log("Test progress: {}".format(test_status_response.get('detailed_status', 'status-unavailable')))
+                    poll_log.warning("%s", test_status_response['message'])
+                poll_log.warning("Test progress: %s", test_status_response.get('detailed_status', 'status-unavailable'))
             runtime = runtime + self.poll_every
 
         raise AppurifyClientError("Test result poll timed out after %s seconds" % timeout_limit, exit_code=constants.EXIT_CODE_TEST_TIMEOUT)
@@ -249,7 +265,7 @@ class AppurifyClient(object):
 
     def reportTestResult(self, test_status_response):
         log("== reportTestResult ==")
-        log(json.dumps(test_status_response))
+        log(LazyJson(test_status_response))
         
         exit_code = constants.EXIT_CODE_ALL_PASS
         test_response = test_status_response['results']
@@ -342,30 +358,38 @@ class AppurifyClient(object):
         exit_code = 0
 
         try:
-            self.refreshAccessToken()
+            with tracer.span('access_token'):
+                self.refreshAccessToken()
 
             if self.test_type is None:
                 raise AppurifyClientError("test_type is required")
 
-            self.checkDevice()
+            with tracer.span('check_device'):
+                self.checkDevice()
             
             # upload app/test of use passed id's
-            app_id = self.args.get('app_id', None) or self.uploadApp()
-            test_id = self.args.get('test_id', None) or self.uploadTest(app_id)
+            with tracer.span('upload_app'):
+                app_id = self.args.get('app_id', None) or self.uploadApp()
+            with tracer.span('upload_test'):
+                test_id = self.args.get('test_id', None) or self.uploadTest(app_id)
             
             config_src = self.args.get('config_src', False)
             if config_src:
-                self.uploadConfig(test_id, config_src)
+                with tracer.span('upload_config'):
+                    self.uploadConfig(test_id, config_src)
 
             
             # start test run
-            test_run_id, queue_timeout_limit, configs = self.runTest(app_id, test_id)
+            with tracer.span('run_test'):
+                test_run_id, queue_timeout_limit, configs = self.runTest(app_id, test_id)
             self.printConfigs(configs)
 
             self.timeout = self.timeout or queue_timeout_limit
             # poll for results and print report
-            test_status_response = self.pollTestResult(test_run_id, self.timeout)
-            exit_code = self.reportTestResult(test_status_response)
+            with tracer.span('poll_result'):
+                test_status_response = self.pollTestResult(test_run_id, self.timeout)
+            with tracer.span('report_result'):
+                exit_code = self.reportTestResult(test_status_response)
         
         except AppurifyClientError, e:
             log(str(e))
@@ -385,6 +409,9 @@ class AppurifyClient(object):
             exit_code = constants.EXIT_CODE_CLIENT_EXCEPTION
 
         log('done with exit code %s' % exit_code)
+        if self.trace_file:
+            tracer.write(self.trace_file)
+            log('trace written to %s' % self.trace_file)
         return exit_code
 
     @staticmethod
@@ -393,7 +420,7 @@ class AppurifyClient(object):
         os.environ['APPURIFY_API_RETRY_ON_FAILURE'] = '0' #disable retries
         pp = pprint.PrettyPrinter(indent=4)
         r = globals()[action](**{k : v for k,v in kwargs.iteritems() if k in required})
-        pp.pprint(r.json())
+        pp.pprint(response_json(r))
         return 0 if r.status_code == 200 else 1
 
     @staticmethod
@@ -428,6 +455,7 @@ class AppurifyClient(object):
 
         parser.add_argument('--disable-ssl-check', help="Optional, if set, don't verify SSL certificates (e.g. if you're using self-signed certificates)", action="store_true")
         parser.add_argument('--timeout', help='Optional, timeout in seconds before the client assumes the test has failed. Defaults to server side timeout value (~ 6 hours)')
+        parser.add_argument('--trace-file', help='Optional, write a chrome trace-event json file with timings of each phase and API call')
         parser.add_argument('--version', help='Print client version and exit', action='store_true')
 
         kwargs = {}
@@ -519,6 +547,9 @@ class AppurifyClient(object):
         kwargs['name'] = args.name
     
         kwargs['url'] = args.url
+
+        # (optional) trace file
+        kwargs['trace_file'] = args.trace_file
     
         # (optional) timeout
         try:
@@ -0,0 +1,84 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+"""
+import os
+import json
+
+# Decoders in order of preference, fastest first. Override with
+# APPURIFY_JSON_CODEC environment variable (e.g. APPURIFY_JSON_CODEC=json)
+CODECS = ['ujson', 'simplejson', 'json']
+
+def load_codec(names=None):
+    """returns (name, module) of the first importable json codec."""
+    preferred = os.environ.get('APPURIFY_JSON_CODEC', None)
+    if names is None:
+        names = [preferred] + CODECS if preferred else CODECS
+    for name in names:
+        try:
+            return name, __import__(name)
+        except ImportError:
+            continue
+    return 'json', json
+
+name, codec = load_codec()
+
+def loads(data):
+    """decode a json document using the fastest available codec"""
+    return codec.loads(data)
+
+def dumps(obj, **kwargs):
+    """encode obj as json, formatting options fall back to stdlib json"""
+    if kwargs:
+        return json.dumps(obj, **kwargs)
+    return codec.dumps(obj)
+
+def response_json(response):
+    """decode the json body of an API response exactly once.
+
+    Decoded payload is cached on the response object so that repeated
+    lookups (status checks, logging, reporting) do not parse it again.
+    """
+    try:
+        return response._appurify_json
+    except AttributeError:
+        pass
+
+    content = getattr(response, 'content', None)
+    if content is None:
+        data = response.json()
+    else:
+        try:
+            data = loads(content)
+        except ValueError:
+            # some legacy endpoints emit single quoted pseudo-json
+            data = loads(content.replace("'", "\""))
+
+    try:
+        response._appurify_json = data
+    except AttributeError: # pragma: no cover
+        pass
+    return data
+
+class LazyJson(object):
+    """defers json serialization until the object is actually rendered.
+
+    Pass instances to log() instead of json.dumps(obj) so large payloads
+    are only serialized when the record passes the active log level.
+    """
+
+    def __init__(self, obj, **kwargs):
+        self.obj = obj
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return dumps(self.obj, **self.kwargs)
+
+    def __repr__(self):
+        return '<LazyJson %s>' % type(self.obj).__name__
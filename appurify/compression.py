@@ -0,0 +1,131 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Gzip encoding of uncompressed text responses, see appurify-tunnel.py --gzip.
+
+Responses travel over the ssh transport, compressing text on the device
+side of the link saves most of its bytes. A response qualifies when the
+client accepts gzip, it has a body of a listed content type, is not encoded
+or partial already and does not forbid transformation (no-transform).
+
+The body is compressed as it arrives, every piece received from upstream
+is sync flushed so the client sees it without waiting for the next one.
+The length of the encoded body is not known up front: Content-Length is
+dropped and the body is sent chunked to HTTP/1.1 clients, delimited by
+close to HTTP/1.0 ones. Strong ETags are weakened as the bytes changed.
+"""
+import zlib
+
+from .utils import thread_time
+from .metrics import registry
+
+GZIP_LEVEL = 6
+GZIP_MIN_BYTES = 1024   # smaller bodies gain less than the gzip header costs
+GZIP_TYPES = ('text/html', 'text/plain', 'text/css', 'text/javascript', 'text/xml', 'text/csv',
+              'application/javascript', 'application/x-javascript', 'application/json',
+              'application/xml', 'image/svg+xml')
+
+CRLF = '\r\n'
+REWRITTEN_HEADERS = ('content-length', 'transfer-encoding', 'content-encoding', 'etag', 'vary', 'connection')
+
+gzip_responses = registry.labeled_counter('tunnel_gzip_responses_total', 'Responses gzip encoded for the client', label='content_type')
+gzip_bytes_in = registry.labeled_counter('tunnel_gzip_bytes_in_total', 'Body bytes received uncompressed from upstream', label='content_type')
+gzip_bytes_out = registry.labeled_counter('tunnel_gzip_bytes_out_total', 'Gzip encoded body bytes sent to the client', label='content_type')
+gzip_cpu = registry.labeled_counter('tunnel_gzip_cpu_seconds_total', 'Cpu time spent compressing response bodies', label='content_type')
+gzip_ratio = registry.histogram('tunnel_gzip_ratio', 'Encoded to original size of gzip encoded responses',
+                                buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1))
+
+def header(message, name):
+    return message.headers[name][1] if name in message.headers else None
+
+def accepts_gzip(request):
+    """Accept-Encoding of request allows gzip (RFC 7231 section 5.3.4)"""
+    qvalues = dict()
+    for coding in (header(request, 'accept-encoding') or '').split(','):
+        parts = coding.split(';')
+        name, q = parts[0].strip().lower(), 1.0
+        for param in parts[1:]:
+            key, sep, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name: qvalues[name] = q
+    if 'gzip' in qvalues: return qvalues['gzip'] > 0
+    if 'x-gzip' in qvalues: return qvalues['x-gzip'] > 0
+    return qvalues.get('*', 0) > 0
+
+def content_type(response):
+    return (header(response, 'content-type') or '').split(';')[0].strip().lower()
+
+def compressible(request, response, types=GZIP_TYPES, min_bytes=GZIP_MIN_BYTES):
+    """response, its head complete, is worth encoding for the client of request"""
+    if not response.has_body() or response.code == '206' or 'content-range' in response.headers: return False
+    if (header(response, 'content-encoding') or 'identity').strip().lower() != 'identity': return False
+    if 'no-transform' in (header(response, 'cache-control') or '').lower(): return False
+    if content_type(response) not in types: return False
+    length = response.content_length()
+    if length is not None and length < min_bytes: return False
+    return accepts_gzip(request)
+
+def gzip_head(response, chunked):
+    """status line and headers of response rewritten for a gzip encoded body"""
+    lines = ['%s %s %s%s' % (response.version, response.code, response.reason, CRLF)]
+    for name in response.headers:
+        if name not in REWRITTEN_HEADERS:
+            lines.append('%s: %s%s' % (response.headers[name][0], response.headers[name][1], CRLF))
+    etag = header(response, 'etag')
+    if etag: lines.append('ETag: %s%s' % (etag if etag.startswith('W/') else 'W/' + etag, CRLF))
+    vary = [v.strip() for v in (header(response, 'vary') or '').split(',') if v.strip()]
+    if 'accept-encoding' not in [v.lower() for v in vary]: vary.append('Accept-Encoding')
+    lines.append('Vary: %s%s' % (', '.join(vary), CRLF))
+    lines.append('Content-Encoding: gzip%s' % CRLF)
+    if chunked: lines.append('Transfer-Encoding: chunked%s' % CRLF)
+    lines.append('Connection: close%s' % CRLF)
+    lines.append(CRLF)
+    return ''.join(lines)
+
+class GzipStream(object):
+    """gzip encoder of one response body, framed in chunks when chunked"""
+
+    def __init__(self, content_type, chunked, level=GZIP_LEVEL):
+        self.content_type = content_type
+        self.chunked = chunked
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.consumed = 0   # body bytes compressed so far
+        self.produced = 0
+        self.finished = False
+        gzip_responses.inc(content_type)
+
+    def compress(self, data):
+        if self.finished or not data: return ''
+        started = thread_time()
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        gzip_cpu.inc(self.content_type, thread_time() - started)
+        self.consumed += len(data)
+        gzip_bytes_in.inc(self.content_type, len(data))
+        return self.frame(out)
+
+    def finish(self):
+        """end of the encoded body, the last chunk included"""
+        if self.finished: return ''
+        self.finished = True
+        started = thread_time()
+        out = self.compressor.flush(zlib.Z_FINISH)
+        gzip_cpu.inc(self.content_type, thread_time() - started)
+        if self.consumed: gzip_ratio.observe((self.produced + len(out)) / float(self.consumed))
+        return self.frame(out) + ('0%s%s' % (CRLF, CRLF) if self.chunked else '')
+
+    def frame(self, out):
+        if not out: return ''
+        self.produced += len(out)
+        gzip_bytes_out.inc(self.content_type, len(out))
+        return '%x%s%s%s' % (len(out), CRLF, out, CRLF) if self.chunked else out
@@ -0,0 +1,340 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Shared HTTP cache of proxied GET responses, see appurify-tunnel.py --http-cache.
+
+Follows the shared cache rules of RFC 7234: responses marked no-store or
+private, setting cookies, varying on * or answering requests with
+Authorization are not stored. Freshness comes from s-maxage, max-age,
+Expires or 10% of the Last-Modified age. Stale entries with an ETag or
+Last-Modified are revalidated with a conditional request, a 304 refreshes
+the entry and the stored body is served. Requests that are conditional or
+ask for a range themselves pass through untouched.
+
+Bodies live in files under the cache directory next to a json file of
+their headers, the index of entries is kept in memory in LRU order and
+rebuilt from the json files on start. Once bodies exceed max_bytes the
+least recently used entries are removed.
+"""
+import os
+import time
+import hashlib
+import threading
+import collections
+import email.utils
+
+from . import codec
+from .utils import get_logger
+from .metrics import registry
+
+HTTP_CACHE_MAX_BYTES = 256 * 1024 * 1024
+HTTP_CACHE_MAX_OBJECT_BYTES = 8 * 1024 * 1024
+HTTP_CACHE_HEURISTIC_FRACTION = 0.1
+HTTP_CACHE_HEURISTIC_MAX = 24 * 3600    # seconds, like every http freshness value
+
+CACHEABLE_CODES = ('200', '203', '300', '301', '410')
+UNCACHED_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'te', 'trailer',
+                    'upgrade', 'proxy-authenticate', 'age', 'content-length')
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range', 'range')
+
+cache_log = get_logger('tunnel.httpcache')
+
+cache_hits = registry.counter('tunnel_http_cache_hits_total', 'GET requests answered from the http cache without going upstream')
+cache_misses = registry.counter('tunnel_http_cache_misses_total', 'Cacheable GET requests not found in the http cache')
+cache_revalidations = registry.counter('tunnel_http_cache_revalidations_total', 'Stale http cache entries revalidated upstream')
+cache_not_modified = registry.counter('tunnel_http_cache_not_modified_total', 'Revalidations answered 304 and served from the http cache')
+cache_bytes_saved = registry.counter('tunnel_http_cache_bytes_saved_total', 'Body bytes served from the http cache instead of upstream')
+cache_stores = registry.counter('tunnel_http_cache_stores_total', 'Responses written to the http cache')
+cache_evictions = registry.counter('tunnel_http_cache_evictions_total', 'Least recently used entries removed to stay under the size cap')
+cache_bytes = registry.gauge('tunnel_http_cache_bytes', 'Body bytes held in the http cache')
+cache_entries = registry.gauge('tunnel_http_cache_entries', 'Entries in the http cache')
+
+def header(message, name):
+    return message.headers[name][1] if name in message.headers else None
+
+def cache_control(value):
+    """directives of a Cache-Control value as a dict, None for directives without argument"""
+    directives = dict()
+    for directive in (value or '').split(','):
+        name, sep, arg = directive.strip().partition('=')
+        if name: directives[name.lower()] = arg.strip('"') if sep else None
+    return directives
+
+def http_date(value):
+    """seconds since epoch of an http date, None if missing or invalid"""
+    if not value: return None
+    parsed = email.utils.parsedate_tz(value)
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+def seconds(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+class CacheEntry(object):
+    """stored response, everything but the body"""
+
+    def __init__(self, key, code, reason, headers, vary, stored, lifetime, age=0, size=0):
+        self.key = key
+        self.code = code
+        self.reason = reason
+        self.headers = headers  # [(name, value)] as received, minus hop by hop headers
+        self.vary = vary        # {request header: value} the response was selected by
+        self.stored = stored    # when the response was received
+        self.lifetime = lifetime
+        self.age = age          # Age header on receipt
+        self.size = size
+
+    def get(self, name):
+        for k, v in self.headers:
+            if k.lower() == name: return v
+        return None
+
+    def headers_dict(self):
+        """headers keyed by lower case name like HttpParser.headers"""
+        return dict([(k.lower(), (k, v)) for k, v in self.headers])
+
+    def current_age(self, now):
+        return self.age + max(now - self.stored, 0)
+
+    def is_fresh(self, now):
+        return self.current_age(now) < self.lifetime
+
+    def validators(self):
+        headers = []
+        if self.get('etag'): headers.append(('If-None-Match', self.get('etag')))
+        if self.get('last-modified'): headers.append(('If-Modified-Since', self.get('last-modified')))
+        return headers
+
+    def head(self, now):
+        lines = ['HTTP/1.1 %s %s\r\n' % (self.code, self.reason)]
+        lines.extend(['%s: %s\r\n' % (k, v) for k, v in self.headers])
+        lines.append('Age: %d\r\n' % self.current_age(now))
+        lines.append('Content-Length: %d\r\n' % self.size)
+        lines.append('Connection: close\r\n')
+        lines.append('\r\n')
+        return ''.join(lines)
+
+    def to_dict(self):
+        return dict(key=self.key, code=self.code, reason=self.reason, headers=self.headers, vary=self.vary,
+                    stored=self.stored, lifetime=self.lifetime, age=self.age, size=self.size)
+
+    @staticmethod
+    def from_dict(d):
+        # json hands back unicode, heads are joined with byte string bodies
+        utf8 = lambda v: v.encode('utf-8') if isinstance(v, unicode) else v
+        return CacheEntry(utf8(d['key']), utf8(d['code']), utf8(d['reason']),
+                          [(utf8(k), utf8(v)) for k, v in d['headers']],
+                          dict([(utf8(k), utf8(v)) for k, v in d['vary'].items()]),
+                          d['stored'], d['lifetime'], d['age'], d['size'])
+
+class HttpCache(object):
+    """LRU on disk cache of GET responses, thread safe"""
+
+    def __init__(self, path, max_bytes=HTTP_CACHE_MAX_BYTES, max_object_bytes=HTTP_CACHE_MAX_OBJECT_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_object_bytes = min(max_object_bytes, max_bytes)
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> CacheEntry, least recently used first
+        self.size = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.load()
+
+    def partition(self, index, count):
+        """cache of worker index of count processes, in a subdirectory with an equal share of the size cap"""
+        return HttpCache(os.path.join(self.path, 'worker-%d' % index), self.max_bytes / count, self.max_object_bytes)
+
+    @staticmethod
+    def key(request):
+        url = request.url
+        return 'http://%s:%s%s' % (url.hostname.lower() if url.hostname else '', url.port or 80, request.build_url().split('#')[0])
+
+    def base(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def filename(self, key, ext):
+        return '%s.%s' % (self.base(key), ext)
+
+    def load(self):
+        found = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.meta'): continue
+            try:
+                with open(os.path.join(self.path, name), 'rb') as f:
+                    entry = CacheEntry.from_dict(codec.loads(f.read()))
+            except Exception, e:
+                cache_log.warning("dropping unreadable cache entry %s %r", name, e)
+                self.unlink(os.path.join(self.path, name[:-len('.meta')]))
+                continue
+            found.append(entry)
+        for entry in sorted(found, key=lambda e: e.stored):
+            self.entries[entry.key] = entry
+            self.size += entry.size
+        self.evict(0)
+        self.update_gauges()
+
+    def cacheable_request(self, request):
+        if request.method != 'GET' or 'authorization' in request.headers: return False
+        for name in CONDITIONAL_HEADERS:
+            if name in request.headers: return False
+        return 'no-store' not in cache_control(header(request, 'cache-control'))
+
+    def lookup(self, request):
+        """(entry, body) for a fresh hit, (entry, None) when entry must be revalidated, (None, None) otherwise"""
+        if not self.cacheable_request(request): return None, None
+        key = HttpCache.key(request)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries[key] = self.entries.pop(key)
+        if entry and any([header(request, name) != value for name, value in entry.vary.items()]):
+            entry = None
+        if not entry:
+            cache_misses.inc()
+            return None, None
+
+        directives = cache_control(header(request, 'cache-control'))
+        no_cache = 'no-cache' in directives or 'no-cache' in (header(request, 'pragma') or '').lower()
+        max_age = seconds(directives.get('max-age')) if 'max-age' in directives else None
+        now = time.time()
+        if not no_cache and entry.is_fresh(now) and (max_age is None or entry.current_age(now) <= max_age):
+            body = self.read(entry)
+            if body is not None:
+                cache_hits.inc()
+                cache_bytes_saved.inc(len(body))
+                return entry, body
+        if entry.validators():
+            cache_revalidations.inc()
+            return entry, None
+        cache_misses.inc()
+        return None, None
+
+    def read(self, entry):
+        try:
+            with open(self.filename(entry.key, 'body'), 'rb') as f:
+                body = f.read()
+        except IOError:
+            self.remove(entry.key)
+            return None
+        if len(body) != entry.size:
+            self.remove(entry.key)
+            return None
+        return body
+
+    def lifetime(self, headers, now):
+        """freshness lifetime in seconds per RFC 7234 section 4.2.1, headers keyed by lower case name"""
+        value = lambda name: headers[name][1] if name in headers else None
+        directives = cache_control(value('cache-control'))
+        if 'no-cache' in directives: return 0
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                return seconds(directives[name]) or 0
+        date = http_date(value('date')) or now
+        if 'expires' in headers:
+            expires = http_date(value('expires'))
+            return max(expires - date, 0) if expires else 0
+        last_modified = http_date(value('last-modified'))
+        if last_modified and date > last_modified:
+            return min((date - last_modified) * HTTP_CACHE_HEURISTIC_FRACTION, HTTP_CACHE_HEURISTIC_MAX)
+        return 0
+
+    def cacheable_response(self, response):
+        if response.code not in CACHEABLE_CODES or 'set-cookie' in response.headers: return False
+        directives = cache_control(header(response, 'cache-control'))
+        if 'no-store' in directives or 'private' in directives: return False
+        return (header(response, 'vary') or '').strip() != '*'
+
+    def store(self, request, response):
+        """stores a complete response to request, returns the entry or None if it may not be cached"""
+        if not self.cacheable_request(request) or not self.cacheable_response(response): return None
+        body = response.body or ''
+        if len(body) > self.max_object_bytes: return None
+
+        now = time.time()
+        headers = [response.headers[name] for name in response.headers if name not in UNCACHED_HEADERS]
+        vary = dict()
+        for name in (header(response, 'vary') or '').split(','):
+            name = name.strip().lower()
+            if name: vary[name] = header(request, name)
+        entry = CacheEntry(HttpCache.key(request), response.code, response.reason, headers, vary, now,
+                           self.lifetime(response.headers, now), seconds(header(response, 'age')) or 0, len(body))
+        if entry.lifetime <= 0 and not entry.validators(): return None
+
+        try:
+            meta = codec.dumps(entry.to_dict())
+            self.write(entry.key, 'body', body)
+            self.write(entry.key, 'meta', meta)
+        except (IOError, OSError, ValueError), e:
+            cache_log.warning("failed to store %s in http cache %r", entry.key, e)
+            return None
+        with self.lock:
+            old = self.entries.pop(entry.key, None)
+            if old: self.size -= old.size
+            self.evict(entry.size)
+            self.entries[entry.key] = entry
+            self.size += entry.size
+            self.update_gauges()
+        cache_stores.inc()
+        return entry
+
+    def refresh(self, entry, response):
+        """updates entry with the headers of a 304 response, returns the stored body or None"""
+        body = self.read(entry)
+        if body is None: return None
+        now = time.time()
+        updated = dict([(name, response.headers[name]) for name in response.headers if name not in UNCACHED_HEADERS])
+        headers = [updated.pop(k.lower(), (k, v)) for k, v in entry.headers] + updated.values()
+        entry.headers = headers
+        entry.stored = now
+        entry.age = seconds(header(response, 'age')) or 0
+        entry.lifetime = self.lifetime(entry.headers_dict(), now)
+        try:
+            self.write(entry.key, 'meta', codec.dumps(entry.to_dict()))
+        except (IOError, OSError, ValueError), e: # pragma: no cover
+            cache_log.warning("failed to refresh %s in http cache %r", entry.key, e)
+        cache_not_modified.inc()
+        cache_bytes_saved.inc(len(body))
+        return body
+
+    def write(self, key, ext, data):
+        path = self.filename(key, ext)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def evict(self, incoming):
+        """removes least recently used entries until incoming bytes fit, called with lock held"""
+        while self.entries and self.size + incoming > self.max_bytes:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.unlink(self.base(key))
+            cache_evictions.inc()
+
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry: self.size -= entry.size
+            self.update_gauges()
+        if entry: self.unlink(self.base(key))
+
+    def unlink(self, base):
+        for ext in ('.meta', '.body'):
+            try:
+                os.remove(base + ext)
+            except OSError:
+                pass
+
+    def update_gauges(self):
+        cache_bytes.set(self.size)
+        cache_entries.set(len(self.entries))
@@ -0,0 +1,333 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+"""
+import bisect
+import threading
+import BaseHTTPServer
+
+from .utils import get_logger
+
+# default histogram buckets (in seconds), tuned for upstream connect / request latencies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRICS_LOG_INTERVAL = 60000    # (in millis) interval between periodic metrics log summaries
+
+metrics_log = get_logger('tunnel.metrics')
+
+class Metric(object):
+    """subclasses provide samples() to render, and state() / add() to merge, see Registry.merge"""
+
+    type = None
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels, format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """monotonically increasing value, e.g. bytes proxied or 502s served"""
+
+    type = 'counter'
+
+    def __init__(self, name, help=''):
+        super(Counter, self).__init__(name, help)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', '', self.value)]
+
+    def summary(self):
+        return '%s=%s' % (self.name, format_value(self.value))
+
+    def state(self):
+        return {'': self.value}
+
+    def add(self, delta):
+        self.inc(delta.get('', 0))
+
+    def reset(self):
+        super(Counter, self).reset()
+        self.value = 0
+
+class LabeledCounter(Metric):
+    """counters split by the value of one label, e.g. bytes per content type"""
+
+    type = 'counter'
+
+    def __init__(self, name, help='', label='type'):
+        super(LabeledCounter, self).__init__(name, help)
+        self.label = label
+        self.values = dict()
+
+    def inc(self, value, amount=1):
+        with self.lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def get(self, value):
+        return self.values.get(value, 0)
+
+    def samples(self):
+        return [('', '{%s="%s"}' % (self.label, value), count) for value, count in sorted(self.values.items())]
+
+    def summary(self):
+        return '%s=%s' % (self.name, format_value(sum(self.values.values())))
+
+    def state(self):
+        return dict(self.values)
+
+    def add(self, delta):
+        for value, amount in delta.items():
+            self.inc(value, amount)
+
+    def reset(self):
+        super(LabeledCounter, self).reset()
+        self.values = dict()
+
+class Gauge(Metric):
+    """value that can go up and down, e.g. live proxy threads"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help=''):
+        super(Gauge, self).__init__(name, help)
+        self.value = 0
+        self.merged = 0     # what other processes reported, set() here does not overwrite it
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def total(self):
+        return self.value + self.merged
+
+    def samples(self):
+        return [('', '', self.total())]
+
+    def summary(self):
+        return '%s=%s' % (self.name, format_value(self.total()))
+
+    def state(self):
+        return {'': self.value}
+
+    def add(self, delta):
+        with self.lock:
+            self.merged += delta.get('', 0)
+
+    def reset(self):
+        super(Gauge, self).reset()
+        self.value = 0
+        self.merged = 0
+
+class Histogram(Metric):
+    """cumulative bucketed distribution of observed values"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help='', buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """upper bound of the bucket containing the q-th quantile"""
+        if self.count == 0:
+            return None
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf') # pragma: no cover
+
+    def samples(self):
+        samples, cumulative = [], 0
+        for i, bound in enumerate(self.buckets):
+            cumulative += self.counts[i]
+            samples.append(('_bucket', '{le="%s"}' % format_value(bound), cumulative))
+        samples.append(('_bucket', '{le="+Inf"}', self.count))
+        samples.append(('_sum', '', self.sum))
+        samples.append(('_count', '', self.count))
+        return samples
+
+    def summary(self):
+        return '%s count=%s p50=%s p99=%s' % (self.name, self.count, format_value(self.quantile(0.5)), format_value(self.quantile(0.99)))
+
+    def state(self):
+        state = dict([(str(i), count) for i, count in enumerate(self.counts)])
+        state.update({'sum': self.sum, 'count': self.count})
+        return state
+
+    def add(self, delta):
+        with self.lock:
+            for i in range(len(self.counts)):
+                self.counts[i] += delta.get(str(i), 0)
+            self.sum += delta.get('sum', 0)
+            self.count += delta.get('count', 0)
+
+    def reset(self):
+        super(Histogram, self).reset()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+class Registry(object):
+    """collection of named metrics, get-or-create so call sites can share instances"""
+
+    def __init__(self):
+        self.metrics = []
+        self.index = dict()
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, help='', **kwargs):
+        with self.lock:
+            if name not in self.index:
+                metric = cls(name, help, **kwargs)
+                self.index[name] = metric
+                self.metrics.append(metric)
+            return self.index[name]
+
+    def counter(self, name, help=''):
+        return self.register(Counter, name, help)
+
+    def labeled_counter(self, name, help='', label='type'):
+        return self.register(LabeledCounter, name, help, label=label)
+
+    def gauge(self, name, help=''):
+        return self.register(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS):
+        return self.register(Histogram, name, help, buckets=buckets)
+
+    def get(self, name):
+        return self.index.get(name)
+
+    def state(self):
+        """cumulative values of every metric, json friendly"""
+        return dict([(metric.name, metric.state()) for metric in self.metrics])
+
+    def merge(self, delta):
+        """adds delta, a difference of two state() of another process, to the metrics here"""
+        for name, values in delta.items():
+            metric = self.index.get(name)
+            if metric: metric.add(values)
+
+    def reset(self):
+        """zeroes every metric, for a forked child that reports its own"""
+        self.lock = threading.Lock()
+        for metric in self.metrics:
+            metric.reset()
+
+    def render(self):
+        """prometheus text exposition format"""
+        return '\n'.join([metric.render() for metric in self.metrics]) + '\n'
+
+    def summary(self):
+        return ', '.join([metric.summary() for metric in self.metrics])
+
+def difference(state, previous):
+    """what changed from one Registry.state() to the next, unchanged values left out"""
+    delta = dict()
+    for name, values in state.items():
+        before = previous.get(name, {})
+        changed = dict([(k, v - before.get(k, 0)) for k, v in values.items() if v != before.get(k, 0)])
+        if changed: delta[name] = changed
+    return delta
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+registry = Registry()
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        metrics_log.debug(format, *args)
+
+class MetricsServer(threading.Thread):
+    """serves registry on http://host:port/metrics from a daemon thread"""
+
+    def __init__(self, port, host='127.0.0.1', registry=registry):
+        super(MetricsServer, self).__init__()
+        self.setDaemon(True)
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self.httpd.registry = registry
+        self.port = self.httpd.server_address[1]
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class MetricsReporter(threading.Thread):
+    """periodically logs a one line summary of all registry metrics"""
+
+    def __init__(self, interval=METRICS_LOG_INTERVAL, registry=registry):
+        super(MetricsReporter, self).__init__()
+        self.setDaemon(True)
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.interval/1000.0)
+            if not self.stopped.is_set():
+                metrics_log.warning('metrics: %s', self.registry.summary())
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,171 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Readiness polling without the select() FD_SETSIZE ceiling.
+
+Python 2 has no selectors module, Poller is the small part of it the
+tunnel needs: objects with a fileno() are registered once for POLL_READ
+and/or POLL_WRITE, interest is modified in place and poll() returns
+(object, events) pairs. poller() picks epoll, then poll, then select
+(windows, where select has no descriptor number limit).
+
+paramiko channels poll readable through a pipe but never writable, use
+Channel.send_ready() for those.
+"""
+import time
+import select
+
+POLL_READ = 1
+POLL_WRITE = 2
+
+class Poller(object):
+
+    def __init__(self):
+        self.fds = dict()      # object -> fd, still known after the object is closed
+        self.objects = dict()  # fd -> object
+        self.events = dict()   # fd -> events
+        self.parked = set()    # fds that hung up while watched for nothing, out of the kernel set until watched again
+
+    def __contains__(self, obj):
+        return obj in self.fds
+
+    def register(self, obj, events):
+        fd = obj.fileno()
+        self.fds[obj] = fd
+        self.objects[fd] = obj
+        self.events[fd] = events
+        self.add(fd, events)
+
+    def modify(self, obj, events):
+        fd = self.fds[obj]
+        if self.events[fd] == events: return
+        self.events[fd] = events
+        if fd in self.parked:
+            self.parked.discard(fd)
+            self.add(fd, events)
+        else:
+            self.change(fd, events)
+
+    def watch(self, obj, events):
+        """register obj or modify its events"""
+        if obj in self.fds: self.modify(obj, events)
+        else: self.register(obj, events)
+
+    def unregister(self, obj):
+        fd = self.fds.pop(obj)
+        del self.objects[fd]
+        del self.events[fd]
+        if fd in self.parked:
+            self.parked.discard(fd)
+            return
+        try:
+            self.remove(fd)
+        except (IOError, OSError, ValueError):
+            pass # already closed, the kernel dropped it
+
+    def poll(self, timeout):
+        """ready (object, events) pairs, timeout in seconds"""
+        return [(self.objects[fd], events) for fd, events in self.ready(timeout) if fd in self.objects]
+
+    def add(self, fd, events): pass
+
+    def change(self, fd, events): pass
+
+    def remove(self, fd): pass
+
+    def close(self):
+        self.fds = dict()
+        self.objects = dict()
+        self.events = dict()
+        self.parked = set()
+
+class SelectPoller(Poller):
+
+    def ready(self, timeout):
+        rlist = [fd for fd, events in self.events.items() if events & POLL_READ]
+        wlist = [fd for fd, events in self.events.items() if events & POLL_WRITE]
+        if not rlist and not wlist:
+            if timeout: time.sleep(timeout)
+            return []
+        r, w, x = select.select(rlist, wlist, [], timeout)
+        ready = dict()
+        for fd in r: ready[fd] = POLL_READ
+        for fd in w: ready[fd] = ready.get(fd, 0) | POLL_WRITE
+        return ready.items()
+
+class PollPoller(Poller):
+
+    READ = select.POLLIN | select.POLLPRI if hasattr(select, 'poll') else 0
+    WRITE = select.POLLOUT if hasattr(select, 'poll') else 0
+    # hang ups and errors are reported as readable so the next recv sees them, whatever
+    # the interest: poll and level triggered epoll report them regardless, until handled.
+    # An fd watched for nothing is reported once and parked, it would wake every poll.
+    ERROR = (select.POLLHUP | select.POLLERR | select.POLLNVAL) if hasattr(select, 'poll') else 0
+
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self.poller = self.create()
+
+    def create(self):
+        return select.poll()
+
+    def mask(self, events):
+        return (self.READ if events & POLL_READ else 0) | (self.WRITE if events & POLL_WRITE else 0)
+
+    def add(self, fd, events):
+        self.poller.register(fd, self.mask(events))
+
+    def change(self, fd, events):
+        self.poller.modify(fd, self.mask(events))
+
+    def remove(self, fd):
+        self.poller.unregister(fd)
+
+    def wait(self, timeout):
+        return self.poller.poll(timeout * 1000 if timeout is not None else None)
+
+    def ready(self, timeout):
+        ready = []
+        for fd, mask in self.wait(timeout):
+            events = POLL_READ if mask & (self.READ | self.ERROR) else 0
+            if mask & (self.WRITE | self.ERROR): events |= POLL_WRITE
+            interest = self.events.get(fd, 0)
+            events &= interest
+            if mask & self.ERROR:
+                events |= POLL_READ
+                if not interest and fd in self.objects:
+                    self.parked.add(fd)
+                    try:
+                        self.remove(fd)
+                    except (IOError, OSError, ValueError):
+                        pass
+            if events: ready.append((fd, events))
+        return ready
+
+class EpollPoller(PollPoller):
+
+    READ = select.EPOLLIN | select.EPOLLPRI if hasattr(select, 'epoll') else 0
+    WRITE = select.EPOLLOUT if hasattr(select, 'epoll') else 0
+    ERROR = (select.EPOLLHUP | select.EPOLLERR) if hasattr(select, 'epoll') else 0
+
+    def create(self):
+        return select.epoll()
+
+    def wait(self, timeout):
+        return self.poller.poll(timeout if timeout is not None else -1)
+
+    def close(self):
+        super(EpollPoller, self).close()
+        self.poller.close()
+
+def poller():
+    if hasattr(select, 'epoll'): return EpollPoller()
+    if hasattr(select, 'poll'): return PollPoller()
+    return SelectPoller()
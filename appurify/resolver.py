@@ -0,0 +1,284 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Name resolution and connect racing for upstream connections made by the tunnel.
+
+DnsCache keeps getaddrinfo results for a fixed ttl (getaddrinfo does not
+expose record ttls) and failed lookups for a shorter negative ttl.
+Concurrent lookups of the same name wait on a single getaddrinfo. With a
+ResolverPool, entries that are about to expire are refreshed in the
+background so proxy threads keep being served from cache.
+
+connect() races addresses happy eyeballs style (RFC 8305), alternating
+address families and starting the next attempt when the previous one
+fails or has not connected within HAPPY_EYEBALLS_DELAY. It blocks the
+calling proxy thread for at most the connect timeout of the host.
+"""
+import os
+import time
+import errno
+import Queue
+import fnmatch
+import socket
+import threading
+
+from .utils import get_logger
+from .metrics import registry
+from .poller import poller, POLL_WRITE
+
+DNS_CACHE_TTL = 60000
+DNS_NEGATIVE_TTL = 5000
+DNS_CACHE_MAX_ENTRIES = 4096
+DNS_REFRESH_AHEAD = 0.75
+DNS_RESOLVER_THREADS = 2
+
+HAPPY_EYEBALLS_DELAY = 250
+CONNECT_TIMEOUT = 5000
+
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+resolver_log = get_logger('tunnel.resolver')
+
+dns_cache_hits = registry.counter('tunnel_dns_cache_hits_total', 'Upstream names served from dns cache')
+dns_cache_negative_hits = registry.counter('tunnel_dns_cache_negative_hits_total', 'Failed lookups served from dns cache')
+dns_cache_misses = registry.counter('tunnel_dns_cache_misses_total', 'Upstream names resolved with getaddrinfo')
+dns_refreshes = registry.counter('tunnel_dns_refreshes_total', 'Cache entries refreshed ahead of expiry')
+dns_latency = registry.histogram('tunnel_dns_resolve_seconds', 'getaddrinfo latency for upstream names')
+connect_attempts = registry.counter('tunnel_upstream_connect_attempts_total', 'Upstream connect attempts, one per address tried')
+connect_failures = registry.counter('tunnel_upstream_connect_failures_total', 'Upstream connect attempts refused or unreachable')
+connect_failovers = registry.counter('tunnel_upstream_connect_failovers_total', 'Upstream connects that succeeded on other than the first address')
+connect_timeouts = registry.counter('tunnel_upstream_connect_timeouts_total', 'Upstream connects that ran out of time')
+
+class Lookup(object):
+    """getaddrinfo in flight, other threads resolving the same name wait on it"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.addresses = None
+        self.error = None
+
+    def result(self):
+        if self.error: raise self.error
+        return self.addresses
+
+class ResolverPool(object):
+    """few daemon threads running background lookups"""
+
+    def __init__(self, threads=DNS_RESOLVER_THREADS):
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self.work, name='resolver-%d' % i)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, fn, *args):
+        self.queue.put((fn, args))
+
+    def work(self):
+        while True:
+            fn, args = self.queue.get()
+            try:
+                fn(*args)
+            except Exception, e: # pragma: no cover
+                resolver_log.warning("background lookup failed %r", e)
+
+class DnsCache(object):
+    """thread safe cache of getaddrinfo results keyed by (host, port).
+
+    ttl and negative_ttl are in milliseconds, pool is an optional
+    ResolverPool used to refresh entries ahead of expiry.
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL,
+                 max_entries=DNS_CACHE_MAX_ENTRIES, pool=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.entries = dict()   # (host, port) -> (resolved at, expires at, Lookup)
+        self.inflight = dict()  # (host, port) -> Lookup
+
+    def resolve(self, host, port):
+        """returns getaddrinfo tuples for a stream connection to host:port, raises socket.gaierror"""
+        if not host:
+            # getaddrinfo would resolve no host to loopback, e.g. for a relative request url
+            raise socket.gaierror(socket.EAI_NONAME, 'no host to resolve')
+        key = (host, port)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                resolved, expires, lookup = entry
+                if lookup.error:
+                    dns_cache_negative_hits.inc()
+                else:
+                    dns_cache_hits.inc()
+                    if self.pool and key not in self.inflight and \
+                    now - resolved > self.ttl * DNS_REFRESH_AHEAD / 1000.0:
+                        refresh = self.inflight[key] = Lookup()
+                        dns_refreshes.inc()
+                        self.pool.submit(self.lookup, key, refresh, True)
+                return lookup.result()
+            lookup = self.inflight.get(key)
+            owner = lookup is None
+            if owner:
+                lookup = self.inflight[key] = Lookup()
+
+        if owner:
+            self.lookup(key, lookup)
+        else:
+            lookup.event.wait()
+        return lookup.result()
+
+    def lookup(self, key, lookup, refresh=False):
+        """getaddrinfo for key, a failed refresh keeps the entry it was to replace until it expires"""
+        host, port = key
+        if not refresh: dns_cache_misses.inc()
+        started = time.time()
+        # waiters get this if getaddrinfo raises anything but socket.error, which is not cached
+        lookup.error = socket.gaierror(socket.EAI_FAIL, 'lookup of %r failed' % host)
+        ttl = None
+        try:
+            try:
+                lookup.addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+                lookup.error = None
+                ttl = self.ttl
+            except socket.error, e:
+                lookup.error = e
+                ttl = self.negative_ttl
+        finally:
+            now = time.time()
+            dns_latency.observe(now - started)
+            with self.lock:
+                entry = self.entries.get(key)
+                if refresh and lookup.error and entry and not entry[2].error and entry[1] > now:
+                    # served until it expires, refreshed again after negative_ttl
+                    retry = now - self.ttl * DNS_REFRESH_AHEAD / 1000.0 + self.negative_ttl / 1000.0
+                    self.entries[key] = (retry, entry[1], entry[2])
+                    ttl = None
+                if ttl is not None:
+                    if len(self.entries) >= self.max_entries and key not in self.entries:
+                        self.evict(now)
+                    self.entries[key] = (now, now + ttl / 1000.0, lookup)
+                self.inflight.pop(key, None)
+            lookup.event.set()
+
+    def evict(self, now):
+        for key, entry in self.entries.items():
+            if entry[1] <= now: del self.entries[key]
+        if len(self.entries) >= self.max_entries:
+            oldest = min(self.entries, key=lambda k: self.entries[k][1])
+            del self.entries[oldest]
+
+    def clear(self):
+        with self.lock:
+            self.entries = dict()
+
+def interleave(addresses):
+    """order addresses alternating between families, first family returned goes first"""
+    families, by_family = [], dict()
+    for address in addresses:
+        if address[0] not in by_family:
+            families.append(address[0])
+            by_family[address[0]] = []
+        by_family[address[0]].append(address)
+    ordered = []
+    while len(ordered) < len(addresses):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
+
+def connect(addresses, timeout, delay=HAPPY_EYEBALLS_DELAY):
+    """connects to whichever of addresses accepts first, blocking for at most timeout ms.
+
+    Returns a connected socket using the default socket timeout, raises
+    socket.timeout or the last connect error when every address fails.
+    """
+    pending = interleave(addresses)
+    deadline = time.time() + timeout / 1000.0
+    attempts = dict()   # socket -> sockaddr, connects in progress
+    writable = poller()
+    error = socket.error('no addresses to connect to')
+    sock, tried, next_attempt = None, 0, 0
+    try:
+        while sock is None:
+            now = time.time()
+            if pending and (not attempts or now >= next_attempt):
+                family, socktype, proto, canonname, sockaddr = pending.pop(0)
+                connect_attempts.inc()
+                tried += 1
+                attempt = socket.socket(family, socktype, proto)
+                attempt.setblocking(0)
+                err = attempt.connect_ex(sockaddr)
+                if err == 0:
+                    sock = attempt
+                elif err in CONNECT_IN_PROGRESS:
+                    attempts[attempt] = sockaddr
+                    writable.register(attempt, POLL_WRITE)
+                    next_attempt = now + delay / 1000.0
+                else:
+                    error = connect_failed(attempt, err)
+                continue
+            if not attempts:
+                raise error
+            if now >= deadline:
+                connect_timeouts.inc()
+                raise socket.timeout('timed out connecting to %s' % ', '.join(['%s:%s' % a[:2] for a in attempts.values()]))
+            wait = min(deadline, next_attempt) if pending else deadline
+            for attempt, events in writable.poll(max(wait - now, 0)):
+                writable.unregister(attempt)
+                del attempts[attempt]
+                err = attempt.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    sock = attempt
+                    break
+                error = connect_failed(attempt, err)
+                next_attempt = 0
+    finally:
+        writable.close()
+        for attempt in attempts: attempt.close()
+    sock.settimeout(socket.getdefaulttimeout())
+    if tried > 1: connect_failovers.inc()
+    return sock
+
+def connect_failed(sock, err):
+    sock.close()
+    connect_failures.inc()
+    return socket.error(err, os.strerror(err))
+
+class ConnectTimeouts(object):
+    """connect timeout in milliseconds per upstream host.
+
+    rules are (pattern, timeout) pairs matched in order with fnmatch, the
+    first match wins, e.g. ('*.example.com', 1000).
+    """
+
+    def __init__(self, default=CONNECT_TIMEOUT, rules=None):
+        self.default = default
+        self.rules = rules if rules else []
+
+    def get(self, host):
+        host = host.lower()
+        for pattern, timeout in self.rules:
+            if fnmatch.fnmatch(host, pattern):
+                return timeout
+        return self.default
+
+    @staticmethod
+    def parse_rule(spec):
+        """host=milliseconds as passed to --host-connect-timeout"""
+        pattern, sep, timeout = spec.rpartition('=')
+        if not sep or not pattern:
+            raise ValueError('expected host=milliseconds, got %r' % spec)
+        return pattern.lower(), int(timeout)
@@ -0,0 +1,146 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Fair sharing of the ssh transport between proxied connections.
+
+Every proxy thread sends to its device channel through FairScheduler.send,
+one send at a time across the tunnel. Turns are handed out deficit round
+robin: a flow waiting for its turn is credited quantum bytes and may send
+up to its deficit, a flow that keeps the wire busy goes to the back of
+the line. Flows that have sent less than short_bytes wait in a separate
+list that is served first (like new flows in fq_codel), so short
+responses are not queued behind bulk downloads. Optionally every flow is
+capped at rate bytes per second with a token bucket.
+
+Only sends towards devices are scheduled, they are what fill the
+transport. Reads from devices are paced by the devices themselves. A turn
+never covers more than the channel's send window: paramiko blocks a send
+once the window is used up, and a device that stopped reading would hold
+the turn of the whole tunnel.
+"""
+import time
+import threading
+import collections
+
+from .metrics import registry
+
+SCHEDULER_QUANTUM = 16384
+SCHEDULER_SHORT_FLOW_BYTES = 65536
+
+scheduler_queue_delay = registry.histogram('tunnel_scheduler_queue_delay_seconds', 'Time sends to devices waited for their turn on the transport')
+scheduler_waiting = registry.gauge('tunnel_scheduler_waiting', 'Connections waiting for their turn on the transport')
+scheduler_throttled = registry.counter('tunnel_scheduler_throttled_total', 'Sends to devices delayed by the per connection rate cap')
+scheduler_bytes = registry.counter('tunnel_scheduler_bytes_total', 'Bytes sent to devices through the scheduler')
+
+class Flow(object):
+    """scheduling state of one proxied connection"""
+
+    def __init__(self, rate=None, burst=SCHEDULER_QUANTUM):
+        self.deficit = 0
+        self.sent = 0
+        self.event = threading.Event()
+        self.queued_at = None
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.refilled = time.time()
+
+    def refill(self, now):
+        if not self.rate: return
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def throttle(self, nbytes):
+        """waits until the rate cap allows sending, returns bytes allowed"""
+        if not self.rate: return nbytes
+        self.refill(time.time())
+        wanted = min(nbytes, self.burst)
+        if self.tokens < wanted:
+            scheduler_throttled.inc()
+            time.sleep((wanted - self.tokens) / float(self.rate))
+            self.refill(time.time())
+        return max(int(self.tokens), 1)
+
+class FairScheduler(object):
+    """deficit round robin over flows sending to devices.
+
+    quantum and short_bytes are in bytes, rate caps every flow in bytes
+    per second (None for no cap).
+    """
+
+    def __init__(self, quantum=SCHEDULER_QUANTUM, short_bytes=SCHEDULER_SHORT_FLOW_BYTES, rate=None):
+        self.quantum = quantum
+        self.short_bytes = short_bytes
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.short_flows = collections.deque()
+        self.bulk_flows = collections.deque()
+        self.busy = None  # flow whose turn it is
+
+    def flow(self):
+        return Flow(self.rate, max(self.quantum, self.rate / 10 if self.rate else 0))
+
+    def send(self, flow, sock, data):
+        """sends what flow may send of data through sock when it is its turn, returns bytes sent"""
+        if send_window(sock) == 0: return 0
+        allowed = flow.throttle(len(data))
+        self.acquire(flow)
+        sent = 0
+        try:
+            n = min(len(data), allowed, flow.deficit)
+            window = send_window(sock)
+            if window is not None: n = min(n, window)
+            if n: sent = sock.send(data[:n] if n < len(data) else data)
+        finally:
+            self.release(flow, sent, sent < len(data))
+        return sent
+
+    def acquire(self, flow):
+        with self.lock:
+            if self.busy is None and not self.short_flows and not self.bulk_flows:
+                self.grant(flow)
+                scheduler_queue_delay.observe(0)
+                return
+            flow.event.clear()
+            flow.queued_at = time.time()
+            if flow.sent < self.short_bytes:
+                self.short_flows.append(flow)
+            else:
+                self.bulk_flows.append(flow)
+            scheduler_waiting.inc()
+        flow.event.wait()
+        scheduler_queue_delay.observe(time.time() - flow.queued_at)
+
+    def release(self, flow, sent, more):
+        """ends flow's turn after it sent bytes, more if it still has bytes to send"""
+        with self.lock:
+            flow.sent += sent
+            flow.deficit = flow.deficit - sent if more else 0
+            if flow.rate: flow.tokens -= sent
+            self.busy = None
+            for flows in (self.short_flows, self.bulk_flows):
+                if flows:
+                    scheduler_waiting.dec()
+                    self.grant(flows.popleft())
+                    break
+        scheduler_bytes.inc(sent)
+
+    def grant(self, flow):
+        # unused credit of a flow still backlogged is kept, up to one extra quantum
+        flow.deficit = min(flow.deficit + self.quantum, 2 * self.quantum)
+        self.busy = flow
+        flow.event.set()
+
+def send_window(sock):
+    """bytes a paramiko channel takes without blocking, None when unknown"""
+    if not hasattr(sock, 'send_ready'): return None
+    if not sock.send_ready(): return 0
+    # a closed channel is ready with no window, its send raises
+    return getattr(sock, 'out_window_size', None) or None
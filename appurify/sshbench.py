@@ -0,0 +1,186 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Self-benchmark for ssh transport options, run with appurify-tunnel.py --self-benchmark.
+
+A stand-in ssh server on loopback accepts the tunnel's remote forward and
+opens forwarded channels like Appurify infrastructure does. For every
+SshOptions in the matrix, bytes are pushed through channels in both
+directions: upload is tunnel to server (responses to devices), download
+is server to tunnel (requests from devices). Loopback has no latency, so
+this compares crypto and window overhead only, links with a long round
+trip gain more from larger windows than shown here. Half of every chunk
+is random so compression is not flattered by the payload.
+"""
+import os
+import time
+import socket
+import logging
+import threading
+import paramiko
+
+from .utils import log
+from .tunnel import SshOptions, SshTransport
+
+BENCH_BYTES = 8 * 1024 * 1024
+BENCH_CHUNK = 32768
+BENCH_CIPHERS = ('aes128-ctr', 'aes256-ctr', 'aes128-cbc', 'blowfish-cbc', 'arcfour128')
+BENCH_WINDOWS = (None, 1024 * 1024, 4 * 1024 * 1024)
+BENCH_USER = 'appurify'
+
+class StandInServer(paramiko.ServerInterface):
+    """accepts the bench key and any remote forward"""
+
+    def __init__(self, pkey):
+        self.pkey = pkey
+        self.forwarded = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if username == BENCH_USER and key == self.pkey:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_port_forward_request(self, address, port):
+        self.forwarded.set()
+        return port
+
+class StandIn(object):
+    """loopback ssh server for one tunnel connection at a time"""
+
+    def __init__(self, host_key, pkey):
+        self.host_key = host_key
+        self.pkey = pkey
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    def config(self):
+        return {'ssh_host': '127.0.0.1', 'ssh_port': self.port, 'ssh_user': BENCH_USER,
+                'pkey': self.pkey, 'proxy_port': 8080}
+
+    def accept(self, options):
+        """server side transport of the next tunnel connection"""
+        sock, addr = self.listener.accept()
+        transport = paramiko.Transport(sock)
+        options.apply(transport)
+        transport.add_server_key(self.host_key)
+        server = StandInServer(self.pkey)
+        transport.start_server(server=server)
+        server.forwarded.wait(10)
+        return transport
+
+    def close(self):
+        self.listener.close()
+
+def payload(nbytes):
+    text = ('appurify tunnel benchmark payload ' * (BENCH_CHUNK / 68 + 1))[:BENCH_CHUNK / 2]
+    chunks = [os.urandom(BENCH_CHUNK / 2) + text for i in range(nbytes / BENCH_CHUNK + 1)]
+    return ''.join(chunks)[:nbytes]
+
+def pump(chan, data):
+    for i in range(0, len(data), BENCH_CHUNK):
+        chan.sendall(data[i:i + BENCH_CHUNK])
+    chan.shutdown_write()
+
+def drain(chan, nbytes):
+    received = 0
+    while received < nbytes:
+        data = chan.recv(BENCH_CHUNK)
+        if not data: break
+        received += len(data)
+    return received
+
+def transfer(sender, receiver, nbytes):
+    """seconds to move nbytes from sender to receiver channel"""
+    data = payload(nbytes)
+    started = time.time()
+    thr = threading.Thread(target=pump, args=(sender, data))
+    thr.setDaemon(True)
+    thr.start()
+    received = drain(receiver, nbytes)
+    elapsed = time.time() - started
+    thr.join()
+    if received != nbytes:
+        raise IOError('received %d of %d bytes' % (received, nbytes))
+    return elapsed
+
+def run(stand_in, options, nbytes=BENCH_BYTES):
+    """returns upload and download throughput in bytes per second for options"""
+    saved, SshTransport.known_hosts = SshTransport.known_hosts, None
+    SshTransport.options = options
+    client = SshTransport(stand_in.config())
+    server = []
+    thr = threading.Thread(target=lambda: server.append(stand_in.accept(options)))
+    thr.setDaemon(True)
+    thr.start()
+    try:
+        client.connect()
+        client.forward()
+        thr.join(10)
+        results = dict()
+        for direction in ('upload', 'download'):
+            chan = server[0].open_forwarded_tcpip_channel(('127.0.0.1', 40000), ('127.0.0.1', 8080))
+            tunnel_chan = None
+            while tunnel_chan is None:
+                tunnel_chan = client.accept()
+            if direction == 'upload':
+                elapsed = transfer(tunnel_chan, chan, nbytes)
+            else:
+                elapsed = transfer(chan, tunnel_chan, nbytes)
+            results[direction] = nbytes / elapsed
+            chan.close()
+            tunnel_chan.close()
+        return results
+    finally:
+        SshTransport.known_hosts = saved
+        client.close()
+        for transport in server: transport.close()
+
+def matrix(base):
+    """SshOptions to compare, varying cipher, window and compression of base"""
+    candidates = [base]
+    for cipher in BENCH_CIPHERS:
+        for window in BENCH_WINDOWS:
+            for compress in (False, True):
+                candidates.append(SshOptions(window, base.max_packet_size, [cipher], base.macs, compress))
+    return candidates
+
+def main(base=None, nbytes=BENCH_BYTES):
+    """benchmark every option set in matrix(base), logs results and returns the fastest"""
+    base = base if base else SshOptions()
+    saved = SshTransport.options
+    paramiko_log = logging.getLogger('paramiko')
+    level = paramiko_log.level
+    paramiko_log.setLevel(logging.CRITICAL)
+    log('Generating keys for loopback ssh stand-in ...')
+    stand_in = StandIn(paramiko.RSAKey.generate(1024), paramiko.RSAKey.generate(1024))
+    results = []
+    try:
+        for options in matrix(base):
+            try:
+                r = run(stand_in, options, nbytes)
+            except Exception, e:
+                log('%-80s failed with %r' % (options, e))
+                continue
+            results.append((min(r['upload'], r['download']), options))
+            log('%-80s upload %7.2f MB/s  download %7.2f MB/s' % (options, r['upload'] / 1e6, r['download'] / 1e6))
+    finally:
+        stand_in.close()
+        SshTransport.options = saved
+        paramiko_log.setLevel(level)
+    if not results:
+        return None
+    best = max(results, key=lambda r: r[0])[1]
+    log('Fastest: %s' % best)
+    return best
@@ -0,0 +1,98 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+"""
+import os
+import time
+import threading
+
+from . import codec
+
+class Span(object):
+    """timed section of work, use as a context manager via Tracer.span()"""
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.tid = threading.current_thread().ident
+        self.start = None
+        self.duration = None
+
+    def set(self, key, value):
+        self.args[key] = value
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.time() - self.start
+        if exc_type:
+            self.args['error'] = repr(exc)
+        self.tracer.record(self)
+        return False
+
+class NullSpan(object):
+    """returned while tracing is disabled, costs a method call and nothing else"""
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Tracer(object):
+    """collects spans and writes them as a chrome trace-event file.
+
+    Load the written file in chrome://tracing (or any trace-event viewer)
+    to see where a run spent its time.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def events(self):
+        pid = os.getpid()
+        with self.lock:
+            spans = self.spans[:]
+        return [{
+            'name': span.name,
+            'ph': 'X',
+            'ts': int(span.start * 1000000),
+            'dur': int(span.duration * 1000000),
+            'pid': pid,
+            'tid': span.tid,
+            'args': span.args,
+        } for span in sorted(spans, key=lambda s: s.start)]
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            f.write(codec.dumps({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}))
+
+tracer = Tracer()
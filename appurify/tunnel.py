@@ -10,30 +10,60 @@
 """
 import os
 import sys
+import Queue
+import collections
 import signal
 import argparse
 import paramiko
-import select
 import socket
 import threading
 import urlparse
-import datetime
+import math
 import tempfile
 import atexit
 import time
 import logging
+import warnings
 
 from . import constants
-from .utils import log, post
+from .utils import log, post, get_logger, start_async_logging, monotonic
+from .codec import response_json
+from .accesslog import AccessLog, ACCESS_LOG_MAX_BYTES, ACCESS_LOG_BACKUPS
+from .metrics import registry, MetricsServer, MetricsReporter
+from .poller import poller, POLL_READ, POLL_WRITE
+from .scheduler import FairScheduler, SCHEDULER_QUANTUM
+from .httpcache import HttpCache, HTTP_CACHE_MAX_BYTES
+from .compression import GzipStream, compressible, content_type, gzip_head, GZIP_TYPES, GZIP_MIN_BYTES
+from .resolver import DnsCache, ResolverPool, ConnectTimeouts, connect, DNS_CACHE_TTL, DNS_NEGATIVE_TTL, \
+    DNS_RESOLVER_THREADS, CONNECT_TIMEOUT
 
 SOCKET_TIMEOUT = 5000
 ACCEPT_TIMEOUT = 1000
 SELECT_TIMEOUT = 1000
+SEND_READY_INTERVAL = 10  # channels never poll writable, pending sends are retried this often
 
 MAX_INACTIVITY = 30000
-MAX_RECV_BYTES = 8192
+IDLE_REAP_INTERVAL = 1000
+MAX_RECV_BYTES = 65536
 MAX_RETRIES = 5
 
+SSH_TRANSPORTS = 1
+HEALTH_CHECK_INTERVAL = 5000
+RECONNECT_BACKOFF_MIN = 1000
+RECONNECT_BACKOFF_MAX = 30000
+
+SSH_PORT = 22
+SSH_WINDOW_SIZE = None      # bytes, None keeps paramiko default
+SSH_MAX_PACKET_SIZE = None  # bytes, None keeps paramiko default
+
+PROXY_WORKERS = 256
+PROXY_QUEUE_SIZE = 1024
+PROXY_QUEUE_TIMEOUT = 5000
+
+RELAY_BUFFER_BYTES = 65536
+SEND_COALESCE_BYTES = 16384
+BUFFER_POOL_MAX_FREE = 1024
+
 CRLF = '\r\n'
 COLON = ':'
 SP = ' '
@@ -50,7 +80,167 @@ HTTP_PARSER_STATE_COMPLETE = 6
 
 CHUNK_PARSER_STATE_WAITING_FOR_SIZE = 1
 CHUNK_PARSER_STATE_WAITING_FOR_DATA = 2
-CHUNK_PARSER_STATE_COMPLETE = 3
+CHUNK_PARSER_STATE_WAITING_FOR_CRLF = 3
+CHUNK_PARSER_STATE_WAITING_FOR_TRAILERS = 4
+CHUNK_PARSER_STATE_COMPLETE = 5
+
+proxy_log = get_logger('tunnel.proxy')
+
+proxy_threads = registry.gauge('tunnel_proxy_threads', 'Proxy threads currently alive')
+channels_accepted = registry.counter('tunnel_channels_accepted_total', 'Channels accepted from ssh transport')
+client_bytes_received = registry.counter('tunnel_client_bytes_received_total', 'Bytes received from devices over the tunnel')
+client_bytes_sent = registry.counter('tunnel_client_bytes_sent_total', 'Bytes sent to devices over the tunnel')
+server_bytes_received = registry.counter('tunnel_server_bytes_received_total', 'Bytes received from upstream servers')
+server_bytes_sent = registry.counter('tunnel_server_bytes_sent_total', 'Bytes sent to upstream servers')
+connect_latency = registry.histogram('tunnel_upstream_connect_seconds', 'Upstream connect latency')
+bad_gateways = registry.counter('tunnel_bad_gateway_total', '502 Bad Gateway responses served')
+proxy_workers = registry.gauge('tunnel_proxy_workers', 'Proxy worker threads started')
+proxy_workers_busy = registry.gauge('tunnel_proxy_workers_busy', 'Proxy worker threads serving a channel')
+proxy_queue_depth = registry.gauge('tunnel_proxy_queue_depth', 'Accepted channels waiting for a proxy worker')
+proxy_queue_wait = registry.histogram('tunnel_proxy_queue_wait_seconds', 'Time accepted channels waited for a proxy worker')
+proxy_rejected = registry.counter('tunnel_proxy_rejected_total', 'Channels answered 503 because proxy workers were saturated')
+gateway_timeouts = registry.counter('tunnel_gateway_timeout_total', '504 Gateway Timeout responses served')
+tunnel_restarts = registry.counter('tunnel_restarts_total', 'Tunnel restarts after transport failure')
+ssh_transports = registry.gauge('tunnel_ssh_transports', 'Healthy ssh transports accepting channels')
+ssh_standby = registry.gauge('tunnel_ssh_standby', 'Standby ssh transports connected and ready to take over')
+ssh_transports_removed = registry.counter('tunnel_ssh_transports_removed_total', 'Dead ssh transports removed by health checks')
+
+class BufferPool(object):
+    """free list of equally sized bytearrays for recv_into by relay pipes.
+
+    Buffers are held per CONNECT relay and given back on close, so the
+    number ever allocated follows peak concurrency rather than traffic.
+    The http path reads with plain recv, its parser needs a string of every
+    read anyway and a pooled buffer would only add a copy. in_use,
+    high_water and allocated are also exported as gauges when a registry
+    is passed in.
+    """
+
+    def __init__(self, size=MAX_RECV_BYTES, max_free=BUFFER_POOL_MAX_FREE, registry=None):
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.high_water = 0
+        self.allocated = 0
+        self.gauges = None
+        if registry:
+            self.gauges = (
+                registry.gauge('tunnel_buffer_pool_in_use', 'Receive buffers currently held by connections'),
+                registry.gauge('tunnel_buffer_pool_high_water', 'Most receive buffers held at once'),
+                registry.gauge('tunnel_buffer_pool_allocated', 'Receive buffers allocated'),
+            )
+            self.update_gauges()
+
+    def acquire(self):
+        with self.lock:
+            buf = self.free.pop() if self.free else None
+            if buf is None: self.allocated += 1
+            self.in_use += 1
+            self.high_water = max(self.high_water, self.in_use)
+            self.update_gauges()
+        return buf if buf is not None else bytearray(self.size)
+
+    def release(self, buf):
+        with self.lock:
+            self.in_use -= 1
+            if len(buf) == self.size and len(self.free) < self.max_free:
+                self.free.append(buf)
+            self.update_gauges()
+
+    def update_gauges(self):
+        if not self.gauges: return
+        in_use, high_water, allocated = self.gauges
+        in_use.set(self.in_use)
+        high_water.set(self.high_water)
+        allocated.set(self.allocated)
+
+class IdleReaper(object):
+    """hashed timer wheel closing connections idle for longer than timeout ms.
+
+    A reaper thread advances ticks every tick ms. Connections record
+    activity by copying ticks into their last_active attribute, a plain
+    store with no lock or clock read. Each connection sits in the wheel
+    slot of its deadline, when that slot comes round it is either reaped
+    or moved to the slot of its new deadline, so the wheel only looks at
+    connections that may have expired. Connections are reaped after
+    between timeout and timeout + tick ms without activity, reaped counts
+    them and is also exported as a counter when a registry is passed in.
+    """
+
+    def __init__(self, timeout=MAX_INACTIVITY, tick=IDLE_REAP_INTERVAL, registry=None):
+        self.tick = tick / 1000.0
+        self.timeout_ticks = int(math.ceil(float(timeout) / tick))
+        self.slots = [set() for i in range(self.timeout_ticks + 2)]
+        self.slot = dict()  # connection -> index into slots
+        self.ticks = 0
+        self.reaped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counter = None
+        if registry:
+            self.counter = registry.counter('tunnel_idle_reaped_total', 'Proxied connections closed for inactivity')
+
+    def add(self, conn):
+        """track conn, which needs a last_active attribute and a reap() method"""
+        with self.lock:
+            conn.last_active = self.ticks
+            self.schedule(conn, self.deadline(conn))
+            if self.thread is None: self.start()
+
+    def discard(self, conn):
+        with self.lock:
+            index = self.slot.pop(conn, None)
+            if index is not None: self.slots[index].discard(conn)
+
+    def deadline(self, conn):
+        return conn.last_active + self.timeout_ticks + 1
+
+    def schedule(self, conn, deadline):
+        index = deadline % len(self.slots)
+        self.slots[index].add(conn)
+        self.slot[conn] = index
+
+    def advance(self, ticks=1):
+        """moves the wheel ticks forward, returns connections reaped"""
+        expired = []
+        with self.lock:
+            for i in range(ticks):
+                self.ticks += 1
+                index = self.ticks % len(self.slots)
+                due, self.slots[index] = self.slots[index], set()
+                for conn in due:
+                    deadline = self.deadline(conn)
+                    if deadline <= self.ticks:
+                        del self.slot[conn]
+                        expired.append(conn)
+                    else:
+                        self.schedule(conn, deadline)
+            self.reaped += len(expired)
+        for conn in expired:
+            if self.counter: self.counter.inc()
+            try:
+                conn.reap()
+            except Exception, e: # pragma: no cover
+                proxy_log.warning("unexpected exception while reaping %r", e)
+        return len(expired)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='idle-reaper')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        started = monotonic()
+        while True:
+            time.sleep(self.tick)
+            due = int((monotonic() - started) / self.tick) - self.ticks
+            if due > 0: self.advance(due)
+
+    def idle_for(self, conn):
+        """seconds since conn was last active, in whole ticks"""
+        return (self.ticks - conn.last_active) * self.tick
 
 class ChunkParser(object):
 
@@ -59,39 +249,61 @@ class ChunkParser(object):
         self.body = ''
         self.chunk = ''
         self.size = None
+        self.buffer = ''  # incomplete size, crlf or trailer line
 
     def parse(self, data):
+        data = self.buffer + data
+        self.buffer = ''
         more = True if len(data) > 0 else False
         while more: more, data = self.process(data)
 
     def process(self, data):
-        if self.state == CHUNK_PARSER_STATE_WAITING_FOR_SIZE:
-            line, data = HttpParser.split(data)
-            self.size = int(line, 16)
-            self.state = CHUNK_PARSER_STATE_WAITING_FOR_DATA
-        elif self.state == CHUNK_PARSER_STATE_WAITING_FOR_DATA:
+        if self.state == CHUNK_PARSER_STATE_WAITING_FOR_DATA:
             remaining = self.size - len(self.chunk)
             self.chunk += data[:remaining]
             data = data[remaining:]
             if len(self.chunk) == self.size:
-                data = data[len(CRLF):]
                 self.body += self.chunk
-                if self.size == 0:
-                    self.state = CHUNK_PARSER_STATE_COMPLETE
-                else:
+                if data[:len(CRLF)] == CRLF:
+                    data = data[len(CRLF):]
                     self.state = CHUNK_PARSER_STATE_WAITING_FOR_SIZE
+                else:
+                    self.state = CHUNK_PARSER_STATE_WAITING_FOR_CRLF
                 self.chunk = ''
                 self.size = None
-        return len(data) > 0, data
+        else:
+            line, data = HttpParser.split(data)
+            if line == False:
+                self.buffer = data
+                return False, ''
+            self.process_line(line)
+        return len(data) > 0 and self.state != CHUNK_PARSER_STATE_COMPLETE, data
+
+    def process_line(self, line):
+        if self.state == CHUNK_PARSER_STATE_WAITING_FOR_SIZE:
+            # chunk extensions after ; are ignored
+            self.size = int(line.split(';')[0].strip(), 16)
+            if self.size == 0:
+                self.size = None
+                self.state = CHUNK_PARSER_STATE_WAITING_FOR_TRAILERS
+            else:
+                self.state = CHUNK_PARSER_STATE_WAITING_FOR_DATA
+        elif self.state == CHUNK_PARSER_STATE_WAITING_FOR_CRLF:
+            self.state = CHUNK_PARSER_STATE_WAITING_FOR_SIZE
+        elif self.state == CHUNK_PARSER_STATE_WAITING_FOR_TRAILERS:
+            if len(line) == 0: self.state = CHUNK_PARSER_STATE_COMPLETE
 
 class HttpParser(object):
 
-    def __init__(self, type=None):
+    def __init__(self, type=None, request=None):
         self.state = HTTP_PARSER_STATE_INITIALIZED
         self.type = type if type else HTTP_REQUEST_PARSER
+        self.request = request  # parser of the request a response parser answers
 
         self.raw = ''
         self.buffer = ''
+        self.start = 0      # offset in raw of the message being parsed
+        self.interim = ''   # interim responses parsed and not yet taken, see Proxy.process_response
 
         self.headers = dict()
         self.body = None
@@ -114,24 +326,9 @@ class HttpParser(object):
         self.buffer = data
 
     def process(self, data):
-        if self.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE and \
-        (self.method == "POST" or self.type == HTTP_RESPONSE_PARSER):
-            if not self.body:
-                self.body = ''
-
-            if 'content-length' in self.headers:
-                self.state = HTTP_PARSER_STATE_RCVING_BODY
-                self.body += data
-                if len(self.body) >= int(self.headers['content-length'][1]):
-                    self.state = HTTP_PARSER_STATE_COMPLETE
-            elif 'transfer-encoding' in self.headers and self.headers['transfer-encoding'][1].lower() == 'chunked':
-                if not self.chunker:
-                    self.chunker = ChunkParser()
-                self.chunker.parse(data)
-                if self.chunker.state == CHUNK_PARSER_STATE_COMPLETE:
-                    self.body = self.chunker.body
-                    self.state = HTTP_PARSER_STATE_COMPLETE
-
+        if self.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE:
+            if self.state < HTTP_PARSER_STATE_COMPLETE:
+                self.process_body(data)
             return False, ''
 
         line, data = HttpParser.split(data)
@@ -142,14 +339,76 @@ class HttpParser(object):
         elif self.state < HTTP_PARSER_STATE_HEADERS_COMPLETE:
             self.process_header(line)
 
-        if self.state == HTTP_PARSER_STATE_HEADERS_COMPLETE and \
-        self.type == HTTP_REQUEST_PARSER and \
-        not self.method == "POST" and \
-        self.raw.endswith(CRLF*2):
-            self.state = HTTP_PARSER_STATE_COMPLETE
+        if self.state == HTTP_PARSER_STATE_HEADERS_COMPLETE:
+            self.process_headers_complete()
+            if self.state == HTTP_PARSER_STATE_INITIALIZED:
+                end = len(self.raw) - len(data)
+                self.interim += self.raw[self.start:end]
+                self.start = end
 
         return len(data) > 0, data
 
+    def process_headers_complete(self):
+        if self.type == HTTP_RESPONSE_PARSER and self.code.startswith('1') and self.code != '101':
+            # interim response (100 Continue), the final one follows on the same connection
+            self.state = HTTP_PARSER_STATE_INITIALIZED
+            self.headers = dict()
+            self.code = self.reason = self.version = None
+        elif not self.has_body():
+            self.state = HTTP_PARSER_STATE_COMPLETE
+
+    def process_body(self, data):
+        if not self.body:
+            self.body = ''
+        self.state = HTTP_PARSER_STATE_RCVING_BODY
+
+        if self.is_chunked():
+            if not self.chunker:
+                self.chunker = ChunkParser()
+            self.chunker.parse(data)
+            if self.chunker.state == CHUNK_PARSER_STATE_COMPLETE:
+                self.body = self.chunker.body
+                self.state = HTTP_PARSER_STATE_COMPLETE
+        elif self.content_length() is not None:
+            self.body += data
+            if len(self.body) >= self.content_length():
+                self.state = HTTP_PARSER_STATE_COMPLETE
+        else:
+            self.body += data
+
+    def has_body(self):
+        """message length rules of RFC 7230 section 3.3.3"""
+        if self.type == HTTP_RESPONSE_PARSER:
+            if self.code in ('204', '304'): return False
+            if self.request and self.request.method == 'HEAD': return False
+        if self.is_chunked(): return True
+        length = self.content_length()
+        if length is not None: return length > 0
+        # requests without framing headers have no body, responses are delimited by close
+        return self.type == HTTP_RESPONSE_PARSER
+
+    def is_chunked(self):
+        if 'transfer-encoding' not in self.headers: return False
+        return self.headers['transfer-encoding'][1].split(',')[-1].strip().lower() == 'chunked'
+
+    def content_length(self):
+        """declared body length, None if absent, invalid or overridden by transfer-encoding"""
+        if 'transfer-encoding' in self.headers or 'content-length' not in self.headers: return None
+        try:
+            return int(self.headers['content-length'][1])
+        except ValueError:
+            return None
+
+    def is_close_delimited(self):
+        return self.type == HTTP_RESPONSE_PARSER and not self.is_chunked() and self.content_length() is None
+
+    def eof(self):
+        """connection closed by peer, completes a body delimited by close"""
+        if self.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE and self.state < HTTP_PARSER_STATE_COMPLETE \
+        and self.is_close_delimited():
+            if not self.body: self.body = ''
+            self.state = HTTP_PARSER_STATE_COMPLETE
+
     def process_line(self, data):
         line = data.split(SP)
         if self.type == HTTP_REQUEST_PARSER:
@@ -164,10 +423,8 @@ class HttpParser(object):
 
     def process_header(self, data):
         if len(data) == 0:
-            if self.state == HTTP_PARSER_STATE_RCVING_HEADERS:
-                self.state = HTTP_PARSER_STATE_HEADERS_COMPLETE
-            elif self.state == HTTP_PARSER_STATE_LINE_RCVD:
-                self.state = HTTP_PARSER_STATE_RCVING_HEADERS
+            # the empty line ends the head, also right after the start line of a message without headers
+            self.state = HTTP_PARSER_STATE_HEADERS_COMPLETE
         else:
             self.state = HTTP_PARSER_STATE_RCVING_HEADERS
             parts = data.split(COLON)
@@ -175,6 +432,11 @@ class HttpParser(object):
             value = COLON.join(parts[1:]).strip()
             self.headers[key.lower()] = (key, value)
 
+    def decoded_body(self):
+        """body received so far without chunk framing, complete or not"""
+        if self.chunker: return self.chunker.body
+        return self.body or ''
+
     def build_url(self):
         if not self.url:
             return '/None'
@@ -188,24 +450,36 @@ class HttpParser(object):
     def build_header(self, k, v):
         return '%s: %s%s' % (k, v, CRLF)
 
-    def build(self, del_headers=None, add_headers=None):
-        req = '%s %s %s' % (self.method, self.build_url(), self.version)
-        req += CRLF
+    def build_head(self, del_headers=None, add_headers=None):
+        """request line and headers up to and including the empty line, in one join"""
+        lines = ['%s %s %s%s' % (self.method, self.build_url(), self.version, CRLF)]
 
         if not del_headers: del_headers = []
         for k in self.headers:
             if not k in del_headers:
-                req += self.build_header(self.headers[k][0], self.headers[k][1])
+                lines.append(self.build_header(self.headers[k][0], self.headers[k][1]))
 
         if not add_headers: add_headers = []
         for k in add_headers:
-            req += self.build_header(k[0], k[1])
+            lines.append(self.build_header(k[0], k[1]))
+
+        lines.append(CRLF)
+        return ''.join(lines)
 
-        req += CRLF
+    def build_parts(self, del_headers=None, add_headers=None):
+        """head and body to be sent in order, the body is passed on without copying"""
+        parts = [self.build_head(del_headers, add_headers)]
         if self.body:
-            req += self.body
+            parts.append(self.body)
+        return parts
+
+    def build(self, del_headers=None, add_headers=None):
+        return ''.join(self.build_parts(del_headers, add_headers))
 
-        return req
+    def unparsed_body(self):
+        """body bytes received so far exactly as sent, chunk framing included"""
+        end = self.raw.find(CRLF*2)
+        return self.raw[end+len(CRLF*2):] if end != -1 else ''
 
     @staticmethod
     def split(data):
@@ -218,18 +492,212 @@ class HttpParser(object):
 class ProxyConnectFailed(Exception):
     pass
 
+class ProxyConnectTimeout(ProxyConnectFailed):
+    pass
+
+class ProxyRevalidationFailed(Exception):
+    pass
+
+class Pipe(object):
+    """one direction of an established CONNECT tunnel.
+
+    Endpoints that are real sockets are read with recv_into a preallocated
+    buffer and written from memoryview slices, so bytes are not copied into
+    intermediate strings. Endpoints without recv_into (paramiko channels)
+    fall back to recv/send of plain strings.
+    """
+
+    def __init__(self, src, dst, size=RELAY_BUFFER_BYTES, buf=None, send=None):
+        self.src = src
+        self.dst = dst
+        self.send = send if send else dst.send
+        self.size = len(buf) if buf is not None else size
+        self.zero_copy_recv = hasattr(src, 'recv_into')
+        self.zero_copy_send = hasattr(dst, 'recv_into')
+        if self.zero_copy_recv:
+            self.buf = buf if buf is not None else bytearray(size)
+            self.view = memoryview(self.buf)
+        self.data = None
+        self.start = 0
+        self.end = 0
+
+    def pending(self):
+        return self.end - self.start
+
+    def fill(self):
+        if self.zero_copy_recv:
+            n = self.src.recv_into(self.buf)
+            self.data = self.view
+        else:
+            data = self.src.recv(self.size)
+            n = len(data)
+            self.data = memoryview(data) if self.zero_copy_send else data
+        self.start, self.end = 0, n
+        return n
+
+    def drain(self):
+        chunk = self.data[self.start:self.end]
+        if not self.zero_copy_send and isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        sent = self.send(chunk)
+        self.start += sent
+        return sent
+
+class SendQueue(object):
+    """bytes queued for a socket as the strings they arrived in.
+
+    Python 2 has no socket.sendmsg, so instead of a vectored send small
+    parts at the front (request head, start of a body) are joined into a
+    single send of up to SEND_COALESCE_BYTES, larger ones are sent from
+    memoryview slices of the queued string without copying it.
+    """
+
+    def __init__(self):
+        self.parts = collections.deque()
+        self.offset = 0  # bytes of parts[0] already sent
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if not data: return
+        self.parts.append(data)
+        self.size += len(data)
+
+    def extend(self, parts):
+        for data in parts: self.append(data)
+
+    def peek(self):
+        """next bytes to send"""
+        first = self.parts[0]
+        if len(first) - self.offset >= SEND_COALESCE_BYTES or len(self.parts) == 1:
+            return memoryview(first)[self.offset:] if self.offset else first
+        chunks, n = [], 0
+        for data in self.parts:
+            data = data[self.offset:] if not chunks and self.offset else data
+            chunks.append(data[:SEND_COALESCE_BYTES - n])
+            n += len(chunks[-1])
+            if n >= SEND_COALESCE_BYTES: break
+        return ''.join(chunks)
+
+    def send(self, sock):
+        data = self.peek()
+        if isinstance(data, memoryview) and not hasattr(sock, 'recv_into'):
+            data = data.tobytes()
+        sent = sock.send(data)
+        self.consume(sent)
+        return sent
+
+    def consume(self, n):
+        self.size -= n
+        while n:
+            remaining = len(self.parts[0]) - self.offset
+            if n < remaining:
+                self.offset += n
+                return
+            self.parts.popleft()
+            self.offset = 0
+            n -= remaining
+
+class WorkerPool(object):
+    """bounded set of threads running Proxy for accepted channels.
+
+    Channels wait in an accept queue of queue_size while every worker is
+    busy, workers are started on demand up to size. A channel finding the
+    queue full, or still queued after queue_timeout milliseconds, is
+    answered 503 and closed instead of piling up threads.
+    """
+
+    service_unavailable_pkt = CRLF.join([
+        'HTTP/1.1 503 Service Unavailable',
+        'Retry-After: 1',
+        'Connection: close',
+        CRLF
+    ])
+
+    def __init__(self, size=PROXY_WORKERS, queue_size=PROXY_QUEUE_SIZE, queue_timeout=PROXY_QUEUE_TIMEOUT):
+        self.size = size
+        self.queue_timeout = queue_timeout
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.workers = 0
+        self.idle = 0
+        self.queued = 0     # channels not yet taken by a worker, kept with idle under lock
+
+    def submit(self, chan):
+        """returns False if chan was rejected"""
+        try:
+            self.queue.put_nowait((chan, time.time()))
+        except Queue.Full:
+            self.reject(chan)
+            return False
+        proxy_queue_depth.set(self.queue.qsize())
+        with self.lock:
+            self.queued += 1
+            spawn = self.queued > self.idle and self.workers < self.size
+            if spawn:
+                self.workers += 1
+                proxy_workers.set(self.workers)
+        if spawn:
+            thr = threading.Thread(target=self.work, name='proxy-%d' % self.workers)
+            thr.setDaemon(True)
+            thr.start()
+        return True
+
+    def work(self):
+        while True:
+            with self.lock: self.idle += 1
+            chan, queued = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+                self.queued -= 1
+            proxy_queue_depth.set(self.queue.qsize())
+            waited = time.time() - queued
+            proxy_queue_wait.observe(waited)
+            if waited * 1000 > self.queue_timeout:
+                self.reject(chan)
+                continue
+            proxy_workers_busy.inc()
+            try:
+                Proxy(chan).run()
+            finally:
+                proxy_workers_busy.dec()
+
+    def reject(self, chan):
+        proxy_rejected.inc()
+        try:
+            chan.send(WorkerPool.service_unavailable_pkt)
+        except Exception, e: # pragma: no cover
+            proxy_log.debug("unable to send 503 %r", e)
+        finally:
+            chan.close()
+
 class Proxy(threading.Thread):
 
+    access_log = None   # AccessLog receiving a record per proxied request, see Tunnel.cli --access-log
+    buffer_pool = BufferPool(registry=registry)   # relay pipe buffers, see Tunnel.cli --recv-buffer-bytes
+    resolver = DnsCache()   # upstream name cache, see Tunnel.cli --dns-cache-ttl
+    connect_timeouts = ConnectTimeouts()   # see Tunnel.cli --connect-timeout and --host-connect-timeout
+    worker_pool = WorkerPool()   # runs proxies for accepted channels, see Tunnel.cli --proxy-workers
+    idle_reaper = IdleReaper(registry=registry)   # closes idle proxies, see Tunnel.cli --idle-timeout
+    scheduler = None   # FairScheduler for sends to devices, see Tunnel.cli --fair-share
+    stream_request_bodies = True   # connect once request headers are in, see Tunnel.cli --buffer-request-bodies
+    http_cache = None   # HttpCache of GET responses, see Tunnel.cli --http-cache
+    gzip_types = None   # content types gzip encoded for clients, see Tunnel.cli --gzip
+    gzip_min_bytes = GZIP_MIN_BYTES
+
     def __init__(self, client):
         super(Proxy, self).__init__()
         self.request = HttpParser()
-        self.response = HttpParser(HTTP_RESPONSE_PARSER)
+        self.response = HttpParser(HTTP_RESPONSE_PARSER, self.request)
 
         self.client = client
         self.server = None
-        self.buffer = {'client':'', 'server':''}
+        self.buffer = {'client':'', 'server':SendQueue()}
 
         self.closed = False
+        self.upstream_closed = False
         self.connection_established_pkt = CRLF.join([
             'HTTP/1.1 200 Connection established',
             'Proxy-agent: Appurify Inc. Proxy over Tunnel v%s' % constants.__version__,
@@ -238,36 +706,77 @@ class Proxy(threading.Thread):
 
         self.host = None
         self.port = None
-        self.last_activity = Tunnel.now()
+        self.last_active = Proxy.idle_reaper.ticks
+        self.reaped = False
+
+        self.started = time.time()
+        self.connect_time = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.error = None
+        self.error_code = None
+        self.buffers = dict()
+        self.poller = None
+        self.flow = Proxy.scheduler.flow() if Proxy.scheduler else None
+        self.from_cache = False
+        self.revalidating = None   # stale cache entry the upstream response may confirm
+        self.held = ''             # response bytes held back until the head is in
+        self.gzip = None           # GzipStream of the response, False once it is known not to be encoded
+        self.stored = False
 
     def server_host_port(self):
         if not self.host and not self.port:
             if self.request.method == "CONNECT":
-                self.host, self.port = self.request.url.path.split(':')
+                host, port = self.request.url.path.split(':')
+                self.host, self.port = host, int(port)
             elif self.request.url:
                 self.host, self.port = self.request.url.hostname, self.request.url.port if self.request.url.port else 80
         return self.host, self.port
 
     def connect_to_server(self):
         host, port = self.server_host_port()
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.connect((host, int(port)))
+        addresses = Proxy.resolver.resolve(host, int(port))
+        started = time.time()
+        self.server = connect(addresses, Proxy.connect_timeouts.get(host))
+        self.connect_time = time.time() - started
+        connect_latency.observe(self.connect_time)
 
     def log(self):
+        if not proxy_log.isEnabledFor(logging.INFO): return
         host, port = self.server_host_port()
         if self.request.method == "CONNECT":
-            log("%r %s %s:%s (%s secs)" % (self.client.origin_addr, self.request.method, host, port, self.inactive_for()))
+            proxy_log.info("%r %s %s:%s (%s secs)", self.client.origin_addr, self.request.method, host, port, self.inactive_for())
         else:
-            log("%r %s %s:%s%s %s %s %s bytes (%s secs)" % (self.client.origin_addr, self.request.method, host, port, self.request.build_url(), self.response.code, self.response.reason, len(self.response.raw), self.inactive_for()))
+            proxy_log.info("%r %s %s:%s%s %s %s %s bytes (%s secs)", self.client.origin_addr, self.request.method, host, port, self.request.build_url(), self.response.code, self.response.reason, len(self.response.raw), self.inactive_for())
+
+    def access_record(self):
+        host, port = self.server_host_port()
+        return {
+            'ts': self.started,
+            'method': self.request.method,
+            'host': host,
+            'port': port,
+            'url': None if self.request.method == "CONNECT" else self.request.build_url(),
+            'status': self.error_code if self.error else self.response.code,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'duration': time.time() - self.started,
+            'connect_time': self.connect_time,
+        }
 
     def process_request(self, data):
+        if self.from_cache:
+            return
         if self.server:
-            self.buffer['server'] += data
+            self.buffer['server'].append(data)
         else:
             self.request.parse(data)
-            if self.request.state == HTTP_PARSER_STATE_COMPLETE:
+            if self.request.state == HTTP_PARSER_STATE_COMPLETE or self.streaming():
+                if Proxy.http_cache and self.serve_from_cache(): return
                 try:
                     self.connect_to_server()
+                except socket.timeout, e:
+                    raise ProxyConnectTimeout("%r" % e)
                 except Exception, e:
                     raise ProxyConnectFailed("%r" % e)
 
@@ -276,174 +785,638 @@ class Proxy(threading.Thread):
                 else:
                     del_headers = ['proxy-connection', 'connection', 'keep-alive']
                     add_headers = [('Connection', 'Close')]
-                    self.buffer['server'] += self.request.build(del_headers=del_headers, add_headers=add_headers)
+                    if self.revalidating: add_headers.extend(self.revalidating.validators())
+                    if Proxy.stream_request_bodies:
+                        # the rest of the body is passed through as it arrives
+                        self.buffer['server'].append(self.request.build_head(del_headers=del_headers, add_headers=add_headers))
+                        self.buffer['server'].append(self.request.unparsed_body())
+                    else:
+                        self.buffer['server'].extend(self.request.build_parts(del_headers=del_headers, add_headers=add_headers))
+
+    def streaming(self):
+        """request headers are in and the body is to be streamed upstream"""
+        return Proxy.stream_request_bodies and self.request.method != "CONNECT" and \
+            self.request.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE
 
     def process_response(self, data):
         if not self.request.method == "CONNECT":
             self.response.parse(data)
+            if self.revalidating or Proxy.gzip_types:
+                # what the client gets depends on the head, interim responses are passed on right away
+                self.held += data
+                if self.response.interim:
+                    self.buffer['client'] += self.response.interim
+                    self.held = self.held[len(self.response.interim):]
+                    self.response.interim = ''
+                if self.response.state < HTTP_PARSER_STATE_HEADERS_COMPLETE: return
+                data, self.held = self.held, ''
+                if self.revalidating: data = self.revalidated(data)
+                if Proxy.gzip_types: data = self.encode(data)
         self.buffer['client'] += data
+        if self.response.state == HTTP_PARSER_STATE_COMPLETE: self.store_response()
+
+    def encode(self, data):
+        """response bytes for the client, gzip encoded when the response qualifies"""
+        head = ''
+        if self.gzip is None:
+            self.gzip = False
+            if compressible(self.request, self.response, Proxy.gzip_types, Proxy.gzip_min_bytes):
+                chunked = self.request.version == 'HTTP/1.1' and self.response.version == 'HTTP/1.1'
+                self.gzip = GzipStream(content_type(self.response), chunked)
+                head = gzip_head(self.response, chunked)
+        if not self.gzip: return data
+        # the parser decodes chunked bodies, pick up what it added since
+        body = self.response.decoded_body()
+        data = head + self.gzip.compress(body[self.gzip.consumed:])
+        if self.response.state == HTTP_PARSER_STATE_COMPLETE: data += self.gzip.finish()
+        return data
+
+    def serve_from_cache(self):
+        """answers a fresh hit from the http cache, otherwise notes the stale entry to revalidate"""
+        if self.request.state != HTTP_PARSER_STATE_COMPLETE: return False
+        entry, body = Proxy.http_cache.lookup(self.request)
+        if body is not None:
+            data = self.respond_from_cache(entry, body)
+            self.buffer['client'] += self.encode(data) if Proxy.gzip_types else data
+            return True
+        self.revalidating = entry
+        return False
+
+    def revalidated(self, data):
+        """what to pass on to the client once the response to a conditional request is in"""
+        entry, self.revalidating = self.revalidating, None
+        if self.response.code == '304':
+            body = Proxy.http_cache.refresh(entry, self.response)
+            # the stored body vanished with the entry, the client never asked for a 304
+            if body is None: raise ProxyRevalidationFailed("%s not modified but no longer cached" % entry.key)
+            return self.respond_from_cache(entry, body)
+        return data
+
+    def respond_from_cache(self, entry, body):
+        data = entry.head(time.time()) + body
+        self.response = HttpParser(HTTP_RESPONSE_PARSER, self.request)
+        self.response.parse(data)
+        self.from_cache = True
+        return data
+
+    def store_response(self):
+        if not Proxy.http_cache or self.stored or self.from_cache: return
+        self.stored = True
+        Proxy.http_cache.store(self.request, self.response)
+
+    def recv_buffer(self, sock):
+        """pooled buffer for the relay pipe reading sock, held until close."""
+        if sock not in self.buffers:
+            self.buffers[sock] = Proxy.buffer_pool.acquire()
+        return self.buffers[sock]
+
+    def release_buffers(self):
+        for buf in self.buffers.values():
+            Proxy.buffer_pool.release(buf)
+        self.buffers = dict()
+
+    def recv(self, sock):
+        return sock.recv(Proxy.buffer_pool.size)
 
     def recv_from_server(self):
         try:
-            data = self.server.recv(MAX_RECV_BYTES)
+            data = self.recv(self.server)
             if len(data) == 0: return None
-            self.last_activity = Tunnel.now()
+            self.last_active = Proxy.idle_reaper.ticks
+            server_bytes_received.inc(len(data))
             return data
         except Exception, e: # pragma: no cover
-            log("unexpected exception while receiving from server socket %r" % e)
+            proxy_log.warning("unexpected exception while receiving from server socket %r", e)
             return None
 
     def recv_from_client(self):
         try:
-            data = self.client.recv(MAX_RECV_BYTES)
+            data = self.recv(self.client)
             if len(data) == 0: return None
-            self.last_activity = Tunnel.now()
+            self.last_active = Proxy.idle_reaper.ticks
+            self.bytes_in += len(data)
+            client_bytes_received.inc(len(data))
             return data
         except Exception, e: # pragma: no cover
-            log("unexpected exception while receiving from client socket %r" % e)
+            proxy_log.warning("unexpected exception while receiving from client socket %r", e)
             return None
 
+    def send_to_client(self, data):
+        if self.flow: return Proxy.scheduler.send(self.flow, self.client, data)
+        return self.client.send(data)
+
     def flush_client_buffer(self):
-        sent = self.client.send(self.buffer['client'])
+        sent = self.send_to_client(self.buffer['client'])
         self.buffer['client'] = self.buffer['client'][sent:]
+        self.bytes_out += sent
+        client_bytes_sent.inc(sent)
 
     def flush_server_buffer(self):
-        sent = self.server.send(self.buffer['server'])
-        self.buffer['server'] = self.buffer['server'][sent:]
+        sent = self.buffer['server'].send(self.server)
+        server_bytes_sent.inc(sent)
 
     def close(self):
         self.log()
+        if Proxy.access_log and not self.closed and Proxy.access_log.sample():
+            Proxy.access_log.write(self.access_record())
         if not self.closed:
             if self.server: self.server.close()
             self.server = None
             self.closed = True
+        if self.poller: self.poller.close()
+        self.poller = None
+        Proxy.idle_reaper.discard(self)
+        self.release_buffers()
         self.client.close()
 
     def inactive_for(self):
-        return (Tunnel.now() - self.last_activity).seconds
+        return Proxy.idle_reaper.idle_for(self)
 
     def is_inactive(self):
-        return self.inactive_for() > MAX_INACTIVITY/1000
+        return self.reaped
+
+    def reap(self):
+        """called by the idle reaper, wakes the proxy loop which then exits"""
+        self.reaped = True
+        server = self.server
+        if server:
+            try: server.shutdown(socket.SHUT_RDWR)
+            except socket.error: pass
+
+    def relay(self):
+        """byte pump for CONNECT tunnels once the connection is established."""
+        up, down = self.pipe(self.client, self.server), self.pipe(self.server, self.client)
+        while True:
+            events = {self.client: 0, self.server: 0}
+            for pipe in (up, down):
+                if pipe.pending(): events[pipe.dst] |= POLL_WRITE
+                else: events[pipe.src] |= POLL_READ
+            for sock in events: self.poller.watch(sock, events[sock])
+            ready = dict(self.poller.poll(self.poll_timeout(self.client if down.pending() else None)))
+
+            if up.pending() and self.writable(self.server, ready):
+                server_bytes_sent.inc(up.drain())
+            if down.pending() and self.writable(self.client, ready):
+                sent = down.drain()
+                self.bytes_out += sent
+                client_bytes_sent.inc(sent)
+
+            if not up.pending() and ready.get(self.client, 0) & POLL_READ:
+                n = self.relay_fill(up)
+                if not n: break
+                self.bytes_in += n
+                client_bytes_received.inc(n)
+            if not down.pending() and ready.get(self.server, 0) & POLL_READ:
+                n = self.relay_fill(down)
+                if not n: break
+                server_bytes_received.inc(n)
+
+            if self.is_inactive(): break
+
+    def pipe(self, src, dst):
+        buf = self.recv_buffer(src) if hasattr(src, 'recv_into') else None
+        return Pipe(src, dst, Proxy.buffer_pool.size, buf, self.send_to_client if dst is self.client else None)
+
+    def relay_fill(self, pipe):
+        try:
+            n = pipe.fill()
+        except Exception, e: # pragma: no cover
+            proxy_log.warning("unexpected exception while relaying %r", e)
+            return 0
+        if n: self.last_active = Proxy.idle_reaper.ticks
+        return n
+
+    def writable(self, sock, ready):
+        """paramiko channels poll readable through a pipe but never writable, ask them instead"""
+        if hasattr(sock, 'send_ready'): return sock.send_ready()
+        return bool(ready.get(sock, 0) & POLL_WRITE)
+
+    def poll_timeout(self, sending):
+        """seconds to wait for events, short while a channel has bytes waiting to be sent"""
+        if sending is not None and hasattr(sending, 'send_ready'):
+            return SEND_READY_INTERVAL/1000.0
+        return SELECT_TIMEOUT/1000.0
 
     def process(self):
+        self.poller = poller()
         while True:
-            rlist, wlist, xlist = [self.client], [], []
-            if len(self.buffer['client']) > 0: wlist.append(self.client)
-            if self.server: rlist.append(self.server)
-            if self.server and len(self.buffer['server']) > 0: wlist.append(self.server)
-            r, w, x = select.select(rlist, wlist, xlist, SELECT_TIMEOUT/1000)
-
-            if self.client in w:
+            if self.request.method == "CONNECT" and self.server and \
+            len(self.buffer['client']) == 0 and len(self.buffer['server']) == 0:
+                return self.relay()
+
+            # stop reading from the client while upstream is slow to take what was read
+            reading = POLL_READ if len(self.buffer['server']) < Proxy.buffer_pool.size else 0
+            self.poller.watch(self.client, reading | (POLL_WRITE if self.buffer['client'] else 0))
+            if self.server and not self.upstream_closed:
+                self.poller.watch(self.server, POLL_READ | (POLL_WRITE if self.buffer['server'] else 0))
+            ready = dict(self.poller.poll(self.poll_timeout(self.client if self.buffer['client'] else None)))
+
+            if len(self.buffer['client']) > 0 and self.writable(self.client, ready):
                 self.flush_client_buffer()
 
-            if self.server and self.server in w:
+            if self.server and len(self.buffer['server']) > 0 and self.writable(self.server, ready):
                 self.flush_server_buffer()
 
-            if self.client in r:
+            if ready.get(self.client, 0) & POLL_READ:
                 data = self.recv_from_client()
                 if not data: break
                 self.process_request(data)
 
-            if self.server in r:
+            if self.server and ready.get(self.server, 0) & POLL_READ:
                 data = self.recv_from_server()
-                if not data: break
-                self.process_response(data)
+                if data: self.process_response(data)
+                else: self.close_upstream()
 
             # TODO: if we don't recv initial packet from client within a short timeout ~5sec, terminate
             # TODO: make sure client doesn't go in a loop of establishing a connection in advance
             if len(self.buffer['client']) == 0:
                 if self.response.state == HTTP_PARSER_STATE_COMPLETE: break
+                if self.upstream_closed: break
                 if self.closed: break
                 if self.is_inactive(): break
 
+    def close_upstream(self):
+        """upstream closed, what is buffered for the client is still delivered"""
+        self.upstream_closed = True
+        self.poller.unregister(self.server)
+        if not self.request.method == "CONNECT":
+            self.response.eof()
+            if self.response.state == HTTP_PARSER_STATE_COMPLETE:
+                if self.gzip: self.buffer['client'] += self.encode('')
+                self.store_response()
+
     def run(self):
+        proxy_threads.inc()
+        Proxy.idle_reaper.add(self)
         try:
             self.process()
-        except ProxyConnectFailed, e:
+        except ProxyConnectTimeout, e:
+            self.gateway_timeout(e)
+        except (ProxyConnectFailed, ProxyRevalidationFailed), e:
             self.bad_gateway(e)
         except Exception, e:
             self.bad_gateway(e)
         finally:
             self.close()
+            proxy_threads.dec()
 
     def bad_gateway(self, e):
-        log(e, logging.ERROR)
-        log(self.request.raw)
-        self.client.send("HTTP/1.1 502 Bad Gateway%s%r%s%s" % (CRLF, e, CRLF, CRLF))
+        bad_gateways.inc()
+        self.error_response(e, 502, 'Bad Gateway')
+
+    def gateway_timeout(self, e):
+        gateway_timeouts.inc()
+        self.error_response(e, 504, 'Gateway Timeout')
+
+    def error_response(self, e, code, reason):
+        self.error = e
+        self.error_code = code
+        proxy_log.error("%r", e)
+        proxy_log.debug("%s", self.request.raw)
+        self.client.send("HTTP/1.1 %d %s%s%r%s%s" % (code, reason, CRLF, e, CRLF, CRLF))
+
+class SshOptions(object):
+    """ssh transport tuning, applied before key exchange.
+
+    window_size and max_packet_size are used for every channel the remote
+    end opens, ciphers and macs are preference ordered lists of paramiko
+    algorithm names, e.g. ['aes128-ctr', 'aes256-ctr'].
+    """
+
+    def __init__(self, window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE,
+                 ciphers=None, macs=None, compress=False):
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.ciphers = ciphers
+        self.macs = macs
+        self.compress = compress
+
+    def __repr__(self):
+        return 'window=%s packet=%s ciphers=%s macs=%s compress=%s' % (
+            self.window_size or 'default', self.max_packet_size or 'default',
+            ','.join(self.ciphers) if self.ciphers else 'default',
+            ','.join(self.macs) if self.macs else 'default', 'on' if self.compress else 'off')
+
+    def apply(self, transport):
+        """raises ValueError for algorithms paramiko does not know"""
+        if self.window_size: transport.window_size = self.window_size
+        if self.max_packet_size: transport.max_packet_size = self.max_packet_size
+        security = transport.get_security_options()
+        if self.ciphers: security.ciphers = self.ciphers
+        if self.macs: security.digests = self.macs
+        transport.use_compression(self.compress)
+
+    def validate(self):
+        for kind, names, known in (('cipher', self.ciphers, paramiko.Transport._cipher_info),
+                                   ('mac', self.macs, paramiko.Transport._mac_info)):
+            unknown = [name for name in names or [] if name not in known]
+            if unknown:
+                raise ValueError('unsupported ssh %s %s, expected one of %s' % (kind, ', '.join(unknown), ', '.join(sorted(known))))
+
+    @staticmethod
+    def algorithms(value):
+        """comma separated algorithm list as passed to --ssh-ciphers and --ssh-macs"""
+        return [name.strip() for name in value.split(',') if name.strip()] if value else None
+
+class SshTransport(object):
+    """one ssh connection into Appurify infrastructure with the proxy port forwarded over it"""
+
+    options = SshOptions()  # see Tunnel.cli --ssh-window-size etc.
+    known_hosts = os.path.expanduser('~/.ssh/known_hosts')
+
+    def __init__(self, config, index=0):
+        self.config = config
+        self.index = index
+        self.transport = None
+        self.channels = 0
+        self.error = None
+
+    def __repr__(self):
+        return '<SshTransport #%d %s:%s>' % (self.index, self.config['ssh_host'], self.config['ssh_port'])
+
+    def connect(self):
+        # paramiko.SSHClient negotiates as soon as it creates the transport,
+        # leaving no chance to apply options, so its steps are done here
+        host, port = self.config['ssh_host'], self.config['ssh_port']
+        sock = socket.create_connection((host, port), SOCKET_TIMEOUT/1000)
+        self.transport = paramiko.Transport(sock)
+        SshTransport.options.apply(self.transport)
+        self.transport.start_client()
+        self.check_host_key(host, port)
+        self.transport.auth_publickey(self.config['ssh_user'], self.config['pkey'])
+        self.transport.set_keepalive(HEALTH_CHECK_INTERVAL/1000)
+
+    def check_host_key(self, host, port):
+        """same policy as SSHClient with system host keys and WarningPolicy, skipped without known_hosts"""
+        if not SshTransport.known_hosts: return
+        host_keys = paramiko.HostKeys()
+        if os.path.exists(SshTransport.known_hosts):
+            host_keys.load(SshTransport.known_hosts)
+        name = host if port == SSH_PORT else '[%s]:%d' % (host, port)
+        key = self.transport.get_remote_server_key()
+        known = host_keys.get(name, {}).get(key.get_name())
+        if known is None:
+            warnings.warn('Unknown %s host key for %s: %s' % (key.get_name(), name, key.get_fingerprint().encode('hex')))
+        elif known != key:
+            raise paramiko.BadHostKeyException(host, key, known)
+
+    def forward(self):
+        self.transport.request_port_forward('', self.config['proxy_port'])
+
+    def accept(self):
+        """next channel opened by the remote end, None on timeout, raises transport errors"""
+        chan = self.transport.accept(timeout=ACCEPT_TIMEOUT/1000)
+        e = self.transport.get_exception()
+        if e: raise e
+        if chan: self.channels += 1
+        return chan
+
+    def is_alive(self):
+        return self.error is None and self.transport is not None and self.transport.is_active()
+
+    def close(self):
+        if self.transport:
+            try: self.transport.close()
+            except Exception: pass
+
+class TransportInactive(Exception):
+    """transport went inactive without an error of its own, failed over unlike EOFError"""
+    pass
+
+class TransportPool(object):
+    """ssh transports sharing the reserved proxy port.
+
+    Every transport requests the same remote forward and runs its own
+    accept thread, so channels are spread by the remote end across all
+    transports that got the forward. The first transport must come up,
+    extra ones that fail to connect or forward are dropped. wait() health
+    checks transports whenever an accept thread exits and at least every
+    HEALTH_CHECK_INTERVAL, removes dead ones and raises the last transport
+    error once none are left.
+    """
+
+    def __init__(self, config, size=SSH_TRANSPORTS, factory=SshTransport):
+        self.config = config
+        self.size = size
+        self.factory = factory
+        self.transports = []
+        self.lock = threading.Lock()
+        self.error = None
+        self.died = threading.Event()   # set by accept threads exiting, wakes wait()
+
+    def start(self, standby=None):
+        """standby is an already connected transport used in place of the first one"""
+        for i in range(self.size):
+            transport = standby if standby and i == 0 else self.factory(self.config, i)
+            try:
+                if transport is not standby: transport.connect()
+                transport.forward()
+            except Exception, e:
+                transport.close()
+                if i == 0: raise
+                log('Dropping ssh transport #%d with reason %r ...' % (i, e))
+                continue
+            self.add(transport)
+
+    def add(self, transport):
+        with self.lock:
+            self.transports.append(transport)
+            ssh_transports.set(len(self.transports))
+        thr = threading.Thread(target=self.accept_loop, args=(transport,), name='accept-%d' % transport.index)
+        thr.setDaemon(True)
+        thr.start()
+
+    def accept_loop(self, transport):
+        try:
+            while transport.is_alive():
+                chan = transport.accept()
+                if chan is None: continue
+                channels_accepted.inc()
+                Proxy.worker_pool.submit(chan)
+        except Exception, e:
+            transport.error = e
+        finally:
+            self.died.set()
+
+    def check(self):
+        """removes dead transports, returns number of healthy ones"""
+        with self.lock:
+            for transport in list(self.transports):
+                if transport.is_alive(): continue
+                self.error = transport.error if transport.error else TransportInactive('%r is no longer active' % transport)
+                log('Removing ssh transport #%d with reason %r ...' % (transport.index, self.error))
+                transport.close()
+                self.transports.remove(transport)
+                ssh_transports_removed.inc()
+            ssh_transports.set(len(self.transports))
+            return len(self.transports)
+
+    def wait(self):
+        while True:
+            self.died.clear()
+            if not self.check(): break
+            self.died.wait(HEALTH_CHECK_INTERVAL/1000.0)
+        raise self.error if self.error else EOFError('ssh transports closed')
+
+    def close(self):
+        with self.lock:
+            for transport in self.transports:
+                transport.close()
+            self.transports = []
+            ssh_transports.set(0)
+        self.died.set()
+
+class Supervisor(object):
+    """keeps the reserved proxy port forwarded across ssh transport failures.
+
+    Once the tunnel is up, a standby SshTransport is connected and
+    authenticated in the background, without the forward. When the
+    active pool loses its last transport the standby requests the forward
+    right away and takes over, then a new standby is prepared. Failed
+    attempts back off exponentially from RECONNECT_BACKOFF_MIN to
+    RECONNECT_BACKOFF_MAX, run() gives up after MAX_RETRIES consecutive
+    failures. EOFError, the remote end closing the session, is not failed
+    over and ends run() as before.
+    """
+
+    def __init__(self, config, size=SSH_TRANSPORTS, factory=SshTransport):
+        self.config = config
+        self.size = size
+        self.factory = factory
+        self.pool = None
+        self.standby = None
+        self.standby_thread = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = True
+
+    @staticmethod
+    def backoff(failures):
+        """milliseconds to wait after these many consecutive failures"""
+        return min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_MIN * 2 ** (failures - 1))
+
+    def run(self):
+        failures = 0
+        while self.running:
+            pool = TransportPool(self.config, self.size, self.factory)
+            try:
+                pool.start(self.take_standby())
+            except Exception, e:
+                pool.close()
+                failures += 1
+                if not self.pool or failures > MAX_RETRIES: raise
+                delay = Supervisor.backoff(failures)
+                log('Failed to re-establish tunnel with reason %r, retrying in %.1f secs (%d/%d) ...' % (e, delay/1000.0, failures, MAX_RETRIES))
+                self.wakeup.wait(delay/1000.0)
+                continue
+
+            log('Tunnel %s successfully over %d ssh transport(s) ...' % ('re-established' if self.pool else 'established', len(pool.transports)))
+            failures = 0
+            self.pool = pool
+            self.start_standby()
+            try:
+                pool.wait()
+            except Exception, e:
+                if not self.running: return
+                if isinstance(e, EOFError): raise
+                tunnel_restarts.inc()
+                log('Tunnel transport failed with reason %r, failing over ...' % e)
+            finally:
+                pool.close()
+
+    def take_standby(self):
+        with self.lock:
+            standby, self.standby = self.standby, None
+            ssh_standby.set(0)
+        if standby and not standby.is_alive():
+            standby.close()
+            standby = None
+        return standby
+
+    def start_standby(self):
+        if self.standby_thread and self.standby_thread.isAlive(): return
+        self.standby_thread = threading.Thread(target=self.standby_loop, name='standby')
+        self.standby_thread.setDaemon(True)
+        self.standby_thread.start()
+
+    def standby_loop(self):
+        failures = 0
+        while self.running:
+            with self.lock:
+                ready = self.standby is not None and self.standby.is_alive()
+            if not ready:
+                transport = self.factory(self.config, 0)
+                try:
+                    transport.connect()
+                except Exception, e:
+                    transport.close()
+                    failures += 1
+                    proxy_log.warning("standby ssh transport failed to connect %r", e)
+                    self.wakeup.wait(Supervisor.backoff(failures)/1000.0)
+                    continue
+                failures = 0
+                with self.lock:
+                    previous, self.standby = self.standby, transport
+                    ssh_standby.set(1)
+                if previous: previous.close()
+            self.wakeup.wait(HEALTH_CHECK_INTERVAL/1000.0)
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        with self.lock:
+            if self.standby: self.standby.close()
+            self.standby = None
+            ssh_standby.set(0)
+        if self.pool: self.pool.close()
 
 class Tunnel(object):
 
     pidfile = None
     daemon = False
+    access_log = None
+    metrics_port = None
+    metrics_interval = None
+    ssh_transports = SSH_TRANSPORTS
+    supervisor = None
     credentials = None
     config = None
-    restart = False
-    retry = 0
-
-    @staticmethod
-    def now():
-        return datetime.datetime.utcnow()
+    processes = 1
+    workers = None
+    log_listener = None
 
     @staticmethod
     def start():
-        Tunnel.retry += 1
+        """runs the tunnel until it stops, returns exit code"""
         socket.setdefaulttimeout(SOCKET_TIMEOUT/1000)
-
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.WarningPolicy())
+        Tunnel.supervisor = Supervisor(Tunnel.config, Tunnel.ssh_transports)
         log('Establishing tunnel into Appurify infrastructure ...')
 
         try:
-            client.connect(
-                Tunnel.config['ssh_host'],
-                port=Tunnel.config['ssh_port'],
-                username=Tunnel.config['ssh_user'],
-                pkey=Tunnel.config['pkey']
-            )
-        except Exception, e:
-            log('Failed to ssh into %s:%d with reason %r ...' % (Tunnel.config['ssh_host'], Tunnel.config['ssh_port'], e))
-            Tunnel.unreserve_proxy_port()
-            sys.exit(1)
-
-        try:
-            transport = client.get_transport()
-            transport.request_port_forward('', Tunnel.config['proxy_port'])
-            log('Tunnel established successfully ...')
-            while True:
-                chan = transport.accept(timeout=ACCEPT_TIMEOUT)
-                e = transport.get_exception()
-                if e: raise e
-                if chan is None: continue
-                thr = Proxy(chan)
-                thr.setDaemon(True)
-                thr.start()
+            Tunnel.supervisor.run()
         except KeyboardInterrupt, e:
             log('Stopping Tunnel with reason %r ...' % e)
         except EOFError, e:
             log('Tunnel terminated due to inactivity or because another instance was started (%r) ...' % e)
-        except OSError, e:
-            log('Underlying OS error, will try to restart tunnel (%r) ...' % e)
-            Tunnel.restart = True
         except Exception, e:
-            log("Unexpected error, will try to restart tunnel %r ..." % e)
-            Tunnel.restart = True
+            if not Tunnel.supervisor.pool:
+                log('Failed to ssh into %s:%d with reason %r ...' % (Tunnel.config['ssh_host'], Tunnel.config['ssh_port'], e))
+            else:
+                log('Giving up on tunnel after %d attempts with reason %r ...' % (MAX_RETRIES + 1, e))
+            return 1
+        return 0
 
     @staticmethod
-    def stop():
-        # TODO: better to start a new child proc while letting this parent die
-        if Tunnel.restart and Tunnel.retry < MAX_RETRIES:
-            try: client.close()
-            except: pass
-            log("Restarting %sth tunnel instance ..." % Tunnel.retry)
-            Tunnel.restart = False
-            Tunnel.start()
-        else:
-            log("Unreserving tunnel resource ...")
-            Tunnel.unreserve_proxy_port()
-            Tunnel.credentials, Tunnel.config, Tunnel.restart, Tunnel.retry = None, None, False, 0
-            log("Shutting down tunnel, start again if required ...")
-            sys.exit(0)
+    def stop(code=0):
+        if Tunnel.supervisor:
+            Tunnel.supervisor.close()
+        if Tunnel.workers:
+            Tunnel.workers.close()
+        log("Unreserving tunnel resource ...")
+        Tunnel.unreserve_proxy_port()
+        Tunnel.credentials, Tunnel.config, Tunnel.supervisor = None, None, None
+        log("Shutting down tunnel, start again if required ...")
+        sys.exit(code)
 
     @staticmethod
     def rsa_to_pkey(rsa):
@@ -458,7 +1431,7 @@ class Tunnel(object):
         try:
             r = post("tunnel/reserve", Tunnel.credentials)
             if r.status_code == 200:
-                return r.json()['response']
+                return response_json(r)['response']
             else:
                 log('Tunnel setup failed with reason %s ...' % r.text)
                 return False
@@ -558,6 +1531,28 @@ class Tunnel(object):
     def run():
         if Tunnel.daemon:
             Tunnel.daemonize()
+        Tunnel.log_listener = start_async_logging()
+
+        if Tunnel.access_log:
+            Tunnel.access_log.start()
+            atexit.register(Tunnel.access_log.stop)
+            Proxy.access_log = Tunnel.access_log
+
+        if Tunnel.processes > 1:
+            # the zygote forking workers is forked before transport threads start
+            from .workers import Workers
+            Tunnel.workers = Workers(Tunnel.processes, Tunnel.log_listener)
+            Tunnel.workers.start()
+            log("Started %d worker processes ..." % Tunnel.processes)
+            if Proxy.scheduler:
+                log("--fair-share only schedules connections proxied in the tunnel process, it is ignored with --processes ...")
+
+        if Tunnel.metrics_port:
+            server = MetricsServer(Tunnel.metrics_port)
+            server.start()
+            log("Serving tunnel metrics on http://127.0.0.1:%s/metrics ..." % server.port)
+        if Tunnel.metrics_interval:
+            MetricsReporter(Tunnel.metrics_interval * 1000).start()
 
         atexit.register(Tunnel.delete_pid_file)
         Tunnel.write_pid_file()
@@ -572,8 +1567,7 @@ class Tunnel(object):
         config['proxy_port'] = int(config['proxy_port'])
 
         Tunnel.config = config
-        Tunnel.start()
-        Tunnel.stop()
+        Tunnel.stop(Tunnel.start())
 
     @staticmethod
     def terminate(pid, pidfile):
@@ -615,11 +1609,58 @@ class Tunnel(object):
         parser.add_argument('--daemon', action='store_true', help='Run in background (supported only on *nix systems)')
         parser.add_argument('--pid', help='Tunnel session pid to terminate')
         parser.add_argument('--terminate', action='store_true', help='Terminate process identified by --pid-file or --pid and shutdown')
+        parser.add_argument('--access-log', help='Write a JSON line per proxied request to this file (rotated by size)')
+        parser.add_argument('--access-log-sample-rate', type=float, default=1.0, help='Fraction of proxied requests to record in access log (default: 1.0)')
+        parser.add_argument('--access-log-max-bytes', type=int, default=ACCESS_LOG_MAX_BYTES, help='Rotate access log after it grows beyond these many bytes')
+        parser.add_argument('--access-log-backups', type=int, default=ACCESS_LOG_BACKUPS, help='Number of rotated access log files to keep')
+        parser.add_argument('--metrics-port', type=int, help='Serve tunnel metrics in prometheus text format on 127.0.0.1:port/metrics')
+        parser.add_argument('--metrics-interval', type=int, default=0, help='Log a summary of tunnel metrics every these many seconds (default: disabled)')
+        parser.add_argument('--recv-buffer-bytes', type=int, default=MAX_RECV_BYTES, help='Read size for proxied sockets, CONNECT relays read into pooled buffers of this size (default: %d)' % MAX_RECV_BYTES)
+        parser.add_argument('--dns-cache-ttl', type=int, default=DNS_CACHE_TTL/1000, help='Seconds to cache resolved upstream names (default: %d)' % (DNS_CACHE_TTL/1000))
+        parser.add_argument('--dns-negative-ttl', type=int, default=DNS_NEGATIVE_TTL/1000, help='Seconds to cache failed upstream name lookups (default: %d)' % (DNS_NEGATIVE_TTL/1000))
+        parser.add_argument('--dns-resolver-threads', type=int, default=DNS_RESOLVER_THREADS, help='Threads refreshing cached names ahead of expiry, 0 to disable (default: %d)' % DNS_RESOLVER_THREADS)
+        parser.add_argument('--connect-timeout', type=int, default=CONNECT_TIMEOUT, help='Milliseconds to wait for upstream connects before answering 504 (default: %d)' % CONNECT_TIMEOUT)
+        parser.add_argument('--host-connect-timeout', action='append', default=[], metavar='HOST=MS', help='Connect timeout in milliseconds for hosts matching a glob like *.example.com, can be repeated')
+        parser.add_argument('--ssh-transports', type=int, default=SSH_TRANSPORTS, help='Parallel ssh transports forwarding the proxy port, needs a server accepting shared forwards (default: %d)' % SSH_TRANSPORTS)
+        parser.add_argument('--ssh-window-size', type=int, default=SSH_WINDOW_SIZE, help='Window size in bytes for tunnel channels (default: paramiko default)')
+        parser.add_argument('--ssh-max-packet-size', type=int, default=SSH_MAX_PACKET_SIZE, help='Max packet size in bytes for tunnel channels (default: paramiko default)')
+        parser.add_argument('--ssh-ciphers', help='Comma separated ciphers in order of preference, e.g. aes128-ctr,aes256-ctr')
+        parser.add_argument('--ssh-macs', help='Comma separated MACs in order of preference, e.g. hmac-sha1,hmac-md5')
+        parser.add_argument('--ssh-compression', action='store_true', help='Compress ssh transport, helps slow links with compressible traffic')
+        parser.add_argument('--self-benchmark', action='store_true', help='Measure throughput of ssh options through a local ssh stand-in and exit')
+        parser.add_argument('--proxy-workers', type=int, default=PROXY_WORKERS, help='Max concurrently proxied connections (default: %d)' % PROXY_WORKERS)
+        parser.add_argument('--proxy-queue-size', type=int, default=PROXY_QUEUE_SIZE, help='Connections waiting for a proxy worker before answering 503 (default: %d)' % PROXY_QUEUE_SIZE)
+        parser.add_argument('--proxy-queue-timeout', type=int, default=PROXY_QUEUE_TIMEOUT, help='Milliseconds a connection may wait for a proxy worker before answering 503 (default: %d)' % PROXY_QUEUE_TIMEOUT)
+        parser.add_argument('--fair-share', action='store_true', help='Share the ssh transport between connections deficit round robin, short responses first')
+        parser.add_argument('--fair-share-quantum', type=int, default=SCHEDULER_QUANTUM, help='Bytes a connection may send per turn with --fair-share (default: %d)' % SCHEDULER_QUANTUM)
+        parser.add_argument('--connection-rate-limit', type=int, help='Cap sends to each device at these many KB/s, implies --fair-share')
+        parser.add_argument('--buffer-request-bodies', action='store_true', help='Receive whole request bodies before connecting upstream (default: connect after headers and stream bodies)')
+        parser.add_argument('--http-cache', metavar='DIR', help='Cache GET responses in this directory and serve them while fresh, revalidating stale ones')
+        parser.add_argument('--http-cache-max-mb', type=int, default=HTTP_CACHE_MAX_BYTES/(1024*1024), help='Size cap of --http-cache in MB, least recently used responses are removed (default: %d)' % (HTTP_CACHE_MAX_BYTES/(1024*1024)))
+        parser.add_argument('--gzip', action='store_true', help='Gzip encode uncompressed text responses for clients accepting it, saves tunnel bandwidth')
+        parser.add_argument('--gzip-types', help='Comma separated content types to encode with --gzip (default: %s)' % ','.join(GZIP_TYPES))
+        parser.add_argument('--gzip-min-bytes', type=int, default=GZIP_MIN_BYTES, help='Leave responses declaring a smaller Content-Length alone (default: %d)' % GZIP_MIN_BYTES)
+        parser.add_argument('--processes', type=int, default=1, help='Proxy in these many worker processes to use more than one core, not on windows (default: 1, proxy in the tunnel process)')
+        parser.add_argument('--idle-timeout', type=int, default=MAX_INACTIVITY/1000, help='Close proxied connections without traffic for these many seconds (default: %d)' % (MAX_INACTIVITY/1000))
+        parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='Log level, use INFO to log every proxied request (default: WARNING)')
         args = parser.parse_args()
+        logging.getLogger().setLevel(getattr(logging, args.log_level))
     
         if args.terminate:
             Tunnel.terminate(args.pid, args.pid_file)
             sys.exit(0)
+
+        SshTransport.options = SshOptions(args.ssh_window_size, args.ssh_max_packet_size,
+                                          SshOptions.algorithms(args.ssh_ciphers), SshOptions.algorithms(args.ssh_macs),
+                                          args.ssh_compression)
+        try:
+            SshTransport.options.validate()
+        except ValueError, e:
+            parser.error(str(e))
+
+        if args.self_benchmark:
+            from . import sshbench
+            sys.exit(0 if sshbench.main(SshTransport.options) else 1)
     
         if (args.api_key == None or args.api_secret == None) and \
         (args.username == None or args.password == None):
@@ -627,6 +1668,35 @@ class Tunnel(object):
     
         Tunnel.pidfile = args.pid_file
         Tunnel.daemon = args.daemon
+        Tunnel.metrics_port = args.metrics_port
+        Tunnel.metrics_interval = args.metrics_interval
+        Tunnel.ssh_transports = max(args.ssh_transports, 1)
+        Tunnel.processes = max(args.processes, 1)
+        if Tunnel.processes > 1 and sys.platform == 'win32':
+            parser.error('--processes needs fork, not available on windows')
+        Proxy.worker_pool = WorkerPool(max(args.proxy_workers, 1), max(args.proxy_queue_size, 1), args.proxy_queue_timeout)
+        Proxy.stream_request_bodies = not args.buffer_request_bodies
+        if args.fair_share or args.connection_rate_limit:
+            rate = args.connection_rate_limit * 1024 if args.connection_rate_limit else None
+            Proxy.scheduler = FairScheduler(max(args.fair_share_quantum, 1), rate=rate)
+        Proxy.idle_reaper = IdleReaper(max(args.idle_timeout, 1) * 1000, registry=registry)
+        if args.gzip or args.gzip_types:
+            Proxy.gzip_types = tuple(t.strip().lower() for t in args.gzip_types.split(',')) if args.gzip_types else GZIP_TYPES
+            Proxy.gzip_min_bytes = args.gzip_min_bytes
+        if args.http_cache:
+            Proxy.http_cache = HttpCache(os.path.abspath(args.http_cache), max(args.http_cache_max_mb, 1) * 1024 * 1024)
+        if args.recv_buffer_bytes != Proxy.buffer_pool.size:
+            Proxy.buffer_pool = BufferPool(args.recv_buffer_bytes, registry=registry)
+        try:
+            rules = [ConnectTimeouts.parse_rule(spec) for spec in args.host_connect_timeout]
+        except ValueError, e:
+            parser.error('--host-connect-timeout %s' % e)
+        Proxy.connect_timeouts = ConnectTimeouts(args.connect_timeout, rules)
+        Proxy.resolver = DnsCache(args.dns_cache_ttl * 1000, args.dns_negative_ttl * 1000,
+                                  pool=ResolverPool(args.dns_resolver_threads) if args.dns_resolver_threads else None)
+        if args.access_log:
+            Tunnel.access_log = AccessLog(os.path.abspath(args.access_log), args.access_log_sample_rate,
+                                          args.access_log_max_bytes, args.access_log_backups)
         Tunnel.credentials = dict()
     
         if args.api_key and args.api_secret:
@@ -15,14 +15,149 @@ import math
 import platform
 import requests
 import logging
+import threading
+import atexit
+import Queue
 
 from . import constants
+from .tracing import tracer
 
-logging.basicConfig(level=logging.WARNING, format='[%(asctime)s] [%(process)d] %(message)s')
+LOG_FORMAT = '[%(asctime)s] [%(process)d] %(message)s'
+LOG_QUEUE_SIZE = 10000  # records buffered for the async log thread before new ones are dropped
 
-def log(msg, level=None): # pragma: no cover
-    """simple logging facility"""
-    logging.log(level if level else logging.WARNING, msg)
+logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+
+def log(msg, *args, **kwargs):
+    """simple logging facility, args are only interpolated into msg if the record is emitted.
+
+    level is passed as keyword, WARNING if not given.
+    """
+    logging.log(kwargs.get('level', logging.WARNING), msg, *args)
+
+def get_logger(name):
+    """returns logger for an appurify subsystem e.g. http, tunnel.proxy, client.poll"""
+    return logging.getLogger('appurify.%s' % name)
+
+http_log = get_logger('http')
+
+def monotonic():
+    """seconds since an arbitrary point, unaffected by wall clock changes.
+
+    python 2 has no time.monotonic, on posix the elapsed time of os.times()
+    comes from times(2) (clock ticks, usually 10ms). Elsewhere it is always
+    0 so time.time() is used. A syscall, keep it out of per read paths.
+    """
+    if os.name == 'posix': return os.times()[4]
+    return time.time()
+
+RUSAGE_THREAD = 1  # linux, the python 2 resource module does not name it
+
+try:
+    import resource
+    resource.getrusage(RUSAGE_THREAD)
+except Exception:
+    resource = None  # no resource module on windows, no per thread usage outside linux
+
+def thread_time():
+    """cpu seconds used by the calling thread.
+
+    python 2 has no time.thread_time, linux reports per thread usage through
+    getrusage(RUSAGE_THREAD). Elsewhere the wall clock is the best there is.
+    """
+    if resource:
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return time.time()
+
+class QueueHandler(logging.Handler):
+    """hands records over to a QueueListener thread, never blocks the caller.
+
+    Records are dropped (and counted) when the queue is full.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # interpolate now, args may be mutated by the calling thread later on
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception: # pragma: no cover
+            self.handleError(record)
+
+class QueueListener(threading.Thread):
+    """drains a queue of log records into the given handlers."""
+
+    def __init__(self, queue, handlers):
+        super(QueueListener, self).__init__()
+        self.setDaemon(True)
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self, timeout=1):
+        try:
+            self.queue.put_nowait(None)
+        except Queue.Full: # pragma: no cover
+            return
+        self.join(timeout)
+
+def start_async_logging(maxsize=LOG_QUEUE_SIZE, logger=None):
+    """moves handlers of logger (default: root) behind a queue drained by a background thread.
+
+    Returns the QueueListener, which is stopped (and flushed) at exit.
+    """
+    logger = logger if logger else logging.getLogger()
+    queue = Queue.Queue(maxsize)
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(queue))
+
+    listener = QueueListener(queue, handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+def reinit_logging(listener=None):
+    """makes logging usable in a child forked from a threaded process.
+
+    Locks held at fork time by threads that do not exist in the child are
+    replaced. Records of a QueueHandler go to a new queue and are drained by
+    a new thread into the handlers of listener, which returns it.
+    """
+    logging._lock = threading.RLock()
+    loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values() if isinstance(l, logging.Logger)]
+    for logger in loggers:
+        for handler in logger.handlers: handler.createLock()
+    if not listener: return None
+    for handler in listener.handlers: handler.createLock()
+    queue = Queue.Queue(listener.queue.maxsize)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler): handler.queue = queue
+    listener = QueueListener(queue, listener.handlers)
+    listener.start()
+    return listener
 
 class AppurifyHttpClientError(Exception):
     pass
@@ -139,10 +274,10 @@ class AppurifyHttpClient(object):
         while AppurifyHttpClient.api_status() == constants.API_STATUS_DOWN:
             # restrict max sleep to 2^6 ~ 1 min
             delay = int(math.pow(2, n % 7))
-            log('Service is down, will retry in %s seconds...' % delay)
+            http_log.warning('Service is down, will retry in %s seconds...', delay)
             time.sleep(delay)
             n += 1
-        log('API service is back up, resuming...')
+        http_log.warning('API service is back up, resuming...')
         return True
     
     def is_api_response(self, response):
@@ -163,19 +298,34 @@ class AppurifyHttpClient(object):
             kwargs['files'] = self.files
         
         return kwargs
+
+    def upload_bytes(self):
+        """total size of files being uploaded, for tracing."""
+        size = 0
+        for f in (self.files or {}).values():
+            try:
+                size += os.fstat(f.fileno()).st_size
+            except Exception:
+                pass
+        return size
     
     def start(self):
         self.retry_count += 1
-        log("HTTP %s %s" % (self.method_name.upper(), self.url))
+        http_log.warning("HTTP %s %s", self.method_name.upper(), self.url)
         
         try:
-            response = self.method(self.url, **self.kwargs())
+            with tracer.span(self.resource, method=self.method_name.upper(), attempt=self.retry_count) as span:
+                response = self.method(self.url, **self.kwargs())
+                if tracer.enabled:
+                    span.set('status', response.status_code)
+                    span.set('bytes_sent', self.upload_bytes())
+                    span.set('bytes_received', len(getattr(response, 'content', None) or ''))
             if self.is_api_response(response):
                 # received response from api backend
                 return response
             else:
                 # received response from higher up the stack
-                log('Received unexpected response from API, waiting for service to resume...')
+                http_log.warning('Received unexpected response from API, waiting for service to resume...')
                 exc = AppurifyHttpClientError('API failure with response %s, code %s' % (response.text, response.status_code))
                 if os.environ.get('APPURIFY_API_WAIT_FOR_SERVICE', constants.API_WAIT_FOR_SERVICE) == 1:
                     self.wait_for_api_service()
@@ -185,7 +335,7 @@ class AppurifyHttpClient(object):
         except requests.exceptions.ConnectionError as e:
             # either no internet connectivity / dns failures
             # or lb is not responding/down
-            log('Connection to API server failed, waiting for service to resume...')
+            http_log.warning('Connection to API server failed, waiting for service to resume...')
             if os.environ.get('APPURIFY_API_WAIT_FOR_SERVICE', constants.API_WAIT_FOR_SERVICE) == 1:
                 self.wait_for_api_service()
                 return self.retry_or_raise(AppurifyHttpClientError('API failure with reason %s' % str(e)))
@@ -210,7 +360,10 @@ def post(resource, data, files=None): # pragma: no cover
 
 def wget(url, path, verify=True): # pragma: no cover
     """Download a file to specified path"""
-    with open(path, 'wb') as f:
-        result = requests.get(url, verify=verify)
-        f.write(result.content)
+    with tracer.span('download', url=url) as span:
+        with open(path, 'wb') as f:
+            result = requests.get(url, verify=verify)
+            f.write(result.content)
+        span.set('status', result.status_code)
+        span.set('bytes_received', len(result.content))
     return result.status_code
@@ -0,0 +1,589 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Proxying in worker processes, see appurify-tunnel.py --processes.
+
+Proxy threads share one interpreter lock, parsing, header rewriting and
+compression of a busy tunnel saturate a single core. With --processes the
+tunnel process keeps the ssh transports and forks that many workers. For
+every accepted channel it creates a unix socketpair and passes one end to
+the least busy worker with SCM_RIGHTS, along with the channel's origin. The
+worker runs a Proxy on it, as if it was the channel. The tunnel process only
+relays bytes between channels and their sockets, all of them on one
+Switchboard thread.
+
+Workers are forked by a Zygote, a process forked from the tunnel process
+before its transport threads start. It runs no threads of its own, so
+workers it forks later on, in place of ones that exited, do not inherit
+locks that some thread of the tunnel process held at the time.
+
+Workers send what changed in their metrics every WORKER_REPORT_INTERVAL
+ms, the tunnel process adds that to its own registry so /metrics and the
+periodic summary cover all processes. A worker that exits is forked again,
+the gauges it reported are taken back out of the totals.
+
+Python 2 has no socket.sendmsg, descriptors are passed with sendfd and
+recvfd of _multiprocessing (posix only).
+"""
+import os
+import time
+import Queue
+import errno
+import signal
+import logging
+import socket
+import threading
+import traceback
+import collections
+import _multiprocessing
+
+from . import codec
+from .utils import get_logger, reinit_logging
+from .metrics import registry, difference
+from .poller import poller, POLL_READ, POLL_WRITE
+from .resolver import DnsCache, ResolverPool
+from .accesslog import AccessLog
+from .tunnel import Proxy, Pipe, WorkerPool, BufferPool, IdleReaper, SEND_READY_INTERVAL, SELECT_TIMEOUT
+
+WORKER_CHECK_INTERVAL = 1000    # ms between checks for exited workers
+WORKER_REPORT_INTERVAL = 1000   # ms between metric reports of a worker
+WORKER_RESTART_DELAY = 1000     # ms, a worker exiting sooner after start is restarted this much later
+WORKER_STOP_TIMEOUT = 5000
+WORKER_REPORT_MAX_BYTES = 262144
+
+workers_log = get_logger('tunnel.workers')
+
+worker_processes = registry.gauge('tunnel_worker_processes', 'Worker processes running proxies')
+worker_restarts = registry.counter('tunnel_worker_restarts_total', 'Worker processes forked again after exiting')
+worker_handoffs = registry.counter('tunnel_worker_handoffs_total', 'Channels passed to worker processes')
+worker_links = registry.gauge('tunnel_worker_links', 'Channels relayed to worker processes')
+
+def control_socketpair():
+    try:
+        pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    except (AttributeError, socket.error):
+        pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)  # no seqpacket on darwin
+    for sock in pair:
+        sock.setblocking(1)   # sendfd and recvfd use the descriptor, a default timeout would make them fail with EAGAIN
+    return pair
+
+def logging_fds(listener=None):
+    """descriptors of the streams log handlers write to"""
+    handlers = list(logging.getLogger().handlers) + (list(listener.handlers) if listener else [])
+    fds = []
+    for handler in handlers:
+        try:
+            fds.append(handler.stream.fileno())
+        except (AttributeError, ValueError, IOError):
+            pass
+    return fds
+
+def detach_inherited_fds(keep):
+    """points descriptors a forked child inherited at /dev/null.
+
+    Sockets of the parent (transports, other workers, relayed channels)
+    must not be held open by the child. They are replaced rather than
+    closed, objects still referring to them must not close an unrelated
+    descriptor that reuses the number.
+    """
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, min(os.sysconf('SC_OPEN_MAX'), 65536))
+    for fd in fds:
+        if fd > 2 and fd != devnull and fd not in keep:
+            try:
+                os.dup2(devnull, fd)
+            except OSError:
+                pass
+
+class HandedOff(socket.socket):
+    """socket of a channel handed over by the tunnel process"""
+
+    def __init__(self, fd, origin_addr):
+        super(HandedOff, self).__init__(_sock=socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM))
+        self.origin_addr = origin_addr
+
+class Link(object):
+    """a channel and the socket of the worker proxy serving it"""
+
+    def __init__(self, chan, sock, worker, buffers):
+        self.chan = chan
+        self.sock = sock
+        self.worker = worker
+        self.buf = buffers.acquire()
+        self.up = Pipe(chan, sock, buffers.size)
+        self.down = Pipe(sock, chan, buffers.size, self.buf)
+
+class Switchboard(threading.Thread):
+    """relays channels to worker processes, all on one thread.
+
+    Takes the place of Proxy.worker_pool in the tunnel process, accept
+    loops submit() channels to it. Its buffers are not in the registry,
+    tunnel_buffer_pool_* gauges are those of the workers.
+    """
+
+    def __init__(self, workers):
+        super(Switchboard, self).__init__(name='switchboard')
+        self.setDaemon(True)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.incoming = collections.deque()
+        self.links = dict()     # endpoint -> Link
+        self.buffers = BufferPool(Proxy.buffer_pool.size, Proxy.buffer_pool.max_free)
+        self.sending = set()    # links with bytes for a channel, which never polls writable
+        self.poller = poller()
+        self.waker, self.wakeup = socket.socketpair()
+        self.poller.register(self.waker, POLL_READ)
+        self.running = True
+
+    def submit(self, chan):
+        """returns False if chan was rejected"""
+        try:
+            worker, sock = self.workers.handoff(chan)
+        except Exception, e:
+            workers_log.warning("unable to hand off channel %r", e)
+            self.workers.pool.reject(chan)
+            return False
+        with self.lock:
+            self.incoming.append(Link(chan, sock, worker, self.buffers))
+        try:
+            self.wakeup.send('x')
+        except socket.error: # pragma: no cover
+            pass # waker is full, the loop wakes up anyway
+        return True
+
+    def run(self):
+        while self.running:
+            timeout = SEND_READY_INTERVAL if self.sending else SELECT_TIMEOUT
+            ready = collections.defaultdict(dict)
+            for obj, events in self.poller.poll(timeout/1000.0):
+                if obj is self.waker:
+                    self.take_incoming()
+                elif obj in self.links:
+                    ready[self.links[obj]][obj] = events
+            for link in self.sending:
+                ready.setdefault(link, {})
+            for link, events in ready.items():
+                self.service(link, events)
+
+    def take_incoming(self):
+        try:
+            self.waker.recv(4096)
+        except socket.error: # pragma: no cover
+            pass
+        with self.lock:
+            incoming, self.incoming = self.incoming, collections.deque()
+        for link in incoming:
+            self.links[link.chan] = self.links[link.sock] = link
+            worker_links.inc()
+            self.watch(link)
+
+    def writable(self, sock, events):
+        """paramiko channels poll readable through a pipe but never writable, ask them instead"""
+        if hasattr(sock, 'send_ready'): return sock.send_ready()
+        return bool(events.get(sock, 0) & POLL_WRITE)
+
+    def service(self, link, events):
+        try:
+            if link.up.pending() and self.writable(link.sock, events): link.up.drain()
+            if link.down.pending() and self.writable(link.chan, events): link.down.drain()
+            if not link.up.pending() and events.get(link.chan, 0) & POLL_READ:
+                if not link.up.fill(): return self.close(link)
+            if not link.down.pending() and events.get(link.sock, 0) & POLL_READ:
+                if not link.down.fill(): return self.close(link)
+        except Exception, e:
+            workers_log.debug("relay to worker #%d failed %r", link.worker.index, e)
+            return self.close(link)
+        self.watch(link)
+
+    def watch(self, link):
+        events = {link.chan: 0, link.sock: 0}
+        for pipe in (link.up, link.down):
+            if pipe.pending(): events[pipe.dst] |= POLL_WRITE
+            else: events[pipe.src] |= POLL_READ
+        for endpoint in events: self.poller.watch(endpoint, events[endpoint])
+        if link.down.pending() and hasattr(link.chan, 'send_ready'): self.sending.add(link)
+        else: self.sending.discard(link)
+
+    def close(self, link):
+        for endpoint in (link.chan, link.sock):
+            if endpoint in self.poller: self.poller.unregister(endpoint)
+            self.links.pop(endpoint, None)
+            try:
+                endpoint.close()
+            except Exception: # pragma: no cover
+                pass
+        self.sending.discard(link)
+        self.buffers.release(link.buf)
+        self.workers.done(link.worker)
+        worker_links.dec()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.send('x')
+
+class Zygote(object):
+    """single threaded process forking the workers, reports the ones that exit.
+
+    Forked by the tunnel process before it starts transport threads.
+    Workers are its children, their exit statuses come over its control
+    socket as the tunnel process cannot wait for them.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.pid = None
+        self.control = None
+        self.status = None
+        self.reader = None
+        self.lock = threading.Lock()    # one fork at a time
+        self.forked = Queue.Queue()     # (index, pid, control socket) of forked workers, None once the zygote is gone
+        self.exits = dict()             # pid -> wait status of workers that exited
+
+    def start(self, pool, listener):
+        parent, child = control_socketpair()
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            code = 1
+            try:
+                parent.close()
+                self.serve(child, pool, listener)
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        child.close()
+        self.pid, self.control = pid, parent
+        self.reader = threading.Thread(target=self.read, name='zygote')
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def fork(self, index):
+        """(pid, control socket) of a new worker process index"""
+        with self.lock:
+            if self.status is not None: raise IOError('zygote %s' % describe(self.status))
+            self.control.send(codec.dumps({'fork': index}))
+            while True:
+                try:
+                    forked = self.forked.get(timeout=WORKER_STOP_TIMEOUT/1000.0)
+                except Queue.Empty:
+                    raise IOError('zygote did not fork worker #%d' % index)
+                if forked is None: raise IOError('zygote exited')
+                if forked[0] == index: return forked[1:]
+                forked[2].close()   # answer to a request that timed out
+
+    def read(self):
+        while True:
+            try:
+                data = self.control.recv(65536)
+            except socket.error:
+                break
+            if not data: break
+            message = codec.loads(data)
+            if 'exited' in message:
+                self.exits[message['exited']] = message['status']
+                continue
+            fd = _multiprocessing.recvfd(self.control.fileno())
+            control = socket.socket(_sock=socket.fromfd(fd, socket.AF_UNIX, self.control.type))
+            os.close(fd)
+            self.forked.put((message['forked'], message['pid'], control))
+        self.forked.put(None)
+
+    def exited(self):
+        if self.status is None: self.status = wait_status(self.pid)
+        return self.status is not None
+
+    def stop(self):
+        """the zygote exits once its control socket is closed"""
+        try:
+            self.control.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        deadline = time.time() + WORKER_STOP_TIMEOUT/1000.0
+        while not self.exited() and time.time() < deadline:
+            time.sleep(0.01)
+        if self.status is None:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        self.control.close()
+
+    def serve(self, control, pool, listener): # pragma: no cover
+        """main of the zygote process"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if hasattr(signal, 'SIGHUP'): signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        detach_inherited_fds([control.fileno()] + logging_fds(listener))
+        requests = poller()
+        requests.register(control, POLL_READ)
+        while True:
+            if requests.poll(WORKER_CHECK_INTERVAL/1000.0):
+                data = control.recv(65536)
+                if not data: break
+                index = codec.loads(data)['fork']
+                pid, theirs = WorkerProcess(index, self.count).spawn(pool, listener)
+                control.send(codec.dumps({'forked': index, 'pid': pid}))
+                _multiprocessing.sendfd(control.fileno(), theirs.fileno())
+                theirs.close()
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError:
+                    break
+                if not pid: break
+                control.send(codec.dumps({'exited': pid, 'status': status}))
+
+def wait_status(pid):
+    """wait status of child pid if it exited, else None"""
+    try:
+        waited, status = os.waitpid(pid, os.WNOHANG)
+    except OSError, e:
+        if e.errno != errno.ECHILD: raise
+        return 0
+    return status if waited else None
+
+def describe(status):
+    if status is None: return 'running'
+    if os.WIFSIGNALED(status): return 'killed by signal %d' % os.WTERMSIG(status)
+    return 'exited with %d' % os.WEXITSTATUS(status)
+
+class WorkerProcess(object):
+    """a forked proxy process and the tunnel's end of its control socket"""
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.zygote = None
+        self.pid = None
+        self.control = None
+        self.reader = None
+        self.started = None
+        self.status = None
+        self.active = 0         # channels relayed to it
+        self.gauges = dict()    # gauge name -> what the worker added to it
+        self.lock = threading.Lock()
+
+    def start(self, zygote):
+        pid, control = zygote.fork(self.index)
+        self.zygote, self.pid, self.control, self.started, self.status = zygote, pid, control, time.time(), None
+        self.gauges = dict()
+        self.reader = threading.Thread(target=self.read_reports, args=(control,), name='worker-%d-reports' % self.index)
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def handoff(self, chan):
+        """socket relayed to a new proxy for chan in the worker"""
+        ours, theirs = socket.socketpair()
+        try:
+            with self.lock:
+                if not self.control: raise socket.error(errno.EPIPE, 'worker #%d exited' % self.index)
+                self.control.send(codec.dumps({'origin_addr': getattr(chan, 'origin_addr', None)}))
+                _multiprocessing.sendfd(self.control.fileno(), theirs.fileno())
+        except Exception:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        return ours
+
+    def read_reports(self, control):
+        while True:
+            try:
+                data = control.recv(WORKER_REPORT_MAX_BYTES)
+            except socket.error:
+                break
+            if not data: break
+            try:
+                delta = codec.loads(data)
+            except ValueError: # pragma: no cover
+                continue
+            registry.merge(delta)
+            for name, values in delta.items():
+                metric = registry.get(name)
+                if metric and metric.type == 'gauge':
+                    self.gauges[name] = self.gauges.get(name, 0) + values.get('', 0)
+
+    def exited(self):
+        if self.status is None: self.status = self.zygote.exits.pop(self.pid, None)
+        return self.status is not None
+
+    def retire(self):
+        """takes what the exited worker added to gauges back out"""
+        with self.lock:
+            control, self.control = self.control, None
+        control.close()
+        self.reader.join(1)
+        registry.merge(dict([(name, {'': -value}) for name, value in self.gauges.items()]))
+        self.gauges = dict()
+
+    def describe(self):
+        return describe(self.status)
+
+    def spawn(self, pool, listener): # pragma: no cover
+        """forks the worker in the zygote, returns its pid and the tunnel's end of its control socket"""
+        parent, child = control_socketpair()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                parent.close()
+                self.serve(child, pool, listener)
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        child.close()
+        return pid, parent
+
+    def serve(self, control, pool, listener): # pragma: no cover
+        """main of the worker process, it ends when the tunnel process closes control"""
+        detach_inherited_fds([control.fileno()] + logging_fds(listener))
+        reinit_logging(listener)
+        registry.reset()
+        self.reset_proxy(pool)
+
+        reporter = threading.Thread(target=self.report, args=(control,), name='reporter')
+        reporter.setDaemon(True)
+        reporter.start()
+
+        while True:
+            meta = control.recv(65536)
+            if not meta: break
+            fd = _multiprocessing.recvfd(control.fileno())
+            origin_addr = codec.loads(meta).get('origin_addr')
+            client = HandedOff(fd, tuple(origin_addr) if origin_addr else None)
+            os.close(fd)
+            Proxy.worker_pool.submit(client)
+        if Proxy.access_log: Proxy.access_log.stop()
+
+    def reset_proxy(self, pool): # pragma: no cover
+        """Proxy state of its own, the threads looking after the tunnel's were not forked"""
+        reaper = Proxy.idle_reaper
+        Proxy.idle_reaper = IdleReaper(reaper.timeout_ticks * reaper.tick * 1000, reaper.tick * 1000, registry=registry)
+        Proxy.worker_pool = WorkerPool(pool.size, pool.queue.maxsize, pool.queue_timeout)
+        Proxy.buffer_pool = BufferPool(Proxy.buffer_pool.size, Proxy.buffer_pool.max_free, registry=registry)
+        resolver = Proxy.resolver
+        Proxy.resolver = DnsCache(resolver.ttl, resolver.negative_ttl, resolver.max_entries,
+                                  ResolverPool(len(resolver.pool.threads)) if resolver.pool else None)
+        Proxy.scheduler = None  # sends to devices happen in the tunnel process
+        if Proxy.access_log:
+            log = Proxy.access_log
+            root, ext = os.path.splitext(log.path)
+            Proxy.access_log = AccessLog('%s.worker-%d%s' % (root, self.index, ext), log.sample_rate, log.max_bytes, log.backups)
+            Proxy.access_log.start()
+        if Proxy.http_cache:
+            Proxy.http_cache = Proxy.http_cache.partition(self.index, self.count)
+
+    def report(self, control): # pragma: no cover
+        previous = dict()
+        while True:
+            time.sleep(WORKER_REPORT_INTERVAL/1000.0)
+            state = registry.state()
+            delta = difference(state, previous)
+            if not delta: continue
+            try:
+                control.send(codec.dumps(delta))
+            except socket.error:
+                os._exit(0)
+            previous = state
+
+class Workers(object):
+    """forks count WorkerProcess and forks them again when they exit"""
+
+    def __init__(self, count, listener=None):
+        self.processes = [WorkerProcess(i, count) for i in range(count)]
+        self.zygote = Zygote(count)
+        self.listener = listener
+        self.pool = Proxy.worker_pool
+        self.lock = threading.Lock()
+        self.switchboard = Switchboard(self)
+        self.monitor = None
+        self.running = False
+
+    def start(self):
+        """forks the zygote and the workers, takes over Proxy.worker_pool, call before transport threads start"""
+        self.zygote.start(self.pool, self.listener)
+        for worker in self.processes:
+            worker.start(self.zygote)
+        worker_processes.set(len(self.processes))
+        self.running = True
+        self.switchboard.start()
+        Proxy.worker_pool = self.switchboard
+        self.monitor = threading.Thread(target=self.run, name='workers')
+        self.monitor.setDaemon(True)
+        self.monitor.start()
+
+    def handoff(self, chan):
+        """(worker, socket) of the least busy worker now serving chan"""
+        with self.lock:
+            candidates = sorted([w for w in self.processes if w.control and w.status is None], key=lambda w: w.active)
+        for worker in candidates:
+            try:
+                sock = worker.handoff(chan)
+            except (socket.error, OSError), e:
+                workers_log.warning("worker #%d refused channel %r", worker.index, e)
+                continue
+            with self.lock: worker.active += 1
+            worker_handoffs.inc()
+            return worker, sock
+        raise IOError('no worker process available')
+
+    def done(self, worker):
+        with self.lock: worker.active -= 1
+
+    def run(self):
+        while self.running:
+            time.sleep(WORKER_CHECK_INTERVAL/1000.0)
+            self.check()
+
+    def check(self):
+        """forks workers that exited again, returns how many"""
+        restarted = 0
+        if self.zygote.status is None and self.zygote.exited():
+            workers_log.error("zygote (pid %d) %s, workers that exit are not forked again", self.zygote.pid, describe(self.zygote.status))
+        for worker in self.processes:
+            if not self.running or not worker.exited(): continue
+            if worker.control:
+                workers_log.warning("worker #%d (pid %d) %s", worker.index, worker.pid, worker.describe())
+                worker.retire()
+                worker_processes.dec()
+            if self.zygote.status is not None: continue
+            if time.time() - worker.started < WORKER_RESTART_DELAY/1000.0: continue
+            try:
+                worker.start(self.zygote)
+            except (IOError, socket.error), e:
+                workers_log.error("unable to fork worker #%d again %r", worker.index, e)
+                continue
+            worker_processes.inc()
+            worker_restarts.inc()
+            restarted += 1
+        return restarted
+
+    def close(self):
+        self.running = False
+        self.switchboard.stop()
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            running = [w for w in self.processes if not w.exited()]
+            for worker in running:
+                try:
+                    os.kill(worker.pid, sig)
+                except OSError:
+                    pass
+            deadline = time.time() + WORKER_STOP_TIMEOUT/1000.0
+            for worker in running:
+                # reaped and reported by the zygote
+                while not worker.exited() and self.zygote.reader.isAlive() and time.time() < deadline:
+                    time.sleep(0.01)
+        self.zygote.stop()
+        worker_processes.set(0)
+        Proxy.worker_pool = self.pool
@@ -0,0 +1,129 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+End-to-end AppurifyClient.main benchmark against the local mock API.
+
+Runs 1, 10 and 100 concurrent clients (threads) through the full pipeline
+including real HTTP uploads and result downloads, then reports end to end
+latency, upload/download throughput and requests per endpoint. Run from the
+repository root:
+
+    python -m benchmarks.bench_client --output client.json
+    python -m benchmarks.bench_client --concurrency 10 --latency 0.05 --devices 3
+"""
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+
+from appurify.client import AppurifyClient
+from appurify import constants
+
+from .common import summarize, save, report
+from .mock_api import MockApi, MockApiServer
+
+def make_file(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write('x' * size)
+    return path
+
+def run_client(app_src, test_src, result_dir, devices, poll_every):
+    client = AppurifyClient(
+        api_key='bench_key', api_secret='bench_secret',
+        test_type='calabash', app_src=app_src, app_src_type='raw',
+        test_src=test_src, test_src_type='raw',
+        device_type_id='58,61' if devices > 1 else '58',
+        result_dir=result_dir, poll_every=poll_every, timeout_sec=600)
+    return client.main()
+
+def run_concurrency(server, concurrency, runs, app_src, test_src, workdir, devices, poll_every):
+    server.api.reset()
+    latencies, errors, lock = [], [0], threading.Lock()
+    remaining = [runs]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                run = remaining[0]
+            result_dir = os.path.join(workdir, 'results-%d-%d' % (concurrency, run))
+            started = time.time()
+            exit_code = run_client(app_src, test_src, result_dir, devices, poll_every)
+            with lock:
+                if exit_code == constants.EXIT_CODE_ALL_PASS:
+                    latencies.append(time.time() - started)
+                else:
+                    errors[0] += 1
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.time() - started
+
+    stats = server.api.stats
+    uploads = [stats.get(k, {}) for k in ('apps/upload', 'tests/upload')]
+    upload_bytes = sum([s.get('bytes_received', 0) for s in uploads])
+    upload_seconds = sum([s.get('seconds', 0) for s in uploads])
+    download = stats.get('results', {})
+
+    result = summarize(latencies, elapsed, upload_bytes + download.get('bytes_sent', 0), errors[0])
+    result['upload_bytes_per_sec'] = upload_bytes / upload_seconds if upload_seconds else None
+    result['download_bytes_per_sec'] = download.get('bytes_sent', 0) / download['seconds'] if download.get('seconds') else None
+    result['requests_per_endpoint'] = dict([(k, v['requests']) for k, v in stats.items()])
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark AppurifyClient.main against a local mock API')
+    parser.add_argument('--concurrency', type=int, action='append', help='Concurrent client runs (default: 1, 10 and 100)')
+    parser.add_argument('--runs', type=int, help='Client runs per concurrency level (default: 2 x concurrency)')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every API response (default: 0)')
+    parser.add_argument('--polls', type=int, default=1, help='In-progress polls before a run completes (default: 1)')
+    parser.add_argument('--poll-every', type=float, default=0.01, help='Client poll interval in seconds, must be > 0 (default: 0.01)')
+    parser.add_argument('--devices', type=int, default=1, help='Devices per run, > 1 returns multi-device results (default: 1)')
+    parser.add_argument('--app-bytes', type=int, default=1024 * 1024, help='Size of uploaded app (default: 1MB)')
+    parser.add_argument('--test-bytes', type=int, default=256 * 1024, help='Size of uploaded test (default: 256KB)')
+    parser.add_argument('--result-bytes', type=int, default=1024 * 1024, help='Size of downloaded results per device (default: 1MB)')
+    parser.add_argument('--output', help='Save results as json to this path (- for stdout)')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    server = MockApiServer(MockApi(args.latency, args.polls, args.devices, args.result_bytes)).start()
+    saved_environ = dict(os.environ)
+    os.environ.update(server.environ())
+    workdir = tempfile.mkdtemp(prefix='appurify-bench-')
+
+    results = dict()
+    try:
+        app_src = make_file(workdir, 'app.ipa', args.app_bytes)
+        test_src = make_file(workdir, 'test.zip', args.test_bytes)
+        for concurrency in args.concurrency or [1, 10, 100]:
+            runs = args.runs or concurrency * 2
+            results['client.main.c%d' % concurrency] = run_concurrency(server, concurrency, runs, app_src, test_src, workdir, args.devices, args.poll_every)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+    report(results)
+    for name in sorted(results):
+        print '%-40s %s' % (name, ', '.join(['%s=%s' % kv for kv in sorted(results[name]['requests_per_endpoint'].items())]))
+    if args.output:
+        save(results, args.output)
+
+if __name__ == '__main__':
+    main()
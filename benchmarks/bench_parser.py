@@ -0,0 +1,172 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Micro-benchmarks for HttpParser and ChunkParser.
+
+Every case parses a fixed message, fed in recv-sized fragments, and reports
+the best-of-N time in ns/byte along with allocations per message. Run from
+the repository root:
+
+    python -m benchmarks.bench_parser --output parser.json
+
+Allocations are measured with tracemalloc where available. Python 2 has no
+tracemalloc, so there the net count of gc tracked objects created while
+parsing is reported instead, which undercounts strings.
+"""
+import gc
+import time
+import argparse
+
+from appurify.tunnel import HttpParser, ChunkParser, HTTP_RESPONSE_PARSER, HTTP_PARSER_STATE_COMPLETE, \
+    CHUNK_PARSER_STATE_COMPLETE, CRLF
+
+from .common import save
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+FRAGMENT_SIZES = (1, 16, 128, 1024, 8192)
+
+def header_heavy_request(headers=60):
+    lines = ['GET http://example.com/path/to/resource?query=string&with=params HTTP/1.1', 'Host: example.com']
+    for i in range(headers):
+        lines.append('X-Custom-Header-%d: %s' % (i, 'v' * 40))
+    return CRLF.join(lines) + CRLF * 2
+
+def content_length_response(size):
+    return CRLF.join(['HTTP/1.1 200 OK', 'Content-Type: application/octet-stream', 'Content-Length: %d' % size, CRLF]) + 'x' * size
+
+def chunked_body(chunks, chunk_size):
+    body = ''.join(['%x%s%s%s' % (chunk_size, CRLF, 'x' * chunk_size, CRLF) for _ in range(chunks)])
+    return body + '0' + CRLF * 2
+
+def chunked_response(chunks, chunk_size):
+    return CRLF.join(['HTTP/1.1 200 OK', 'Transfer-Encoding: chunked', CRLF]) + chunked_body(chunks, chunk_size)
+
+def fragments(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def http_request_parser():
+    return HttpParser()
+
+def http_response_parser():
+    return HttpParser(HTTP_RESPONSE_PARSER)
+
+def check_http(parser):
+    assert parser.state == HTTP_PARSER_STATE_COMPLETE, parser.state
+
+def check_chunk(parser):
+    assert parser.state == CHUNK_PARSER_STATE_COMPLETE, parser.state
+
+def cases():
+    """case name -> (parser factory, completion check, message, fragment size)"""
+    cases = dict()
+    request = header_heavy_request()
+    cases['request.header_heavy'] = (http_request_parser, check_http, request, len(request))
+    small = content_length_response(4096)
+    for size in FRAGMENT_SIZES:
+        cases['response.fragmented.%05d' % size] = (http_response_parser, check_http, small, size)
+    cases['response.content_length_1mb'] = (http_response_parser, check_http, content_length_response(1024 * 1024), 8192)
+    response = chunked_response(1000, 64)
+    cases['response.chunked_1000x64'] = (http_response_parser, check_http, response, len(response))
+    cases['response.chunked_1000x64.fragmented'] = (http_response_parser, check_http, response, 8192)
+    body = chunked_body(1000, 64)
+    cases['chunk.1000x64'] = (ChunkParser, check_chunk, body, len(body))
+    cases['chunk.1000x64.fragmented'] = (ChunkParser, check_chunk, body, 8192)
+    body = chunked_body(16, 65536)
+    cases['chunk.16x65536'] = (ChunkParser, check_chunk, body, len(body))
+    return cases
+
+def parse(factory, pieces):
+    parser = factory()
+    for piece in pieces:
+        parser.parse(piece)
+    return parser
+
+def measure_allocations(factory, pieces):
+    if tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        parser = parse(factory, pieces)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocs = sum([stat.count_diff for stat in after.compare_to(before, 'lineno') if stat.count_diff > 0])
+        return allocs, 'tracemalloc', parser
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        parser = parse(factory, pieces)
+        allocs = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return allocs, 'gc', parser
+
+def run_case(factory, check, message, size, repeat, min_time):
+    pieces = fragments(message, size)
+    allocs, method, parser = measure_allocations(factory, pieces)
+    check(parser)
+
+    # calibrate iterations so a single repeat takes at least min_time
+    iterations = 1
+    while True:
+        started = time.time()
+        for _ in xrange(iterations): parse(factory, pieces)
+        elapsed = time.time() - started
+        if elapsed >= min_time: break
+        iterations *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = time.time()
+        for _ in xrange(iterations): parse(factory, pieces)
+        best = min(best, time.time() - started)
+
+    per_message = best / iterations
+    return {
+        'message_bytes': len(message),
+        'fragment_bytes': size,
+        'fragments': len(pieces),
+        'iterations': iterations,
+        'us_per_message': per_message * 1e6,
+        'ns_per_byte': per_message * 1e9 / len(message),
+        'allocs_per_message': allocs,
+        'alloc_method': method,
+    }
+
+def main():
+    available = cases()
+    parser = argparse.ArgumentParser(description='Micro-benchmark HttpParser and ChunkParser')
+    parser.add_argument('--case', action='append', choices=sorted(available), help='Case to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeats, best time is reported (default: 5)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum seconds per repeat (default: 0.2)')
+    parser.add_argument('--output', help='Save results as json to this path (- for stdout)')
+    args = parser.parse_args()
+
+    results = dict()
+    for name in args.case or sorted(available):
+        factory, check, message, size = available[name]
+        try:
+            r = results[name] = run_case(factory, check, message, size, args.repeat, args.min_time)
+        except Exception, e:
+            # e.g. parser unable to handle this fragmentation, keep going with other cases
+            results[name] = {'error': repr(e)}
+            print '%-40s failed with %r' % (name, e)
+            continue
+        print '%-40s %10.2f ns/byte %10.1f us/msg %8d allocs/msg (%s)' % (
+            name, r['ns_per_byte'], r['us_per_message'], r['allocs_per_message'], r['alloc_method'])
+
+    if args.output:
+        save(results, args.output)
+
+if __name__ == '__main__':
+    main()
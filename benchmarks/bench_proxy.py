@@ -0,0 +1,187 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Proxy throughput and latency benchmark against a loopback origin.
+
+Each request gets a socketpair standing in for the ssh channel; one end is
+handed to the proxy engine, the other plays the device. Run from the
+repository root:
+
+    python -m benchmarks.bench_proxy --output proxy.json
+    python -m benchmarks.bench_proxy --scenario get_small --concurrency 50 --requests 2000
+
+Every engine runs in its own process so peak RSS is reported per engine.
+"""
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+
+from appurify.tunnel import Proxy, CRLF
+from appurify.workers import Workers, Switchboard
+
+from .common import summarize, save, report
+from .origin import OriginServer, EchoServer, FakeChannel, read_until_close
+
+DEVICE_TIMEOUT = 30
+
+def threaded(channel):
+    """default engine: one Proxy thread per channel, as in Tunnel.start"""
+    proxy = Proxy(channel)
+    proxy.setDaemon(True)
+    proxy.start()
+
+def pooled(channel):
+    """bounded WorkerPool with accept queue, as in TransportPool.accept_loop"""
+    Proxy.worker_pool.submit(channel)
+
+WORKER_PROCESSES = 2
+workers_lock = threading.Lock()
+
+def processes(channel):
+    """Switchboard relaying to forked worker processes, as with --processes"""
+    with workers_lock:
+        if not isinstance(Proxy.worker_pool, Switchboard):
+            Workers(WORKER_PROCESSES).start()
+    Proxy.worker_pool.submit(channel)
+
+# engine name -> callable taking an accepted channel
+ENGINES = {
+    'threaded': threaded,
+    'pooled': pooled,
+    'processes': processes,
+}
+
+# scenario name -> (kind, path or payload size, default requests)
+SCENARIOS = {
+    'get_small': ('http', '/bytes/1024', 2000),
+    'get_large': ('http', '/bytes/%d' % (4 * 1024 * 1024), 50),
+    'chunked': ('http', '/chunked/%d/4096' % (1024 * 1024), 100),
+    'connect_stream': ('connect', 1024 * 1024, 100),
+}
+
+def http_request(engine, host, port, path):
+    channel, device = FakeChannel.pair()
+    device.settimeout(DEVICE_TIMEOUT)
+    engine(channel)
+    device.sendall(CRLF.join([
+        'GET http://%s:%s%s HTTP/1.1' % (host, port, path),
+        'Host: %s:%s' % (host, port),
+        'User-Agent: appurify-bench',
+        'Proxy-Connection: Keep-Alive',
+        CRLF
+    ]))
+    try:
+        return read_until_close(device)
+    finally:
+        device.close()
+
+def connect_stream(engine, host, port, size, piece=65536):
+    channel, device = FakeChannel.pair()
+    device.settimeout(DEVICE_TIMEOUT)
+    engine(channel)
+    try:
+        device.sendall(CRLF.join(['CONNECT %s:%s HTTP/1.1' % (host, port), 'Host: %s:%s' % (host, port), CRLF]))
+        established = ''
+        while not established.endswith(CRLF * 2):
+            data = device.recv(1024)
+            if not data:
+                raise IOError('tunnel closed before connection established')
+            established += data
+        total, payload = 0, 'x' * piece
+        while total < size:
+            device.sendall(payload)
+            received = 0
+            while received < piece:
+                data = device.recv(piece - received)
+                if not data:
+                    raise IOError('tunnel closed mid stream')
+                received += len(data)
+            total += received
+        return total
+    finally:
+        device.close()
+
+def run_scenario(engine, scenario, origin, echo, concurrency, requests):
+    kind, arg, _ = SCENARIOS[scenario]
+    latencies, nbytes, errors = [], [0], [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            started = time.time()
+            try:
+                if kind == 'http':
+                    n = http_request(engine, origin.host, origin.port, arg)
+                else:
+                    n = connect_stream(engine, echo.host, echo.port, arg)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - started)
+                nbytes[0] += n
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return summarize(latencies, time.time() - started, nbytes[0], errors[0])
+
+def run_engine(name, scenarios, concurrency, requests):
+    origin, echo = OriginServer().start(), EchoServer().start()
+    socket.setdefaulttimeout(DEVICE_TIMEOUT)
+    results = dict()
+    try:
+        for scenario in scenarios:
+            n = requests or SCENARIOS[scenario][2]
+            results['%s.%s.c%d' % (name, scenario, concurrency)] = run_scenario(ENGINES[name], scenario, origin, echo, concurrency, n)
+    finally:
+        origin.stop()
+        echo.stop()
+    return results
+
+def engine_process(queue, *args):
+    queue.put(run_engine(*args))
+
+def run_engine_in_process(name, scenarios, concurrency, requests):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=engine_process, args=(queue, name, scenarios, concurrency, requests))
+    proc.start()
+    results = queue.get()
+    proc.join()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Proxy engines against a loopback origin')
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES), help='Engine to benchmark (default: all)')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='Scenario to run (default: all)')
+    parser.add_argument('--concurrency', type=int, default=10, help='Concurrent devices (default: 10)')
+    parser.add_argument('--requests', type=int, help='Requests per scenario (default: per scenario)')
+    parser.add_argument('--output', help='Save results as json to this path (- for stdout)')
+    args = parser.parse_args()
+
+    results = dict()
+    for name in args.engine or sorted(ENGINES):
+        results.update(run_engine_in_process(name, args.scenario or sorted(SCENARIOS), args.concurrency, args.requests))
+
+    report(results)
+    if args.output:
+        save(results, args.output)
+
+if __name__ == '__main__':
+    main()
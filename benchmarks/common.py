@@ -0,0 +1,88 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Shared helpers for benchmark drivers: timing stats, memory usage and
+result files that can be diffed across commits.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import subprocess
+
+from appurify import constants
+
+def percentile(values, p):
+    """nearest-rank percentile of values, p in [0, 100]"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+def peak_rss_kb():
+    """peak resident set size of this process in KB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024
+    return rss
+
+def summarize(latencies, elapsed, nbytes, errors=0):
+    """standard result record for a benchmark scenario"""
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'elapsed_sec': elapsed,
+        'requests_per_sec': len(latencies) / elapsed if elapsed else None,
+        'bytes': nbytes,
+        'bytes_per_sec': nbytes / elapsed if elapsed else None,
+        'latency_p50_ms': ms(percentile(latencies, 50)),
+        'latency_p99_ms': ms(percentile(latencies, 99)),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+def ms(value):
+    return None if value is None else value * 1000
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'wb')).strip()
+    except Exception:
+        return None
+
+def environment():
+    return {
+        'version': constants.__version__,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+    }
+
+def save(results, path):
+    """write results along with environment details to path, '-' for stdout"""
+    doc = {'environment': environment(), 'results': results}
+    data = json.dumps(doc, indent=2, sort_keys=True)
+    if path == '-':
+        print data
+    else:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+def report(results):
+    """print a one line summary per scenario"""
+    for name in sorted(results):
+        r = results[name]
+        print '%-40s %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms  %10.0f B/s  rss %6d KB  errors %d' % (
+            name, r['requests_per_sec'] or 0, r['latency_p50_ms'] or 0, r['latency_p99_ms'] or 0,
+            r['bytes_per_sec'] or 0, r['peak_rss_kb'], r['errors'])
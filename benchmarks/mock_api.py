@@ -0,0 +1,201 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Local stand-in for the Appurify REST API, just enough of it to drive
+AppurifyClient.main end to end: access token, device list, app/test/config
+upload, test run, result polling and result download.
+
+Point the client at it with:
+
+    APPURIFY_API_PROTO=http APPURIFY_API_HOST=127.0.0.1 APPURIFY_API_PORT=<port>
+"""
+import json
+import time
+import urlparse
+import threading
+import BaseHTTPServer
+
+from .origin import OriginServer
+
+DEVICE_TYPES = [
+    {'device_type_id': 58, 'name': '5_NR', 'brand': 'iPhone', 'os_name': 'iOS', 'os_version': '6.1.2'},
+    {'device_type_id': 61, 'name': '5_NR', 'brand': 'iPhone', 'os_name': 'iOS', 'os_version': '6.0.2'},
+    {'device_type_id': 137, 'name': 'Nexus 5', 'brand': 'Google', 'os_name': 'Android', 'os_version': '4.4'},
+]
+
+class MockApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def resource(self):
+        path = self.path.split('?')[0]
+        if path.startswith('/resource/'):
+            path = path[len('/resource/'):]
+        return path.strip('/')
+
+    def read_body(self):
+        length = int(self.headers.getheader('content-length', 0))
+        remaining, received = length, 0
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, 65536))
+            if not data: break
+            remaining -= len(data)
+            received += len(data)
+        return received
+
+    def reply(self, response, code=200):
+        body = json.dumps({'meta': {'code': code}, 'response': response})
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-api-server-hostname', 'mock-api')
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def params(self):
+        query = urlparse.urlsplit(self.path).query
+        return dict([(k, v[0]) for k, v in urlparse.parse_qs(query).items()])
+
+    def do_GET(self):
+        self.server.api.handle(self, self.resource(), self.params(), 0)
+
+    def do_POST(self):
+        received = self.read_body()
+        self.server.api.handle(self, self.resource(), self.params(), received)
+
+    def log_message(self, format, *args):
+        pass
+
+class MockApi(object):
+    """state and behaviour of the mock API.
+
+    latency         seconds added to every API response
+    polls           tests/check responses reporting in-progress before complete
+    devices         device types per run, > 1 returns multi-device results
+    result_bytes    size of each downloadable results.zip
+    """
+
+    def __init__(self, latency=0, polls=1, devices=1, result_bytes=1024 * 1024):
+        self.latency = latency
+        self.polls = polls
+        self.devices = devices
+        self.result_bytes = result_bytes
+        self.payload = 'x' * result_bytes
+
+        self.lock = threading.Lock()
+        self.runs = dict()
+        self.next_id = 0
+        self.stats = dict()
+        self.base_url = None
+
+    def count(self, endpoint, received, sent, elapsed):
+        with self.lock:
+            s = self.stats.setdefault(endpoint, {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0, 'seconds': 0})
+            s['requests'] += 1
+            s['bytes_received'] += received
+            s['bytes_sent'] += sent
+            s['seconds'] += elapsed
+
+    def reset(self):
+        with self.lock:
+            self.stats = dict()
+
+    def new_id(self, prefix):
+        with self.lock:
+            self.next_id += 1
+            return '%s_%d' % (prefix, self.next_id)
+
+    def handle(self, handler, resource, params, received):
+        started = time.time()
+        if self.latency and not resource.startswith('results/'):
+            time.sleep(self.latency)
+
+        if resource.startswith('results/'):
+            sent = self.download(handler)
+        else:
+            endpoint = getattr(self, resource.replace('/', '_'), None)
+            if endpoint is None:
+                handler.send_error(404)
+                sent = 0
+            else:
+                sent = handler.reply(endpoint(params))
+        self.count(resource.split('/')[0] if resource.startswith('results/') else resource, received, sent, time.time() - started)
+
+    def download(self, handler):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/zip')
+        handler.send_header('Content-Length', str(self.result_bytes))
+        handler.end_headers()
+        handler.wfile.write(self.payload)
+        return self.result_bytes
+
+    def access_token_generate(self, params):
+        return {'access_token': self.new_id('token'), 'ttl': 86400}
+
+    def devices_list(self, params):
+        return DEVICE_TYPES
+
+    def apps_upload(self, params):
+        return {'app_id': self.new_id('app')}
+
+    def tests_upload(self, params):
+        return {'test_id': self.new_id('test')}
+
+    def tests_config_upload(self, params):
+        return {'config_id': self.new_id('config')}
+
+    def tests_run(self, params):
+        test_run_id = self.new_id('run')
+        with self.lock:
+            self.runs[test_run_id] = 0
+        return {'test_run_id': test_run_id, 'config': None, 'queue_timeout_limit': 600}
+
+    def tests_check(self, params):
+        test_run_id = params.get('test_run_id')
+        with self.lock:
+            polled = self.runs.get(test_run_id, 0)
+            self.runs[test_run_id] = polled + 1
+        if polled < self.polls:
+            return {'status': 'in-progress', 'detailed_status': 'running', 'test_run_id': test_run_id}
+        return self.complete()
+
+    def device_result(self, device_type_id):
+        return {
+            'exception': None, 'errors': '', 'output': 'mock output',
+            'number_passes': 1, 'number_fails': 0, 'pass': True,
+            'url': '%s/results/%s.zip' % (self.base_url, device_type_id),
+        }
+
+    def complete(self):
+        if self.devices > 1:
+            results = [{'device_type': 'mock', 'device_type_id': 58 + i, 'results': self.device_result(58 + i)} for i in range(self.devices)]
+            return {'status': 'complete', 'detailed_status': 'success', 'complete_count': self.devices, 'results': results}
+        return {'status': 'complete', 'detailed_status': 'success', 'results': self.device_result(58)}
+
+class MockApiServer(OriginServer):
+    """threaded mock API listening on an ephemeral loopback port"""
+
+    handler = MockApiHandler
+
+    def __init__(self, api=None, host='127.0.0.1', port=0):
+        super(MockApiServer, self).__init__(host, port)
+        self.api = api if api else MockApi()
+        self.api.base_url = 'http://%s:%s' % (self.host, self.port)
+        self.server.api = self.api
+
+    def environ(self):
+        """environment variables pointing AppurifyClient at this server"""
+        return {
+            'APPURIFY_API_PROTO': 'http',
+            'APPURIFY_API_HOST': self.host,
+            'APPURIFY_API_PORT': str(self.port),
+            'APPURIFY_STATUS_BASE_URL': 'none',
+        }
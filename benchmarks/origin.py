@@ -0,0 +1,138 @@
+"""
+    Copyright 2013 Appurify, Inc
+    All rights reserved
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+    License for the specific language governing permissions and limitations
+    under the License.
+
+Loopback stand-ins for the pieces around Proxy: an origin HTTP server,
+a TCP echo server for CONNECT streams and a fake ssh channel.
+"""
+import socket
+import threading
+import SocketServer
+import BaseHTTPServer
+
+class OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """serves generated bodies.
+
+    GET /bytes/<n>                  n byte body with content-length
+    GET /chunked/<n>/<chunk size>   n byte body with chunked transfer-encoding
+    POST /echo                      request body echoed back
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts[0] == 'bytes':
+            body = 'x' * int(parts[1])
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif parts[0] == 'chunked':
+            size, chunk = int(parts[1]), int(parts[2]) if len(parts) > 2 else 1024
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            sent = 0
+            while sent < size:
+                n = min(chunk, size - sent)
+                self.wfile.write('%x\r\n%s\r\n' % (n, 'x' * n))
+                sent += n
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+class OriginServer(object):
+    """http origin listening on an ephemeral loopback port"""
+
+    handler = OriginHandler
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadedServer((host, port), self.handler)
+        self.host, self.port = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class EchoHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            self.request.sendall(data)
+
+class EchoServer(OriginServer):
+    """tcp echo server, stands in for a TLS origin behind CONNECT"""
+
+    handler = EchoHandler
+
+class FakeChannel(object):
+    """wraps one end of a socketpair so Proxy can treat it like a paramiko Channel.
+
+    The other end plays the device sending requests through the tunnel.
+    """
+
+    origin_addr = ('127.0.0.1', 0)
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    @staticmethod
+    def pair():
+        """returns (channel for Proxy, socket for device)"""
+        a, b = socket.socketpair()
+        return FakeChannel(a), b
+
+def read_until_close(sock, bufsize=65536):
+    """read from sock until peer closes, returns total bytes received"""
+    total = 0
+    while True:
+        data = sock.recv(bufsize)
+        if not data:
+            return total
+        total += len(data)
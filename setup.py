@@ -20,7 +20,7 @@ setup(
     license=constants.__license__,
     description=constants.__description__,
     long_description=open('README.txt').read().strip(),
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     install_requires=open('requirements.txt', 'rb').read().strip().split(),
     tests_require=open('requirements-test.txt', 'rb').read().strip().split(),
     entry_points={
@@ -0,0 +1,67 @@
+import os
+import json
+import shutil
+import socket
+import tempfile
+import unittest
+from appurify.accesslog import AccessLog
+from appurify.tunnel import Proxy, CRLF
+
+class TestAccessLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, path):
+        return [json.loads(line) for line in open(path, 'rb')]
+
+    def test_flush_writes_jsonl(self):
+        access_log = AccessLog(self.path)
+        access_log.write({'method': 'GET', 'host': 'example.com', 'bytes_out': 10})
+        access_log.write({'method': 'CONNECT', 'host': 'example.com', 'bytes_out': 20})
+        access_log.flush()
+        records = self.read(self.path)
+        self.assertEqual([r['method'] for r in records], ['GET', 'CONNECT'])
+        self.assertEqual(access_log.written, 2)
+        self.assertEqual(access_log.records, [])
+        access_log.stop()
+
+    def test_rotation(self):
+        access_log = AccessLog(self.path, max_bytes=64, backups=2)
+        for i in range(4):
+            access_log.write({'seq': i, 'padding': 'x' * 32})
+            access_log.flush()
+        access_log.stop()
+        self.assertEqual(self.read(self.path), [{'seq': 3, 'padding': 'x' * 32}])
+        self.assertEqual(self.read(self.path + '.1')[0]['seq'], 2)
+        self.assertEqual(self.read(self.path + '.2')[0]['seq'], 1)
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+    def test_sampling(self):
+        self.assertTrue(AccessLog(self.path).sample())
+        self.assertFalse(AccessLog(self.path, sample_rate=0).sample())
+
+    def test_background_thread_flushes_on_stop(self):
+        access_log = AccessLog(self.path, flush_interval=10)
+        access_log.start()
+        access_log.write({'seq': 1})
+        access_log.stop()
+        self.assertFalse(access_log.isAlive())
+        self.assertEqual(self.read(self.path), [{'seq': 1}])
+
+    def test_port_is_a_number(self):
+        access_log = AccessLog(self.path)
+        for request in ('GET http://example.com:8080/ HTTP/1.1', 'CONNECT example.com:443 HTTP/1.1'):
+            channel, device = socket.socketpair()
+            proxy = Proxy(channel)
+            proxy.request.parse(CRLF.join([request, 'Host: example.com', CRLF]))
+            access_log.write(proxy.access_record())
+            channel.close()
+            device.close()
+        access_log.flush()
+        access_log.stop()
+        self.assertEqual([(r['method'], r['port']) for r in self.read(self.path)], [('GET', 8080), ('CONNECT', 443)])
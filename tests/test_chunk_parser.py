@@ -22,3 +22,17 @@ class TestChunkParser(unittest.TestCase):
         self.assertEqual(self.parser.size, None)
         self.assertEqual(self.parser.body, 'Wikipedia in\r\n\r\nchunks.')
         self.assertEqual(self.parser.state, CHUNK_PARSER_STATE_COMPLETE)
+
+    def test_split_size_line(self):
+        for data in ('1', '0\r', '\nabcdefghijklmnop\r', '\n', '0;ext=1\r\n', 'Trailer: x\r\n', '\r', '\n'):
+            self.parser.parse(data)
+        self.assertEqual(self.parser.body, 'abcdefghijklmnop')
+        self.assertEqual(self.parser.state, CHUNK_PARSER_STATE_COMPLETE)
+
+    def test_byte_at_a_time(self):
+        for c in '4\r\nWiki\r\n5\r\npedia\r\n0\r\n\r\n':
+            self.assertNotEqual(self.parser.state, CHUNK_PARSER_STATE_COMPLETE)
+            self.parser.parse(c)
+        self.assertEqual(self.parser.body, 'Wikipedia')
+        self.assertEqual(self.parser.state, CHUNK_PARSER_STATE_COMPLETE)
+
@@ -0,0 +1,46 @@
+import json
+import unittest
+from appurify import codec
+from appurify.codec import response_json, LazyJson
+
+class Response(object):
+
+    def __init__(self, content):
+        self.content = content
+        self.raw = content
+        self.decoded = 0
+
+    def json(self):
+        self.decoded += 1
+        return json.loads(self.raw)
+
+class TestCodec(unittest.TestCase):
+
+    def test_load_codec_falls_back_to_json(self):
+        name, module = codec.load_codec(['appurify_missing_codec', 'json'])
+        self.assertEqual(name, 'json')
+        self.assertEqual(module, json)
+
+    def test_response_json_cached(self):
+        r = Response('{"response": {"status": "complete"}}')
+        data = response_json(r)
+        r.content = None
+        self.assertTrue(response_json(r) is data)
+        self.assertEqual(data['response']['status'], 'complete')
+
+    def test_response_json_single_quotes(self):
+        r = Response("{'response': [{'device_type_id': 58}]}")
+        self.assertEqual(response_json(r)['response'][0]['device_type_id'], 58)
+
+    def test_response_json_without_content(self):
+        r = Response('{"response": 1}')
+        del r.content
+        self.assertEqual(response_json(r), {'response': 1})
+        self.assertEqual(response_json(r), {'response': 1})
+        self.assertEqual(r.decoded, 1)
+
+    def test_lazy_json(self):
+        obj = {'results': [1, 2, 3]}
+        lazy = LazyJson(obj, sort_keys=True)
+        self.assertEqual(json.loads(str(lazy)), obj)
+        self.assertEqual(str(LazyJson(obj)), codec.dumps(obj))
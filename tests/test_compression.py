@@ -0,0 +1,74 @@
+import zlib
+import unittest
+from appurify import compression
+from appurify.compression import GzipStream, accepts_gzip, compressible, gzip_head
+from appurify.tunnel import HttpParser, HTTP_RESPONSE_PARSER, ChunkParser, CRLF
+
+def request(headers=('Accept-Encoding: gzip, deflate',), method='GET'):
+    parser = HttpParser()
+    parser.parse(CRLF.join(['%s http://example.com/ HTTP/1.1' % method, 'Host: example.com'] + list(headers) + [CRLF]))
+    return parser
+
+def response(req, headers, code='200 OK'):
+    parser = HttpParser(HTTP_RESPONSE_PARSER, req)
+    parser.parse(CRLF.join(['HTTP/1.1 %s' % code] + list(headers) + [CRLF]))
+    return parser
+
+def dechunk(data):
+    chunker = ChunkParser()
+    chunker.parse(data)
+    return chunker.body
+
+class TestCompression(unittest.TestCase):
+
+    def test_accepts_gzip(self):
+        for value, accepted in (('gzip', True), ('deflate, GZIP;q=0.5', True), ('gzip;q=0', False),
+                                ('*', True), ('*;q=0', False), ('gzip;q=0, *', False), ('identity', False)):
+            self.assertEqual(accepts_gzip(request(['Accept-Encoding: %s' % value])), accepted, value)
+        self.assertFalse(accepts_gzip(request([])))
+
+    def test_compressible(self):
+        req = request()
+        html = ['Content-Type: text/html; charset=utf-8', 'Content-Length: 4096']
+        self.assertTrue(compressible(req, response(req, html)))
+        self.assertFalse(compressible(request([]), response(request([]), html)))
+        self.assertFalse(compressible(req, response(req, html + ['Content-Encoding: br'])))
+        self.assertFalse(compressible(req, response(req, html + ['Cache-Control: no-transform'])))
+        self.assertFalse(compressible(req, response(req, html, code='206 Partial Content')))
+        self.assertFalse(compressible(req, response(req, ['Content-Type: image/png', 'Content-Length: 4096'])))
+        self.assertFalse(compressible(req, response(req, ['Content-Type: text/html', 'Content-Length: 100'])))
+        self.assertFalse(compressible(req, response(req, ['Content-Type: text/html'], code='304 Not Modified')))
+        head = request(method='HEAD')
+        self.assertFalse(compressible(head, response(head, html)))
+
+    def test_gzip_head(self):
+        req = request()
+        res = response(req, ['Content-Type: text/css', 'Content-Length: 4096', 'ETag: "v1"', 'Vary: Cookie'])
+        head = gzip_head(res, True)
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(head.endswith('\r\n\r\n'))
+        for line in ('Content-Type: text/css', 'ETag: W/"v1"', 'Vary: Cookie, Accept-Encoding',
+                     'Content-Encoding: gzip', 'Transfer-Encoding: chunked'):
+            self.assertTrue(line + CRLF in head, line)
+        self.assertFalse('Content-Length' in head)
+        self.assertFalse('Transfer-Encoding' in gzip_head(res, False))
+
+    def test_stream(self):
+        responses = compression.gzip_responses.get('text/plain')
+        stream = GzipStream('text/plain', True)
+        body = ''.join(['line %d\n' % i for i in range(2000)])
+        framed = stream.compress(body[:5000])
+        # every piece is flushed, it decodes before the body is complete
+        self.assertTrue(zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(dechunk(framed)))
+        framed += stream.compress(body[5000:]) + stream.finish()
+        self.assertEqual(stream.finish(), '')
+        self.assertTrue(framed.endswith('0\r\n\r\n'))
+        self.assertEqual(zlib.decompress(dechunk(framed), 16 + zlib.MAX_WBITS), body)
+        self.assertEqual(compression.gzip_responses.get('text/plain'), responses + 1)
+        self.assertTrue(stream.produced < stream.consumed / 4)
+        self.assertEqual(stream.consumed, len(body))
+
+    def test_close_delimited(self):
+        stream = GzipStream('application/json', False)
+        encoded = stream.compress('{"a": 1}') + stream.finish()
+        self.assertEqual(zlib.decompress(encoded, 16 + zlib.MAX_WBITS), '{"a": 1}')
@@ -29,13 +29,13 @@ class TestHttpParser(unittest.TestCase):
     def test_build_url_none(self):
         self.assertEqual(self.parser.build_url(), '/None')
 
-    def test_line_rcvd_to_rcving_headers_state_change(self):
+    def test_line_rcvd_to_complete_without_headers(self):
         self.parser.parse("GET http://localhost HTTP/1.1")
         self.assertEqual(self.parser.state, HTTP_PARSER_STATE_INITIALIZED)
         self.parser.parse(CRLF)
         self.assertEqual(self.parser.state, HTTP_PARSER_STATE_LINE_RCVD)
         self.parser.parse(CRLF)
-        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_RCVING_HEADERS)
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
 
     def test_get_partial_parse1(self):
         self.parser.parse(CRLF.join([
@@ -136,6 +136,45 @@ class TestHttpParser(unittest.TestCase):
         self.assertEqual(self.parser.body, "a=b&c=d")
         self.assertEqual(self.parser.buffer, "")
 
+    def test_put_full_parse(self):
+        raw = CRLF.join([
+            "PUT http://localhost/file HTTP/1.1",
+            "Host: localhost",
+            "Content-Length: 5%s" % CRLF,
+            "hello"
+        ])
+        self.parser.parse(raw)
+        self.assertEqual(self.parser.method, "PUT")
+        self.assertEqual(self.parser.body, "hello")
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+
+    def test_unparsed_body(self):
+        self.parser.parse(CRLF.join([
+            "PATCH http://localhost/file HTTP/1.1",
+            "Host: localhost",
+            "Transfer-Encoding: chunked%s" % CRLF,
+            "5",
+            "hel"
+        ]))
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_RCVING_BODY)
+        self.assertEqual(self.parser.unparsed_body(), "5\r\nhel")
+        head = self.parser.build_head()
+        self.assertTrue(head.startswith("PATCH /file HTTP/1.1" + CRLF))
+        self.assertTrue("Transfer-Encoding: chunked" + CRLF in head)
+        self.assertTrue(head.endswith(CRLF * 2))
+        self.assertFalse("hel" in head)
+
+    def test_build_parts(self):
+        self.parser.parse(CRLF.join([
+            "POST http://localhost/upload HTTP/1.1",
+            "Content-Length: 7%s" % CRLF,
+            "a=b&c=d"
+        ]))
+        head, body = self.parser.build_parts(add_headers=[('Connection', 'Close')])
+        self.assertTrue(body is self.parser.body)
+        self.assertEqual(head, CRLF.join(["POST /upload HTTP/1.1", "Content-Length: 7", "Connection: Close", CRLF]))
+        self.assertEqual(self.parser.build(add_headers=[('Connection', 'Close')]), head + body)
+
     def test_response_parse(self):
         self.parser.type = HTTP_RESPONSE_PARSER
         self.parser.parse(''.join([
@@ -202,3 +241,60 @@ class TestHttpParser(unittest.TestCase):
         ]))
         self.assertEqual(self.parser.body, 'Wikipedia in\r\n\r\nchunks.')
         self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+
+    def response(self, code, headers, request_method='GET'):
+        request = HttpParser()
+        request.parse(CRLF.join(["%s http://localhost/ HTTP/1.1" % request_method, "Host: localhost", CRLF]))
+        self.parser = HttpParser(HTTP_RESPONSE_PARSER, request)
+        self.parser.parse(CRLF.join(["HTTP/1.1 %s" % code] + headers + [CRLF]))
+
+    def test_head_response(self):
+        self.response('200 OK', ['Content-Length: 1024'], 'HEAD')
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+
+    def test_bodiless_responses(self):
+        for code in ('204 No Content', '304 Not Modified'):
+            self.response(code, ['Content-Type: text/html'])
+            self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.response('200 OK', ['Content-Length: 0'])
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+
+    def test_close_delimited_response(self):
+        self.response('200 OK', ['Content-Type: text/html'])
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_HEADERS_COMPLETE)
+        self.parser.parse('<html>')
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_RCVING_BODY)
+        self.parser.eof()
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.assertEqual(self.parser.body, '<html>')
+
+    def test_transfer_encoding_overrides_content_length(self):
+        self.response('200 OK', ['Transfer-Encoding: gzip, chunked', 'Content-Length: 2'])
+        self.parser.parse('2\r\nab\r\n')
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_RCVING_BODY)
+        self.parser.parse('0\r\n\r\n')
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.assertEqual(self.parser.body, 'ab')
+
+    def test_interim_response(self):
+        self.response('100 Continue', [])
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_INITIALIZED)
+        self.parser.parse(CRLF.join(['HTTP/1.1 201 Created', 'Content-Length: 2', CRLF]) + 'ok')
+        self.assertEqual(self.parser.code, '201')
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.assertEqual(self.parser.interim, 'HTTP/1.1 100 Continue\r\n\r\n')
+
+    def test_decoded_body(self):
+        self.response('200 OK', ['Transfer-Encoding: chunked'])
+        self.parser.parse('2\r\nab\r\n3\r\nc')
+        self.assertEqual(self.parser.decoded_body(), 'ab')
+        self.parser.parse('de\r\n0\r\n\r\n')
+        self.assertEqual(self.parser.decoded_body(), 'abcde')
+
+    def test_request_without_body(self):
+        self.parser.parse(CRLF.join(["DELETE http://localhost/file HTTP/1.1", "Host: localhost", CRLF]))
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.parser = HttpParser()
+        self.parser.parse(CRLF.join(["POST http://localhost/ HTTP/1.1", "Content-Length: 0", CRLF]))
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+
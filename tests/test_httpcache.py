@@ -0,0 +1,122 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from appurify import httpcache
+from appurify.httpcache import HttpCache, cache_control
+from appurify.tunnel import HttpParser, HTTP_RESPONSE_PARSER, CRLF
+
+def request(path='/a.css', headers=()):
+    parser = HttpParser()
+    parser.parse(CRLF.join(['GET http://example.com%s HTTP/1.1' % path, 'Host: example.com'] + list(headers) + [CRLF]))
+    return parser
+
+def response(req, headers, body='body', code='200 OK'):
+    parser = HttpParser(HTTP_RESPONSE_PARSER, req)
+    parser.parse(CRLF.join(['HTTP/1.1 %s' % code, 'Content-Length: %d' % len(body)] + list(headers) + [CRLF]) + body)
+    return parser
+
+class TestHttpCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = HttpCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_cache_control(self):
+        self.assertEqual(cache_control('public, max-age=60, no-cache="Set-Cookie"'),
+                         {'public': None, 'max-age': '60', 'no-cache': 'Set-Cookie'})
+
+    def test_fresh_hit(self):
+        req = request()
+        self.assertEqual(self.cache.lookup(req), (None, None))
+        self.assertTrue(self.cache.store(req, response(req, ['Cache-Control: max-age=60', 'Connection: close'])))
+        hits, saved = httpcache.cache_hits.value, httpcache.cache_bytes_saved.value
+        entry, body = self.cache.lookup(request())
+        self.assertEqual(body, 'body')
+        self.assertEqual(httpcache.cache_hits.value, hits + 1)
+        self.assertEqual(httpcache.cache_bytes_saved.value, saved + 4)
+        head = entry.head(time.time())
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue('Content-Length: 4\r\n' in head and 'Age: 0\r\n' in head)
+        self.assertEqual(head.count('Connection'), 1)
+
+    def test_not_stored(self):
+        req = request()
+        for headers in (['Cache-Control: no-store, max-age=60'], ['Cache-Control: private, max-age=60'],
+                        ['Cache-Control: max-age=60', 'Set-Cookie: a=b'], ['Cache-Control: max-age=60', 'Vary: *'], []):
+            self.assertEqual(self.cache.store(req, response(req, headers)), None)
+        self.assertEqual(self.cache.store(req, response(req, ['Cache-Control: max-age=60'], code='404 Not Found')), None)
+        auth = request(headers=['Authorization: Basic eDp5'])
+        self.assertEqual(self.cache.store(auth, response(auth, ['Cache-Control: max-age=60'])), None)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_bypass(self):
+        req = request()
+        self.cache.store(req, response(req, ['Cache-Control: max-age=60']))
+        for headers in (['Range: bytes=0-1'], ['If-None-Match: "x"'], ['Cache-Control: no-store']):
+            self.assertEqual(self.cache.lookup(request(headers=headers)), (None, None))
+
+    def test_revalidate(self):
+        req = request()
+        self.cache.store(req, response(req, ['Cache-Control: max-age=0', 'ETag: "v1"', 'Last-Modified: Mon, 01 Jan 2024 00:00:00 GMT']))
+        entry, body = self.cache.lookup(request())
+        self.assertEqual(body, None)
+        self.assertEqual(entry.validators(), [('If-None-Match', '"v1"'), ('If-Modified-Since', 'Mon, 01 Jan 2024 00:00:00 GMT')])
+        not_modified = HttpParser(HTTP_RESPONSE_PARSER, req)
+        not_modified.parse(CRLF.join(['HTTP/1.1 304 Not Modified', 'Cache-Control: max-age=60', 'ETag: "v1"', CRLF]))
+        self.assertEqual(self.cache.refresh(entry, not_modified), 'body')
+        self.assertEqual(self.cache.lookup(request())[1], 'body')
+        self.assertEqual(len([h for h in entry.headers if h[0] == 'Cache-Control']), 1)
+
+    def test_request_no_cache(self):
+        req = request()
+        self.cache.store(req, response(req, ['Cache-Control: max-age=60', 'ETag: "v1"']))
+        entry, body = self.cache.lookup(request(headers=['Cache-Control: no-cache']))
+        self.assertTrue(entry and body is None)
+
+    def test_vary(self):
+        gzip = request(headers=['Accept-Encoding: gzip'])
+        self.cache.store(gzip, response(gzip, ['Cache-Control: max-age=60', 'Vary: Accept-Encoding']))
+        self.assertEqual(self.cache.lookup(request(headers=['Accept-Encoding: gzip']))[1], 'body')
+        self.assertEqual(self.cache.lookup(request()), (None, None))
+
+    def test_heuristic_freshness(self):
+        req = request()
+        now = time.time()
+        date = 'Date: %s' % httpcache.email.utils.formatdate(now, usegmt=True)
+        modified = 'Last-Modified: %s' % httpcache.email.utils.formatdate(now - 1000, usegmt=True)
+        entry = self.cache.store(req, response(req, [date, modified]))
+        self.assertTrue(99 <= entry.lifetime <= 101)
+
+    def test_lru_eviction(self):
+        cache = HttpCache(self.path, max_bytes=10)
+        for path in ('/a', '/b'):
+            req = request(path)
+            cache.store(req, response(req, ['Cache-Control: max-age=60'], body='12345'))
+        cache.lookup(request('/a'))
+        req = request('/c')
+        cache.store(req, response(req, ['Cache-Control: max-age=60'], body='12345'))
+        self.assertEqual([key[-2:] for key in cache.entries], ['/a', '/c'])
+        self.assertEqual(cache.size, 10)
+        self.assertEqual(len(os.listdir(self.path)), 4)
+        self.assertEqual(cache.store(req, response(req, ['Cache-Control: max-age=60'], body='x' * 11)), None)
+
+    def test_reload(self):
+        req = request()
+        self.cache.store(req, response(req, ['Cache-Control: max-age=60', 'Content-Type: text/css']))
+        cache = HttpCache(self.path)
+        self.assertEqual(cache.size, 4)
+        entry, body = cache.lookup(request())
+        self.assertEqual(body, 'body')
+        self.assertTrue(isinstance(entry.head(time.time()) + '\xff', str))
+
+    def test_missing_body(self):
+        req = request()
+        entry = self.cache.store(req, response(req, ['Cache-Control: max-age=60']))
+        os.remove(self.cache.filename(entry.key, 'body'))
+        self.assertEqual(self.cache.lookup(request()), (None, None))
+        self.assertEqual(self.cache.entries, {})
@@ -0,0 +1,86 @@
+import urllib2
+import unittest
+from appurify.metrics import Registry, MetricsServer, difference
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter('requests_total', 'Requests')
+        counter.inc()
+        counter.inc(4)
+        gauge = self.registry.gauge('threads', 'Threads')
+        gauge.inc(3)
+        gauge.dec()
+        self.assertTrue(self.registry.counter('requests_total') is counter)
+        text = self.registry.render()
+        self.assertTrue('# TYPE requests_total counter\nrequests_total 5' in text)
+        self.assertTrue('# TYPE threads gauge\nthreads 2' in text)
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        text = self.registry.render()
+        self.assertTrue('latency_seconds_bucket{le="0.1"} 2' in text)
+        self.assertTrue('latency_seconds_bucket{le="1"} 3' in text)
+        self.assertTrue('latency_seconds_bucket{le="+Inf"} 4' in text)
+        self.assertTrue('latency_seconds_count 4' in text)
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.99), float('inf'))
+        self.assertTrue('p50=0.1' in histogram.summary())
+
+    def test_labeled_counter(self):
+        counter = self.registry.labeled_counter('gzip_bytes_total', 'Bytes', label='content_type')
+        counter.inc('text/html', 10)
+        counter.inc('application/json', 5)
+        counter.inc('text/html')
+        self.assertEqual(counter.get('text/html'), 11)
+        text = self.registry.render()
+        self.assertTrue('gzip_bytes_total{content_type="application/json"} 5\ngzip_bytes_total{content_type="text/html"} 11' in text)
+        self.assertEqual(counter.summary(), 'gzip_bytes_total=16')
+
+    def test_merge(self):
+        # what a worker process reports is added to the registry of the tunnel process
+        worker = Registry()
+        worker.counter('requests_total').inc(3)
+        worker.gauge('threads').inc(2)
+        worker.labeled_counter('bytes_total').inc('text/html', 10)
+        worker.histogram('latency_seconds', buckets=(0.1, 1)).observe(0.5)
+        first = worker.state()
+        self.registry.counter('requests_total').inc()
+        self.registry.gauge('threads')
+        self.registry.labeled_counter('bytes_total')
+        self.registry.histogram('latency_seconds', buckets=(0.1, 1))
+        self.registry.merge(difference(first, {}))
+        worker.counter('requests_total').inc()
+        worker.gauge('threads').dec(2)
+        self.assertEqual(difference(worker.state(), first), {'requests_total': {'': 1}, 'threads': {'': -2}})
+        self.registry.merge(difference(worker.state(), first))
+        self.assertEqual(self.registry.get('requests_total').value, 5)
+        self.assertEqual(self.registry.get('threads').total(), 0)
+        # a gauge set here keeps what workers reported apart
+        self.registry.merge({'threads': {'': 3}})
+        self.registry.get('threads').set(1)
+        self.assertTrue('threads 4' in self.registry.render())
+        self.assertEqual(self.registry.get('bytes_total').get('text/html'), 10)
+        self.assertEqual(self.registry.get('latency_seconds').count, 1)
+        self.assertEqual(self.registry.get('latency_seconds').quantile(0.5), 1)
+        self.registry.reset()
+        self.assertEqual(self.registry.get('requests_total').value, 0)
+        self.assertEqual(self.registry.get('latency_seconds').count, 0)
+
+    def test_empty_histogram_quantile(self):
+        self.assertEqual(self.registry.histogram('empty').quantile(0.5), None)
+
+    def test_metrics_server(self):
+        self.registry.counter('served_total').inc(7)
+        server = MetricsServer(0, registry=self.registry)
+        server.start()
+        try:
+            body = urllib2.urlopen('http://127.0.0.1:%s/metrics' % server.port).read()
+            self.assertTrue('served_total 7' in body)
+        finally:
+            server.stop()
@@ -0,0 +1,92 @@
+import time
+import socket
+import unittest
+from appurify.poller import poller, Poller, SelectPoller, PollPoller, EpollPoller, POLL_READ, POLL_WRITE
+
+class PollerTests(object):
+
+    def setUp(self):
+        self.poller = self.create()
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.poller.close()
+        self.a.close()
+        self.b.close()
+
+    def test_read(self):
+        self.poller.register(self.a, POLL_READ)
+        self.assertEqual(self.poller.poll(0), [])
+        self.b.send('x')
+        self.assertEqual(self.poller.poll(1), [(self.a, POLL_READ)])
+
+    def test_modify(self):
+        self.poller.register(self.a, POLL_READ)
+        self.assertEqual(self.poller.poll(0), [])
+        self.poller.watch(self.a, POLL_READ | POLL_WRITE)
+        self.assertEqual(self.poller.poll(1), [(self.a, POLL_WRITE)])
+        self.b.send('x')
+        self.assertEqual(self.poller.poll(1), [(self.a, POLL_READ | POLL_WRITE)])
+        self.poller.watch(self.a, 0)
+        self.assertEqual(self.poller.poll(0), [])
+
+    def test_unregister(self):
+        self.poller.register(self.a, POLL_WRITE)
+        self.assertTrue(self.a in self.poller)
+        self.poller.unregister(self.a)
+        self.assertFalse(self.a in self.poller)
+        self.assertEqual(self.poller.poll(0), [])
+
+    def test_unregister_closed(self):
+        self.poller.register(self.a, POLL_READ)
+        self.a.close()
+        self.poller.unregister(self.a)
+        self.assertFalse(self.a in self.poller)
+
+    def test_hang_up_is_readable(self):
+        self.poller.register(self.a, POLL_READ)
+        self.b.close()
+        self.assertEqual(self.poller.poll(1), [(self.a, POLL_READ)])
+        self.assertEqual(self.a.recv(1), '')
+
+    def test_hang_up_without_interest(self):
+        if isinstance(self.poller, SelectPoller):
+            self.skipTest('select only reports what is asked for')
+        # pending while interest is 0, dropping it would make every poll return at once
+        self.poller.register(self.a, 0)
+        self.b.close()
+        self.assertEqual(self.poller.poll(1), [(self.a, POLL_READ)])
+        # reported once, then left alone until it is watched again
+        started = time.time()
+        self.assertEqual(self.poller.poll(0.1), [])
+        self.assertTrue(time.time() - started >= 0.05)
+        self.poller.watch(self.a, POLL_READ)
+        self.assertEqual(self.poller.poll(1), [(self.a, POLL_READ)])
+        self.poller.unregister(self.a)
+        self.assertFalse(self.a in self.poller)
+
+class TestSelectPoller(PollerTests, unittest.TestCase):
+
+    def create(self):
+        return SelectPoller()
+
+class TestPollPoller(PollerTests, unittest.TestCase):
+
+    def create(self):
+        if not PollPoller.READ:
+            self.skipTest('poll not available')
+        return PollPoller()
+
+class TestEpollPoller(PollerTests, unittest.TestCase):
+
+    def create(self):
+        if not EpollPoller.READ:
+            self.skipTest('epoll not available')
+        return EpollPoller()
+
+class TestFactory(unittest.TestCase):
+
+    def test_poller(self):
+        p = poller()
+        self.assertTrue(isinstance(p, Poller))
+        p.close()
@@ -1,7 +1,19 @@
+import os
+import mock
+import zlib
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 import unittest
-from appurify.tunnel import Proxy, HttpParser
+from appurify.tunnel import Proxy, HttpParser, ChunkParser, Pipe, BufferPool, WorkerPool, IdleReaper, SendQueue, SEND_COALESCE_BYTES
+from appurify.poller import poller, POLL_READ, POLL_WRITE
+from appurify.scheduler import FairScheduler
+from appurify.httpcache import HttpCache
 from appurify.tunnel import (CRLF, HTTP_RESPONSE_PARSER, HTTP_PARSER_STATE_COMPLETE,
-                             ProxyConnectFailed, HTTP_PARSER_STATE_HEADERS_COMPLETE)
+                             ProxyConnectFailed, ProxyConnectTimeout, HTTP_PARSER_STATE_HEADERS_COMPLETE)
 
 class Client(object):
 
@@ -49,7 +61,7 @@ class TestProxy(unittest.TestCase):
         self.assertEqual(self.proxy.port, 80)
 
         self.proxy.flush_server_buffer()
-        self.assertEqual(self.proxy.buffer['server'], '')
+        self.assertEqual(len(self.proxy.buffer['server']), 0)
 
         data = self.proxy.recv_from_server()
         while data:
@@ -90,7 +102,7 @@ class TestProxy(unittest.TestCase):
         ])
         self.proxy.process_request(self.proxy.recv_from_client())
         self.proxy.flush_server_buffer()
-        self.assertEqual(self.proxy.buffer['server'], '')
+        self.assertEqual(len(self.proxy.buffer['server']), 0)
 
         parser = HttpParser(HTTP_RESPONSE_PARSER)
         data = self.proxy.recv_from_server()
@@ -111,3 +123,684 @@ class TestProxy(unittest.TestCase):
                 "Host: unknown.domain",
                 CRLF
             ]))
+
+    @mock.patch('appurify.tunnel.connect')
+    def test_proxy_connection_timeout(self, connect):
+        connect.side_effect = socket.timeout('timed out')
+        with self.assertRaises(ProxyConnectTimeout):
+            self.proxy.process_request(CRLF.join([
+                "GET http://localhost:8899/ HTTP/1.1",
+                "Host: localhost:8899",
+                CRLF
+            ]))
+
+    def test_gateway_timeout(self):
+        self.proxy.client.buffer['in'] = ''
+        self.proxy.gateway_timeout(socket.timeout('timed out'))
+        self.assertTrue(self.proxy.client.buffer['in'].startswith('HTTP/1.1 504 Gateway Timeout'))
+        self.assertEqual(self.proxy.access_record()['status'], 504)
+
+    def test_send_ready(self):
+        chan = mock.Mock(spec=['send_ready', 'fileno'])
+        chan.send_ready.return_value = False
+        self.assertFalse(self.proxy.writable(chan, {chan: POLL_WRITE}))
+        chan.send_ready.return_value = True
+        self.assertTrue(self.proxy.writable(chan, {}))
+        self.assertEqual(self.proxy.poll_timeout(chan), 0.01)
+
+        sock = Channel(None)
+        self.assertTrue(self.proxy.writable(sock, {sock: POLL_READ | POLL_WRITE}))
+        self.assertFalse(self.proxy.writable(sock, {sock: POLL_READ}))
+        self.assertEqual(self.proxy.poll_timeout(sock), 1)
+        self.assertEqual(self.proxy.poll_timeout(None), 1)
+
+    def test_access_record(self):
+        self.proxy.client.buffer['out'] += CRLF.join([
+            "GET http://localhost:8899/path?a=b HTTP/1.1",
+            "Host: localhost:8899",
+            CRLF
+        ])
+        self.proxy.request.parse(self.proxy.recv_from_client())
+        record = self.proxy.access_record()
+        self.assertEqual(record['method'], "GET")
+        self.assertEqual(record['host'], "localhost")
+        self.assertEqual(record['port'], 8899)
+        self.assertEqual(record['url'], "/path?a=b")
+        self.assertEqual(record['bytes_in'], len(self.proxy.request.raw))
+        self.assertEqual(record['bytes_out'], 0)
+        self.assertEqual(record['connect_time'], None)
+
+class Channel(object):
+    """socket wrapper without recv_into, behaves like a paramiko channel"""
+
+    origin_addr = ('127.0.0.1', 64001)
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def recv(self, bytes):
+        return self.sock.recv(bytes)
+
+    def send(self, data):
+        assert isinstance(data, str)
+        return self.sock.send(data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+class TestPipe(unittest.TestCase):
+
+    def setUp(self):
+        self.src, self.src_peer = socket.socketpair()
+        self.dst, self.dst_peer = socket.socketpair()
+
+    def tearDown(self):
+        for sock in (self.src, self.src_peer, self.dst, self.dst_peer):
+            sock.close()
+
+    def relay(self, pipe, data):
+        self.src_peer.sendall(data)
+        self.assertEqual(pipe.fill(), len(data))
+        while pipe.pending():
+            pipe.drain()
+        return self.dst_peer.recv(len(data))
+
+    def test_zero_copy_between_sockets(self):
+        pipe = Pipe(self.src, self.dst, 16)
+        self.assertTrue(pipe.zero_copy_recv)
+        self.assertTrue(pipe.zero_copy_send)
+        self.assertEqual(self.relay(pipe, 'hello'), 'hello')
+        self.assertEqual(self.relay(pipe, 'world!'), 'world!')
+        self.assertEqual(pipe.buf[:6], bytearray('world!'))
+
+    def test_channel_endpoints(self):
+        pipe = Pipe(self.src, Channel(self.dst), 16)
+        self.assertFalse(pipe.zero_copy_send)
+        self.assertEqual(self.relay(pipe, 'to channel'), 'to channel')
+
+        pipe = Pipe(Channel(self.src), self.dst, 16)
+        self.assertFalse(pipe.zero_copy_recv)
+        self.assertEqual(self.relay(pipe, 'from channel'), 'from channel')
+
+    def test_pooled_buffer(self):
+        buf = bytearray(8)
+        pipe = Pipe(self.src, self.dst, buf=buf)
+        self.assertEqual(pipe.size, 8)
+        self.assertEqual(self.relay(pipe, 'pooled'), 'pooled')
+        self.assertEqual(buf[:6], bytearray('pooled'))
+
+class Sink(object):
+    """socket accepting at most limit bytes per send"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.sends = []
+
+    def send(self, data):
+        self.sends.append(data)
+        return min(len(data), self.limit)
+
+    def recv_into(self, buf):
+        pass
+
+class TestSendQueue(unittest.TestCase):
+
+    def test_coalesce(self):
+        queue = SendQueue()
+        queue.extend(['head\r\n\r\n', '', 'body'])
+        self.assertEqual(len(queue), 12)
+        sink = Sink(100)
+        self.assertEqual(queue.send(sink), 12)
+        self.assertEqual(sink.sends, ['head\r\n\r\nbody'])
+        self.assertEqual(len(queue), 0)
+
+    def test_large_part_not_copied(self):
+        head, body = 'head\r\n\r\n', 'x' * (SEND_COALESCE_BYTES * 4)
+        queue = SendQueue()
+        queue.extend([head, body])
+        sink = Sink(SEND_COALESCE_BYTES)
+        queue.send(sink)
+        self.assertEqual(sink.sends[0], head + body[:SEND_COALESCE_BYTES - len(head)])
+        queue.send(sink)
+        self.assertTrue(isinstance(sink.sends[1], memoryview))
+        while len(queue): queue.send(sink)
+        sent = [data.tobytes() if isinstance(data, memoryview) else data for data in sink.sends]
+        self.assertEqual(''.join([data[:SEND_COALESCE_BYTES] for data in sent]), head + body)
+
+    def test_channel_gets_strings(self):
+        queue = SendQueue()
+        queue.append('x' * (SEND_COALESCE_BYTES * 2))
+        chan = Channel(None)
+        chan.send = lambda data: SEND_COALESCE_BYTES if isinstance(data, str) else 0
+        queue.send(chan)
+        self.assertEqual(queue.send(chan), SEND_COALESCE_BYTES)
+        self.assertEqual(len(queue), 0)
+
+class TestBufferPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = BufferPool(16)
+        a = pool.acquire()
+        self.assertEqual(len(a), 16)
+        pool.release(a)
+        self.assertTrue(pool.acquire() is a)
+        self.assertEqual(pool.allocated, 1)
+
+    def test_high_water(self):
+        pool = BufferPool(16)
+        bufs = [pool.acquire() for i in range(3)]
+        for buf in bufs: pool.release(buf)
+        pool.acquire()
+        self.assertEqual(pool.in_use, 1)
+        self.assertEqual(pool.high_water, 3)
+        self.assertEqual(pool.allocated, 3)
+
+    def test_max_free(self):
+        pool = BufferPool(16, max_free=1)
+        bufs = [pool.acquire() for i in range(3)]
+        for buf in bufs: pool.release(buf)
+        self.assertEqual(len(pool.free), 1)
+        pool.release(bytearray(8))
+        self.assertEqual(len(pool.free), 1)
+
+class Idle(object):
+
+    def __init__(self):
+        self.reaped = False
+
+    def reap(self):
+        self.reaped = True
+
+class TestIdleReaper(unittest.TestCase):
+
+    def setUp(self):
+        # ticks of an hour, the reaper thread never advances the wheel during a test
+        self.reaper = IdleReaper(3 * 3600000, 3600000)
+        self.conn = Idle()
+        self.reaper.add(self.conn)
+
+    def test_reap(self):
+        self.assertEqual(self.reaper.advance(3), 0)
+        self.assertEqual(self.reaper.advance(1), 1)
+        self.assertTrue(self.conn.reaped)
+        self.assertEqual(self.reaper.reaped, 1)
+        self.assertEqual(self.reaper.slot, dict())
+
+    def test_activity(self):
+        self.reaper.advance(2)
+        self.conn.last_active = self.reaper.ticks
+        self.assertEqual(self.reaper.advance(3), 0)
+        self.assertEqual(self.reaper.idle_for(self.conn), 3 * 3600)
+        self.assertEqual(self.reaper.advance(1), 1)
+
+    def test_discard(self):
+        self.reaper.discard(self.conn)
+        self.assertEqual(self.reaper.advance(10), 0)
+        self.assertFalse(self.conn.reaped)
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.patch = mock.patch.object(Proxy, 'process', side_effect=self.process)
+        self.patch.start()
+        self.devices = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def tearDown(self):
+        self.release.set()
+        self.patch.stop()
+        for device in self.devices: device.close()
+
+    def process(self):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        self.started.set()
+        self.release.wait(5)
+        with self.lock: self.running -= 1
+
+    def channel(self):
+        channel, device = socket.socketpair()
+        device.settimeout(5)
+        self.devices.append(device)
+        return Channel(channel), device
+
+    def test_saturated(self):
+        pool = WorkerPool(size=1, queue_size=1)
+        busy, busy_device = self.channel()
+        self.assertTrue(pool.submit(busy))
+        self.assertTrue(self.started.wait(5))
+        queued, queued_device = self.channel()
+        self.assertTrue(pool.submit(queued))
+        rejected, rejected_device = self.channel()
+        self.assertFalse(pool.submit(rejected))
+        self.assertTrue(rejected_device.recv(1024).startswith('HTTP/1.1 503 Service Unavailable'))
+        self.assertEqual(pool.workers, 1)
+
+        self.release.set()
+        self.assertEqual(busy_device.recv(1024), '')
+        self.assertEqual(queued_device.recv(1024), '')
+
+    def test_queue_timeout(self):
+        pool = WorkerPool(size=1, queue_size=1, queue_timeout=10)
+        busy, busy_device = self.channel()
+        pool.submit(busy)
+        self.assertTrue(self.started.wait(5))
+        queued, queued_device = self.channel()
+        pool.submit(queued)
+        time.sleep(0.05)
+        self.release.set()
+        self.assertTrue(queued_device.recv(1024).startswith('HTTP/1.1 503 Service Unavailable'))
+
+    def test_workers_started_on_demand(self):
+        self.release.set()
+        pool = WorkerPool(size=4)
+        for i in range(3):
+            channel, device = self.channel()
+            pool.submit(channel)
+            self.assertEqual(device.recv(1024), '')
+        self.assertTrue(pool.workers < 3)
+
+    def test_burst_runs_concurrently(self):
+        self.release.set()
+        pool = WorkerPool(size=10)
+        channel, device = self.channel()
+        pool.submit(channel)
+        self.assertEqual(device.recv(1024), '')
+        for i in range(100):
+            if pool.idle == 1: break
+            time.sleep(0.01)
+        self.assertEqual(pool.workers, 1)
+        # the one idle worker must not take the whole burst in turn
+        self.release.clear()
+        self.peak = 0
+        for i in range(5):
+            pool.submit(self.channel()[0])
+        for i in range(100):
+            if self.peak == 5: break
+            time.sleep(0.01)
+        self.release.set()
+        self.assertEqual(self.peak, 5)
+        self.assertEqual(pool.workers, 5)
+
+class TestConnectRelay(unittest.TestCase):
+
+    def setUp(self):
+        socket.setdefaulttimeout(5)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.echo = threading.Thread(target=self.serve_echo)
+        self.echo.setDaemon(True)
+        self.echo.start()
+
+    def tearDown(self):
+        socket.setdefaulttimeout(None)
+        self.listener.close()
+
+    def serve_echo(self):
+        conn, addr = self.listener.accept()
+        while True:
+            data = conn.recv(65536)
+            if not data: break
+            conn.sendall(data)
+        conn.close()
+
+    def test_connect_relay(self):
+        in_use = Proxy.buffer_pool.in_use
+        channel, device = socket.socketpair()
+        proxy = Proxy(Channel(channel))
+        proxy.setDaemon(True)
+        proxy.start()
+
+        port = self.listener.getsockname()[1]
+        device.sendall(CRLF.join(["CONNECT 127.0.0.1:%d HTTP/1.1" % port, "Host: 127.0.0.1:%d" % port, CRLF]))
+        established = ''
+        while not established.endswith(CRLF * 2):
+            established += device.recv(1024)
+        self.assertTrue(established.startswith('HTTP/1.1 200 Connection established'))
+
+        payload = 'x' * 16384
+        for i in range(10):
+            device.sendall(payload)
+            received = ''
+            while len(received) < len(payload):
+                received += device.recv(65536)
+            self.assertEqual(received, payload)
+
+        device.close()
+        proxy.join(5)
+        self.assertFalse(proxy.isAlive())
+        self.assertEqual(proxy.bytes_in - len(proxy.request.raw), 10 * len(payload))
+        self.assertEqual(proxy.bytes_out - len(proxy.connection_established_pkt), 10 * len(payload))
+        self.assertEqual(proxy.buffers, dict())
+        self.assertEqual(Proxy.buffer_pool.in_use, in_use)
+
+    def test_connect_relay_scheduled(self):
+        scheduler = FairScheduler(quantum=4096)
+        channel, device = socket.socketpair()
+        with mock.patch.object(Proxy, 'scheduler', scheduler):
+            proxy = Proxy(Channel(channel))
+            proxy.setDaemon(True)
+            proxy.start()
+            port = self.listener.getsockname()[1]
+            device.sendall(CRLF.join(["CONNECT 127.0.0.1:%d HTTP/1.1" % port, "Host: 127.0.0.1:%d" % port, CRLF]))
+            established = ''
+            while not established.endswith(CRLF * 2):
+                established += device.recv(1024)
+
+            payload = 'x' * 16384
+            device.sendall(payload)
+            received = ''
+            while len(received) < len(payload):
+                received += device.recv(65536)
+            self.assertEqual(received, payload)
+            device.close()
+            proxy.join(5)
+        self.assertFalse(proxy.isAlive())
+        self.assertEqual(proxy.flow.sent, len(proxy.connection_established_pkt) + len(payload))
+
+    def test_idle_reaped(self):
+        reaper = IdleReaper(3600000, 3600000)
+        channel, device = socket.socketpair()
+        with mock.patch.object(Proxy, 'idle_reaper', reaper):
+            proxy = Proxy(Channel(channel))
+            proxy.setDaemon(True)
+            proxy.start()
+            port = self.listener.getsockname()[1]
+            device.sendall(CRLF.join(["CONNECT 127.0.0.1:%d HTTP/1.1" % port, "Host: 127.0.0.1:%d" % port, CRLF]))
+            established = ''
+            while not established.endswith(CRLF * 2):
+                established += device.recv(1024)
+
+            self.assertEqual(reaper.advance(2), 1)
+            proxy.join(1)
+            self.assertFalse(proxy.isAlive())
+            self.assertEqual(device.recv(1024), '')
+        device.close()
+
+    def test_server_reset_while_device_behind(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        established = threading.Event()
+        def flood():
+            conn, addr = server.accept()
+            established.wait(5)
+            conn.setblocking(0)
+            try:
+                while True: conn.send('x' * 65536)
+            except socket.error:
+                pass
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            conn.close()
+        thread = threading.Thread(target=flood)
+        thread.setDaemon(True)
+        thread.start()
+
+        polls = []
+        def counting_poller():
+            instance = poller()
+            poll = instance.poll
+            def counted(timeout):
+                polls.append(timeout)
+                return poll(timeout)
+            instance.poll = counted
+            return instance
+        channel, device = socket.socketpair()
+        with mock.patch('appurify.tunnel.poller', counting_poller):
+            proxy = Proxy(Channel(channel))
+            proxy.setDaemon(True)
+            proxy.start()
+            port = server.getsockname()[1]
+            device.sendall(CRLF.join(["CONNECT 127.0.0.1:%d HTTP/1.1" % port, "Host: 127.0.0.1:%d" % port, CRLF]))
+            response = ''
+            while not response.endswith(CRLF * 2):
+                response += device.recv(1)
+            established.set()
+            thread.join(5)
+            # the hung up server is not polled over and over while the device is not reading
+            time.sleep(0.05)
+            del polls[:]
+            time.sleep(0.2)
+            self.assertTrue(len(polls) < 10)
+            device.close()
+            proxy.join(5)
+        self.assertFalse(proxy.isAlive())
+        server.close()
+
+class TestStreamingUpload(unittest.TestCase):
+
+    def setUp(self):
+        socket.setdefaulttimeout(5)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.headers_seen = threading.Event()
+        self.received = []
+        self.origin = threading.Thread(target=self.serve_upload)
+        self.origin.setDaemon(True)
+        self.origin.start()
+
+    def tearDown(self):
+        socket.setdefaulttimeout(None)
+        self.listener.close()
+
+    def serve_upload(self):
+        conn, addr = self.listener.accept()
+        data = ''
+        while CRLF * 2 not in data:
+            data += conn.recv(65536)
+        self.headers_seen.set()
+        head, body = data.split(CRLF * 2, 1)
+        length = int([line.split(':')[1] for line in head.split(CRLF) if line.lower().startswith('content-length')][0])
+        while len(body) < length:
+            body += conn.recv(65536)
+        self.received.append((head, body))
+        conn.sendall(CRLF.join(['HTTP/1.1 201 Created', 'Content-Length: 2', CRLF]) + 'ok')
+        conn.close()
+
+    def test_put_streamed(self):
+        body = 'x' * (1024 * 1024)
+        channel, device = socket.socketpair()
+        proxy = Proxy(Channel(channel))
+        proxy.setDaemon(True)
+        proxy.start()
+
+        device.sendall(CRLF.join([
+            "PUT http://127.0.0.1:%d/upload HTTP/1.1" % self.port,
+            "Host: 127.0.0.1:%d" % self.port,
+            "Content-Length: %d" % len(body),
+            CRLF
+        ]) + body[:1024])
+        self.assertTrue(self.headers_seen.wait(2))
+        self.assertEqual(self.received, [])
+        device.sendall(body[1024:])
+
+        response = ''
+        while not response.endswith('ok'):
+            response += device.recv(1024)
+        self.assertTrue(response.startswith('HTTP/1.1 201 Created'))
+        head, received = self.received[0]
+        self.assertTrue(head.startswith('PUT /upload HTTP/1.1'))
+        self.assertEqual(received, body)
+        proxy.join(5)
+        self.assertFalse(proxy.isAlive())
+        self.assertEqual(proxy.request.body, body[:1024])
+        device.close()
+
+class TestMessageLength(unittest.TestCase):
+
+    def setUp(self):
+        socket.setdefaulttimeout(5)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.done.set()
+        socket.setdefaulttimeout(None)
+        self.listener.close()
+
+    def serve(self, response, close):
+        conn, addr = self.listener.accept()
+        data = ''
+        while CRLF * 2 not in data:
+            data += conn.recv(65536)
+        conn.sendall(response)
+        if not close: self.done.wait(5)
+        conn.close()
+
+    def proxy(self, method, response, close=False, headers=(), version='HTTP/1.1'):
+        origin = threading.Thread(target=self.serve, args=(response, close))
+        origin.setDaemon(True)
+        origin.start()
+        channel, device = socket.socketpair()
+        proxy = Proxy(Channel(channel))
+        proxy.setDaemon(True)
+        proxy.start()
+        device.sendall(CRLF.join(["%s http://127.0.0.1:%d/ %s" % (method, self.port, version), "Host: 127.0.0.1"] + list(headers) + [CRLF]))
+        received = ''
+        while True:
+            data = device.recv(65536)
+            if not data: break
+            received += data
+        proxy.join(1)
+        self.assertFalse(proxy.isAlive())
+        device.close()
+        return received
+
+    def test_head(self):
+        # the origin keeps the connection open, the proxy must not wait for it
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Content-Length: 1024', CRLF])
+        self.assertEqual(self.proxy('HEAD', response), response)
+
+    def test_no_content(self):
+        response = CRLF.join(['HTTP/1.1 204 No Content', 'Content-Type: text/plain', CRLF])
+        self.assertEqual(self.proxy('GET', response), response)
+
+    def test_close_delimited(self):
+        response = CRLF.join(['HTTP/1.0 200 OK', 'Content-Type: text/plain', CRLF]) + 'x' * (1024 * 1024)
+        self.assertEqual(self.proxy('GET', response, close=True), response)
+
+    def test_http_path_unpooled(self):
+        # pooled buffers are for relay pipes, http reads are parsed as strings
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Content-Length: 65536', CRLF]) + 'x' * 65536
+        with mock.patch.object(Proxy.buffer_pool, 'acquire') as acquire:
+            self.assertEqual(self.proxy('GET', response), response)
+        self.assertFalse(acquire.called)
+
+class TestHttpCacheProxy(TestMessageLength):
+
+    def setUp(self):
+        super(TestHttpCacheProxy, self).setUp()
+        self.listener.listen(5)
+        self.path = tempfile.mkdtemp()
+        Proxy.http_cache = HttpCache(self.path)
+        self.requests = []
+
+    def tearDown(self):
+        Proxy.http_cache = None
+        shutil.rmtree(self.path)
+        super(TestHttpCacheProxy, self).tearDown()
+
+    def serve(self, response, close):
+        conn, addr = self.listener.accept()
+        data = ''
+        while CRLF * 2 not in data:
+            data += conn.recv(65536)
+        self.requests.append(data)
+        conn.sendall(response)
+        conn.close()
+
+    def test_fresh_hit(self):
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Cache-Control: max-age=60', 'Content-Length: 5', CRLF]) + 'hello'
+        self.assertEqual(self.proxy('GET', response), response)
+        # nothing listens for a second upstream request
+        channel, device = socket.socketpair()
+        proxy = Proxy(Channel(channel))
+        proxy.start()
+        device.sendall(CRLF.join(["GET http://127.0.0.1:%d/ HTTP/1.1" % self.port, "Host: 127.0.0.1", CRLF]))
+        proxy.join(1)
+        cached = device.recv(65536)
+        device.close()
+        self.assertTrue(cached.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(cached.endswith('\r\n\r\nhello'))
+        self.assertTrue(proxy.from_cache)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_not_modified(self):
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Cache-Control: no-cache', 'ETag: "v1"', 'Content-Length: 5', CRLF]) + 'hello'
+        self.assertEqual(self.proxy('GET', response), response)
+        not_modified = CRLF.join(['HTTP/1.1 304 Not Modified', 'ETag: "v1"', CRLF])
+        cached = self.proxy('GET', not_modified)
+        self.assertTrue('If-None-Match: "v1"' in self.requests[1])
+        self.assertTrue(cached.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(cached.endswith('hello'))
+
+    def test_not_modified_body_gone(self):
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Cache-Control: no-cache', 'ETag: "v1"', 'Content-Length: 5', CRLF]) + 'hello'
+        self.proxy('GET', response)
+        key = Proxy.http_cache.entries.keys()[0]
+        os.remove(Proxy.http_cache.filename(key, 'body'))
+        not_modified = CRLF.join(['HTTP/1.1 304 Not Modified', 'ETag: "v1"', CRLF])
+        received = self.proxy('GET', not_modified)
+        self.assertTrue('If-None-Match: "v1"' in self.requests[1])
+        self.assertTrue(received.startswith('HTTP/1.1 502 Bad Gateway'))
+        self.assertEqual(Proxy.http_cache.entries, dict())
+
+    def test_modified(self):
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Cache-Control: no-cache', 'ETag: "v1"', 'Content-Length: 5', CRLF]) + 'hello'
+        self.proxy('GET', response)
+        changed = CRLF.join(['HTTP/1.1 200 OK', 'Cache-Control: no-cache', 'ETag: "v2"', 'Content-Length: 5', CRLF]) + 'world'
+        self.assertEqual(self.proxy('GET', changed), changed)
+        self.assertEqual(Proxy.http_cache.entries.values()[0].get('etag'), '"v2"')
+
+class TestGzipProxy(TestMessageLength):
+
+    def setUp(self):
+        super(TestGzipProxy, self).setUp()
+        Proxy.gzip_types = ('text/html', 'application/json')
+        self.body = ''.join(['<p>line %d</p>\n' % i for i in range(1000)])
+
+    def tearDown(self):
+        Proxy.gzip_types = None
+        super(TestGzipProxy, self).tearDown()
+
+    def split(self, received):
+        head, body = received.split(CRLF * 2, 1)
+        return head, body
+
+    def test_chunked(self):
+        chunks = ''.join(['%x\r\n%s\r\n' % (len(self.body[i:i+1000]), self.body[i:i+1000]) for i in range(0, len(self.body), 1000)])
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Content-Type: text/html', 'Transfer-Encoding: chunked', CRLF]) + chunks + '0\r\n\r\n'
+        head, body = self.split(self.proxy('GET', response, headers=['Accept-Encoding: gzip']))
+        self.assertTrue('Content-Encoding: gzip' in head and 'Transfer-Encoding: chunked' in head)
+        chunker = ChunkParser()
+        chunker.parse(body)
+        self.assertEqual(zlib.decompress(chunker.body, 16 + zlib.MAX_WBITS), self.body)
+
+    def test_http10_client(self):
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Content-Type: application/json', 'Content-Length: %d' % len(self.body), CRLF]) + self.body
+        head, body = self.split(self.proxy('GET', response, headers=['Accept-Encoding: gzip'], version='HTTP/1.0'))
+        self.assertFalse('Content-Length' in head or 'Transfer-Encoding' in head)
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), self.body)
+
+    def test_not_accepted(self):
+        response = CRLF.join(['HTTP/1.1 200 OK', 'Content-Type: text/html', 'Content-Length: %d' % len(self.body), CRLF]) + self.body
+        self.assertEqual(self.proxy('GET', response), response)
+
+    def test_interim_passed_on(self):
+        response = CRLF.join(['HTTP/1.1 100 Continue', '', 'HTTP/1.1 200 OK', 'Content-Type: text/html', 'Content-Length: %d' % len(self.body), CRLF]) + self.body
+        received = self.proxy('GET', response, headers=['Accept-Encoding: gzip'])
+        self.assertTrue(received.startswith('HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\n'))
@@ -0,0 +1,213 @@
+import time
+import mock
+import select
+import socket
+import threading
+import unittest
+from appurify.resolver import DnsCache, ResolverPool, ConnectTimeouts, interleave, connect, dns_cache_misses, dns_refreshes
+
+V4 = (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 80))
+V6 = (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 80, 0, 0))
+
+class TestDnsCache(unittest.TestCase):
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_cache_hit(self, getaddrinfo):
+        getaddrinfo.return_value = [V4]
+        cache = DnsCache()
+        self.assertEqual(cache.resolve('example.com', 80), [V4])
+        self.assertEqual(cache.resolve('example.com', 80), [V4])
+        self.assertEqual(getaddrinfo.call_count, 1)
+        cache.resolve('example.com', 443)
+        self.assertEqual(getaddrinfo.call_count, 2)
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_expiry(self, getaddrinfo):
+        getaddrinfo.return_value = [V4]
+        cache = DnsCache(ttl=10)
+        cache.resolve('example.com', 80)
+        time.sleep(0.02)
+        cache.resolve('example.com', 80)
+        self.assertEqual(getaddrinfo.call_count, 2)
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_negative_cache(self, getaddrinfo):
+        getaddrinfo.side_effect = socket.gaierror(-2, 'Name or service not known')
+        cache = DnsCache()
+        for i in range(2):
+            self.assertRaises(socket.gaierror, cache.resolve, 'unknown.domain', 80)
+        self.assertEqual(getaddrinfo.call_count, 1)
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_concurrent_lookups_share_getaddrinfo(self, getaddrinfo):
+        started = threading.Event()
+        def slow(*args):
+            started.set()
+            time.sleep(0.05)
+            return [V4]
+        getaddrinfo.side_effect = slow
+        cache = DnsCache()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.resolve('example.com', 80))) for i in range(5)]
+        threads[0].start()
+        started.wait(1)
+        for t in threads[1:]: t.start()
+        for t in threads: t.join(1)
+        self.assertEqual(results, [[V4]] * 5)
+        self.assertEqual(getaddrinfo.call_count, 1)
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_unexpected_error_releases_waiters(self, getaddrinfo):
+        started, release = threading.Event(), threading.Event()
+        def bad(*args):
+            started.set()
+            release.wait(1)
+            raise UnicodeError('label too long')
+        getaddrinfo.side_effect = bad
+        cache = DnsCache()
+        errors = []
+        def resolve():
+            try:
+                cache.resolve('bad.example.com', 80)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=resolve) for i in range(3)]
+        threads[0].start()
+        started.wait(1)
+        for t in threads[1:]: t.start()
+        release.set()
+        for t in threads: t.join(1)
+        self.assertFalse([t for t in threads if t.isAlive()])
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(cache.inflight, dict())
+        # not cached, the next resolve tries again
+        getaddrinfo.side_effect = None
+        getaddrinfo.return_value = [V4]
+        self.assertEqual(cache.resolve('bad.example.com', 80), [V4])
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_no_host(self, getaddrinfo):
+        self.assertRaises(socket.gaierror, DnsCache().resolve, None, 80)
+        self.assertFalse(getaddrinfo.called)
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_refresh_ahead(self, getaddrinfo):
+        getaddrinfo.return_value = [V4]
+        cache = DnsCache(ttl=1000, pool=ResolverPool(1))
+        cache.resolve('example.com', 80)
+        resolved, expires, lookup = cache.entries[('example.com', 80)]
+        cache.entries[('example.com', 80)] = (resolved - 0.9, expires, lookup)
+        getaddrinfo.return_value = [V6]
+        self.assertEqual(cache.resolve('example.com', 80), [V4])
+        for i in range(100):
+            if not cache.inflight: break
+            time.sleep(0.01)
+        self.assertEqual(cache.resolve('example.com', 80), [V6])
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_failed_refresh_keeps_entry(self, getaddrinfo):
+        getaddrinfo.return_value = [V4]
+        cache = DnsCache(ttl=1000, pool=ResolverPool(1))
+        cache.resolve('example.com', 80)
+        resolved, expires, lookup = cache.entries[('example.com', 80)]
+        cache.entries[('example.com', 80)] = (resolved - 0.9, expires, lookup)
+        getaddrinfo.side_effect = socket.gaierror(socket.EAI_AGAIN, 'Temporary failure in name resolution')
+        misses, refreshes = dns_cache_misses.value, dns_refreshes.value
+        self.assertEqual(cache.resolve('example.com', 80), [V4])
+        for i in range(100):
+            if not cache.inflight: break
+            time.sleep(0.01)
+        self.assertEqual(cache.resolve('example.com', 80), [V4])
+        self.assertEqual(dns_cache_misses.value, misses)
+        self.assertEqual(dns_refreshes.value, refreshes + 1)
+
+    @mock.patch('appurify.resolver.socket.getaddrinfo')
+    def test_max_entries(self, getaddrinfo):
+        getaddrinfo.return_value = [V4]
+        cache = DnsCache(max_entries=2)
+        for host in ('a', 'b', 'c'):
+            cache.resolve(host, 80)
+        self.assertEqual(sorted(cache.entries), [('b', 80), ('c', 80)])
+
+class TestConnect(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def address(self, port):
+        return (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))
+
+    def closed_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_interleave(self):
+        self.assertEqual(interleave([V6, V6, V4, V4]), [V6, V4, V6, V4])
+        self.assertEqual(interleave([V4, V6, V6]), [V4, V6, V6])
+
+    def test_connect(self):
+        sock = connect([self.address(self.port)], 1000)
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', self.port))
+        sock.close()
+
+    def test_failover(self):
+        started = time.time()
+        sock = connect([self.address(self.closed_port()), self.address(self.port)], 1000, delay=5000)
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', self.port))
+        self.assertTrue(time.time() - started < 1)
+        sock.close()
+
+    def test_all_fail(self):
+        self.assertRaises(socket.error, connect, [self.address(self.closed_port())], 1000)
+
+    def test_timeout(self):
+        # a full accept queue drops further SYNs, so the next connect hangs
+        backlog = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        backlog.bind(('127.0.0.1', 0))
+        backlog.listen(0)
+        address = (socket.AF_INET, socket.SOCK_STREAM, 6, '', backlog.getsockname())
+        queued = []
+        try:
+            for i in range(8):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                queued.append(sock)
+                sock.connect_ex(address[4])
+                r, w, x = select.select([], [sock], [], 0.1)
+                if w: continue
+                started = time.time()
+                self.assertRaises(socket.timeout, connect, [address], 200)
+                self.assertTrue(time.time() - started < 1)
+                # the next address is tried once the hanging one had delay ms
+                started = time.time()
+                queued.append(connect([address, self.address(self.port)], 5000, delay=50))
+                self.assertEqual(queued[-1].getpeername(), ('127.0.0.1', self.port))
+                self.assertTrue(time.time() - started < 1)
+                break
+            else:
+                self.skipTest('accept queue never filled up')
+        finally:
+            for sock in queued: sock.close()
+            backlog.close()
+
+class TestConnectTimeouts(unittest.TestCase):
+
+    def test_rules(self):
+        timeouts = ConnectTimeouts(5000, [('*.example.com', 1000), ('example.com', 2000)])
+        self.assertEqual(timeouts.get('www.Example.com'), 1000)
+        self.assertEqual(timeouts.get('example.com'), 2000)
+        self.assertEqual(timeouts.get('example.org'), 5000)
+
+    def test_parse_rule(self):
+        self.assertEqual(ConnectTimeouts.parse_rule('*.Example.com=1500'), ('*.example.com', 1500))
+        self.assertRaises(ValueError, ConnectTimeouts.parse_rule, '1500')
+        self.assertRaises(ValueError, ConnectTimeouts.parse_rule, 'example.com=soon')
@@ -0,0 +1,104 @@
+import time
+import threading
+import unittest
+from appurify.scheduler import FairScheduler, Flow, scheduler_queue_delay
+
+class Wire(object):
+    """socket recording which flow sent what"""
+
+    def __init__(self):
+        self.sends = []
+
+    def send(self, data):
+        self.sends.append(data)
+        return len(data)
+
+class Channel(Wire):
+    """paramiko like channel, send blocks while the device does not read"""
+
+    def __init__(self, window):
+        super(Channel, self).__init__()
+        self.out_window_size = window
+        self.unblocked = threading.Event()
+
+    def send_ready(self):
+        return self.out_window_size > 0
+
+    def send(self, data):
+        if not self.out_window_size: self.unblocked.wait()
+        data = data[:self.out_window_size]
+        self.out_window_size -= len(data)
+        return super(Channel, self).send(data)
+
+class TestFairScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = FairScheduler(quantum=10, short_bytes=100)
+        self.wire = Wire()
+
+    def waiting(self, flow, data):
+        thr = threading.Thread(target=self.scheduler.send, args=(flow, self.wire, data))
+        thr.setDaemon(True)
+        thr.start()
+        for i in range(100):
+            if flow in self.scheduler.short_flows or flow in self.scheduler.bulk_flows: break
+            time.sleep(0.01)
+        return thr
+
+    def test_quantum(self):
+        flow = self.scheduler.flow()
+        self.assertEqual(self.scheduler.send(flow, self.wire, 'x' * 25), 10)
+        self.assertEqual(flow.deficit, 0)
+        self.assertEqual(self.scheduler.send(flow, self.wire, 'x' * 5), 5)
+        self.assertEqual(flow.deficit, 0)
+        self.assertEqual(flow.sent, 15)
+        self.assertEqual(self.scheduler.busy, None)
+
+    def test_short_flows_first(self):
+        holder, bulk, short = self.scheduler.flow(), self.scheduler.flow(), self.scheduler.flow()
+        bulk.sent = 1000
+        count = scheduler_queue_delay.count
+        self.scheduler.acquire(holder)
+        threads = [self.waiting(bulk, 'b' * 10), self.waiting(short, 's' * 10)]
+        self.assertEqual(list(self.scheduler.bulk_flows), [bulk])
+        self.assertEqual(list(self.scheduler.short_flows), [short])
+        self.scheduler.release(holder, 0, False)
+        for thr in threads: thr.join(1)
+        self.assertEqual(self.wire.sends, ['s' * 10, 'b' * 10])
+        self.assertEqual(scheduler_queue_delay.count, count + 3)
+
+    def test_round_robin(self):
+        holder = self.scheduler.flow()
+        flows = [self.scheduler.flow() for i in range(3)]
+        for flow in flows: flow.sent = 1000
+        self.scheduler.acquire(holder)
+        for i, flow in enumerate(flows):
+            self.waiting(flow, str(i) * 30)
+        self.scheduler.release(holder, 0, False)
+        for i in range(100):
+            if len(self.wire.sends) == 3: break
+            time.sleep(0.01)
+        self.assertEqual(self.wire.sends, ['0' * 10, '1' * 10, '2' * 10])
+
+    def test_rate_cap(self):
+        flow = Flow(rate=20000, burst=1000)
+        started = time.time()
+        sent = 0
+        while sent < 5000:
+            sent += self.scheduler.send(flow, self.wire, 'x' * (5000 - sent))
+        self.assertTrue(time.time() - started >= 0.15)
+
+    def test_stalled_channel(self):
+        stalled, other = self.scheduler.flow(), self.scheduler.flow()
+        channel = Channel(4)
+        self.assertEqual(self.scheduler.send(stalled, channel, 'x' * 10), 4)
+        # the device stopped reading, its sends would block forever
+        sender = threading.Thread(target=self.scheduler.send, args=(stalled, channel, 'x' * 6))
+        sender.setDaemon(True)
+        sender.start()
+        sender.join(1)
+        self.assertFalse(sender.isAlive())
+        self.assertEqual(self.scheduler.busy, None)
+        self.assertEqual(self.scheduler.send(other, self.wire, 'y' * 5), 5)
+        self.assertEqual(self.wire.sends, ['y' * 5])
+        channel.unblocked.set()
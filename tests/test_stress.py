@@ -0,0 +1,119 @@
+import time
+import socket
+import resource
+import threading
+import unittest
+from appurify.tunnel import Proxy, CRLF
+from appurify.poller import poller, POLL_READ
+
+CONNECTIONS = 2048
+DESCRIPTORS = CONNECTIONS * 5 + 256   # socketpair, upstream, origin side and a poller per connection
+
+class Channel(object):
+
+    origin_addr = ('127.0.0.1', 64002)
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def recv(self, bytes):
+        return self.sock.recv(bytes)
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+class TestManyConnections(unittest.TestCase):
+    """more concurrent proxied connections than select() can handle"""
+
+    def setUp(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < DESCRIPTORS:
+            if hard != resource.RLIM_INFINITY and hard < DESCRIPTORS:
+                self.skipTest('needs %d descriptors, hard limit is %d' % (DESCRIPTORS, hard))
+            resource.setrlimit(resource.RLIMIT_NOFILE, (DESCRIPTORS, hard))
+        self.limits = (soft, hard)
+        threading.stack_size(256 * 1024)
+        socket.setdefaulttimeout(30)
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(CONNECTIONS)
+        self.port = self.listener.getsockname()[1]
+        self.stopped = False
+        self.origin = threading.Thread(target=self.serve_echo)
+        self.origin.setDaemon(True)
+        self.origin.start()
+
+        self.devices = []
+        self.proxies = []
+
+    def tearDown(self):
+        for device in self.devices: device.close()
+        for proxy in self.proxies: proxy.join(5)
+        self.stopped = True
+        self.origin.join(5)
+        self.listener.close()
+        socket.setdefaulttimeout(None)
+        threading.stack_size(0)
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.limits)
+
+    def serve_echo(self):
+        """single threaded echo origin"""
+        conns = poller()
+        self.listener.setblocking(0)
+        conns.register(self.listener, POLL_READ)
+        while not self.stopped:
+            for sock, events in conns.poll(0.1):
+                if sock is self.listener:
+                    while True:
+                        try:
+                            conn, addr = self.listener.accept()
+                        except socket.error:
+                            break
+                        conn.setblocking(1)
+                        conns.register(conn, POLL_READ)
+                    continue
+                data = sock.recv(1024)
+                if data:
+                    sock.sendall(data)
+                else:
+                    conns.unregister(sock)
+                    sock.close()
+        for sock in list(conns.fds):
+            if sock is not self.listener: sock.close()
+        conns.close()
+
+    def test_connections(self):
+        for i in range(CONNECTIONS):
+            channel, device = socket.socketpair()
+            proxy = Proxy(Channel(channel))
+            proxy.setDaemon(True)
+            proxy.start()
+            self.devices.append(device)
+            self.proxies.append(proxy)
+            device.sendall(CRLF.join(["CONNECT 127.0.0.1:%d HTTP/1.1" % self.port, "Host: 127.0.0.1:%d" % self.port, CRLF]))
+
+        for device in self.devices:
+            established = ''
+            while not established.endswith(CRLF * 2):
+                established += device.recv(1024)
+            self.assertTrue(established.startswith('HTTP/1.1 200 Connection established'))
+
+        self.assertTrue(max([proxy.server.fileno() for proxy in self.proxies]) > 1024)
+        self.assertEqual(len([proxy for proxy in self.proxies if proxy.isAlive()]), CONNECTIONS)
+
+        for i, device in enumerate(self.devices):
+            device.sendall('ping %d' % i)
+        for i, device in enumerate(self.devices):
+            self.assertEqual(device.recv(1024), 'ping %d' % i)
+
+        for device in self.devices: device.close()
+        for proxy in self.proxies: proxy.join(5)
+        self.assertEqual([proxy for proxy in self.proxies if proxy.isAlive()], [])
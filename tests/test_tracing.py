@@ -0,0 +1,45 @@
+import os
+import json
+import tempfile
+import unittest
+from appurify.tracing import Tracer, NULL_SPAN
+
+class TestTracing(unittest.TestCase):
+
+    def test_disabled_tracer_returns_null_span(self):
+        tracer = Tracer()
+        with tracer.span('upload_app', bytes=10) as span:
+            span.set('status', 200)
+        self.assertTrue(span is NULL_SPAN)
+        self.assertEqual(tracer.spans, [])
+
+    def test_spans_recorded_as_complete_events(self):
+        tracer = Tracer(enabled=True)
+        with tracer.span('poll_result'):
+            with tracer.span('tests/check', method='GET', attempt=1) as span:
+                span.set('bytes_received', 128)
+        events = tracer.events()
+        self.assertEqual([e['name'] for e in events], ['poll_result', 'tests/check'])
+        self.assertEqual(events[1]['ph'], 'X')
+        self.assertEqual(events[1]['args'], {'method': 'GET', 'attempt': 1, 'bytes_received': 128})
+        self.assertTrue(events[0]['dur'] >= events[1]['dur'])
+
+    def test_span_records_error(self):
+        tracer = Tracer(enabled=True)
+        with self.assertRaises(ValueError):
+            with tracer.span('run_test'):
+                raise ValueError('boom')
+        self.assertEqual(tracer.spans[0].args['error'], repr(ValueError('boom')))
+
+    def test_write(self):
+        tracer = Tracer(enabled=True)
+        with tracer.span('download', url='http://localhost/results.zip'):
+            pass
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            tracer.write(path)
+            trace = json.load(open(path))
+            self.assertEqual(trace['traceEvents'][0]['name'], 'download')
+        finally:
+            os.remove(path)
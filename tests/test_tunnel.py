@@ -0,0 +1,212 @@
+import time
+import mock
+import socket
+import paramiko
+import unittest
+import threading
+from appurify import tunnel, sshbench
+from appurify.tunnel import TransportPool, TransportInactive, SshOptions, Supervisor
+
+class FakeTransport(object):
+
+    fail_connect = ()
+    fail_forward = ()
+
+    def __init__(self, config, index=0):
+        self.config = config
+        self.index = index
+        self.alive = True
+        self.closed = False
+        self.error = None
+        self.channels = 0
+
+    def connect(self):
+        if self.index in self.fail_connect:
+            raise IOError('connect #%d failed' % self.index)
+
+    def forward(self):
+        if self.index in self.fail_forward:
+            raise IOError('forward #%d refused' % self.index)
+
+    def accept(self):
+        time.sleep(0.01)
+        return None
+
+    def is_alive(self):
+        return self.alive and self.error is None
+
+    def close(self):
+        self.closed = True
+        self.alive = False
+
+class TestTransportPool(unittest.TestCase):
+
+    def setUp(self):
+        FakeTransport.fail_connect = ()
+        FakeTransport.fail_forward = ()
+
+    def test_start(self):
+        pool = TransportPool({}, 3, FakeTransport)
+        pool.start()
+        self.assertEqual([t.index for t in pool.transports], [0, 1, 2])
+        self.assertEqual(pool.check(), 3)
+        pool.close()
+
+    def test_extra_transports_dropped(self):
+        FakeTransport.fail_connect = (1,)
+        FakeTransport.fail_forward = (2,)
+        pool = TransportPool({}, 3, FakeTransport)
+        pool.start()
+        self.assertEqual([t.index for t in pool.transports], [0])
+        pool.close()
+
+    def test_first_transport_required(self):
+        FakeTransport.fail_forward = (0,)
+        pool = TransportPool({}, 2, FakeTransport)
+        self.assertRaises(IOError, pool.start)
+
+    def test_dead_transports_removed(self):
+        pool = TransportPool({}, 2, FakeTransport)
+        pool.start()
+        first, second = pool.transports
+        first.error = EOFError('closed')
+        self.assertEqual(pool.check(), 1)
+        self.assertTrue(first.closed)
+        self.assertEqual(pool.transports, [second])
+        second.alive = False
+        with mock.patch.object(tunnel, 'HEALTH_CHECK_INTERVAL', 10):
+            self.assertRaises(TransportInactive, pool.wait)
+        self.assertEqual(pool.transports, [])
+
+    def test_wait_woken_by_accept_loop(self):
+        pool = TransportPool({}, 1, FakeTransport)
+        pool.start()
+        errors = []
+        def wait():
+            try:
+                pool.wait()
+            except Exception, e:
+                errors.append(e)
+        waiter = threading.Thread(target=wait)
+        waiter.setDaemon(True)
+        waiter.start()
+        time.sleep(0.05)
+        started = time.time()
+        pool.transports[0].alive = False
+        waiter.join(1)
+        # well before HEALTH_CHECK_INTERVAL
+        self.assertFalse(waiter.isAlive())
+        self.assertTrue(time.time() - started < 1)
+        self.assertTrue(isinstance(errors[0], TransportInactive))
+
+class TestSshOptions(unittest.TestCase):
+
+    def test_apply(self):
+        a, b = socket.socketpair()
+        transport = paramiko.Transport(a)
+        options = SshOptions(4 * 1024 * 1024, 32768, ['aes256-ctr'], ['hmac-md5'], True)
+        options.apply(transport)
+        self.assertEqual(transport.window_size, 4 * 1024 * 1024)
+        self.assertEqual(transport.max_packet_size, 32768)
+        self.assertEqual(transport.get_security_options().ciphers, ('aes256-ctr',))
+        self.assertEqual(transport.get_security_options().digests, ('hmac-md5',))
+        self.assertTrue('zlib' in transport.get_security_options().compression)
+        a.close()
+        b.close()
+
+    def test_validate(self):
+        SshOptions(ciphers=SshOptions.algorithms('aes128-ctr, arcfour128')).validate()
+        self.assertRaises(ValueError, SshOptions(ciphers=['rot13']).validate)
+        self.assertRaises(ValueError, SshOptions(macs=['hmac-sha2-512']).validate)
+
+class TestSelfBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        stand_in = sshbench.StandIn(paramiko.RSAKey.generate(1024), paramiko.RSAKey.generate(1024))
+        try:
+            results = sshbench.run(stand_in, SshOptions(ciphers=['aes128-ctr'], compress=True), 64 * 1024)
+        finally:
+            stand_in.close()
+        self.assertTrue(results['upload'] > 0)
+        self.assertTrue(results['download'] > 0)
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        FakeTransport.fail_connect = ()
+        FakeTransport.fail_forward = ()
+        self.patches = [mock.patch.object(tunnel, name, 10) for name in
+                        ('HEALTH_CHECK_INTERVAL', 'RECONNECT_BACKOFF_MIN', 'RECONNECT_BACKOFF_MAX')]
+        for patch in self.patches: patch.start()
+        self.supervisor = Supervisor({}, 1, FakeTransport)
+        self.errors = []
+        self.thread = threading.Thread(target=self.supervise)
+        self.thread.setDaemon(True)
+
+    def tearDown(self):
+        self.supervisor.close()
+        if self.thread.isAlive(): self.thread.join(1)
+        for patch in self.patches: patch.stop()
+
+    def supervise(self):
+        try:
+            self.supervisor.run()
+        except Exception, e:
+            self.errors.append(e)
+
+    def wait_for(self, condition):
+        for i in range(200):
+            if condition(): return
+            time.sleep(0.01)
+        self.fail('timed out waiting for supervisor')
+
+    def test_backoff(self):
+        self.assertEqual([Supervisor.backoff(n) for n in (1, 2, 3, 10)], [10, 10, 10, 10])
+        with mock.patch.object(tunnel, 'RECONNECT_BACKOFF_MIN', 1000):
+            with mock.patch.object(tunnel, 'RECONNECT_BACKOFF_MAX', 30000):
+                self.assertEqual([Supervisor.backoff(n) for n in (1, 2, 3, 10)], [1000, 2000, 4000, 30000])
+
+    def test_failover_to_standby(self):
+        self.thread.start()
+        self.wait_for(lambda: self.supervisor.pool and self.supervisor.standby)
+        active, standby = self.supervisor.pool.transports[0], self.supervisor.standby
+        active.error = socket.error('connection reset')
+        self.wait_for(lambda: self.supervisor.pool.transports and self.supervisor.pool.transports[0] is standby)
+        self.assertTrue(active.closed)
+        self.wait_for(lambda: self.supervisor.standby and self.supervisor.standby is not standby)
+        self.supervisor.close()
+        self.thread.join(1)
+        self.assertFalse(self.thread.isAlive())
+        self.assertEqual(self.errors, [])
+
+    def test_inactive_fails_over(self):
+        self.thread.start()
+        self.wait_for(lambda: self.supervisor.pool and self.supervisor.standby)
+        active, standby = self.supervisor.pool.transports[0], self.supervisor.standby
+        active.alive = False
+        self.wait_for(lambda: self.supervisor.pool.transports and self.supervisor.pool.transports[0] is standby)
+        self.assertEqual(self.errors, [])
+
+    def test_eof_stops(self):
+        self.thread.start()
+        self.wait_for(lambda: self.supervisor.pool)
+        self.supervisor.pool.transports[0].error = EOFError()
+        self.thread.join(1)
+        self.assertTrue(isinstance(self.errors[0], EOFError))
+
+    def test_gives_up(self):
+        self.thread.start()
+        self.wait_for(lambda: self.supervisor.pool and self.supervisor.standby)
+        FakeTransport.fail_connect = (0,)
+        self.supervisor.standby.alive = False
+        self.supervisor.pool.transports[0].error = socket.error('connection reset')
+        self.thread.join(2)
+        self.assertFalse(self.thread.isAlive())
+        self.assertTrue(isinstance(self.errors[0], IOError))
+
+    def test_initial_failure(self):
+        FakeTransport.fail_connect = (0,)
+        self.thread.start()
+        self.thread.join(1)
+        self.assertTrue(isinstance(self.errors[0], IOError))
+        self.assertEqual(self.supervisor.pool, None)
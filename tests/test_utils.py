@@ -0,0 +1,80 @@
+import Queue
+import logging
+import unittest
+from appurify.utils import log, get_logger, QueueHandler, QueueListener, start_async_logging
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class Expensive(object):
+
+    rendered = 0
+
+    def __str__(self):
+        Expensive.rendered += 1
+        return 'expensive'
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = get_logger('test')
+        self.logger.propagate = False
+        self.handler = RecordingHandler()
+
+    def tearDown(self):
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+        self.logger.propagate = True
+
+    def test_subsystem_logger_name(self):
+        self.assertEqual(get_logger('tunnel.proxy').name, 'appurify.tunnel.proxy')
+
+    def test_deferred_args_not_rendered_below_level(self):
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.WARNING)
+        Expensive.rendered = 0
+        self.logger.info('%s', Expensive())
+        self.assertEqual(Expensive.rendered, 0)
+        self.logger.warning('%s', Expensive())
+        self.assertEqual(self.handler.records[0].getMessage(), 'expensive')
+
+    def test_log_deferred_args(self):
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        level = root.level
+        root.setLevel(logging.WARNING)
+        try:
+            Expensive.rendered = 0
+            log('%s', Expensive(), level=logging.INFO)
+            self.assertEqual(Expensive.rendered, 0)
+            log('%s of %d', Expensive(), 2)
+            self.assertEqual(self.handler.records[0].getMessage(), 'expensive of 2')
+            self.assertEqual(self.handler.records[0].levelno, logging.WARNING)
+        finally:
+            root.removeHandler(self.handler)
+            root.setLevel(level)
+
+    def test_queue_handler_drops_when_full(self):
+        handler = QueueHandler(Queue.Queue(1))
+        self.logger.addHandler(handler)
+        self.logger.warning('first %s', 1)
+        self.logger.warning('second %s', 2)
+        self.assertEqual(handler.dropped, 1)
+        record = handler.queue.get_nowait()
+        self.assertEqual(record.msg, 'first 1')
+        self.assertEqual(record.args, None)
+
+    def test_async_logging(self):
+        self.logger.addHandler(self.handler)
+        listener = start_async_logging(logger=self.logger)
+        self.assertTrue(isinstance(self.logger.handlers[0], QueueHandler))
+        self.logger.warning('via %s', 'queue')
+        listener.stop()
+        self.assertFalse(listener.isAlive())
+        self.assertEqual([r.getMessage() for r in self.handler.records], ['via queue'])
@@ -0,0 +1,119 @@
+import os
+import mock
+import time
+import signal
+import socket
+import threading
+import unittest
+from appurify import workers
+from appurify.tunnel import Proxy, WorkerPool, CRLF, client_bytes_received
+from appurify.workers import Workers, Switchboard, worker_restarts, worker_handoffs
+
+class Channel(object):
+    """socket wrapper without recv_into, behaves like a paramiko channel"""
+
+    origin_addr = ('127.0.0.1', 64003)
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def recv(self, bytes):
+        return self.sock.recv(bytes)
+
+    def send(self, data):
+        assert isinstance(data, str)
+        return self.sock.send(data)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [mock.patch.object(workers, name, 50) for name in
+                        ('WORKER_CHECK_INTERVAL', 'WORKER_REPORT_INTERVAL', 'WORKER_RESTART_DELAY')]
+        for patch in self.patches: patch.start()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.body = 'x' * 100000
+        origin = threading.Thread(target=self.serve)
+        origin.setDaemon(True)
+        origin.start()
+        self.pool = Proxy.worker_pool
+        self.workers = Workers(2)
+        self.workers.start()
+
+    def tearDown(self):
+        self.workers.close()
+        self.listener.close()
+        for patch in self.patches: patch.stop()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error:
+                return
+            data = ''
+            while CRLF * 2 not in data:
+                data += conn.recv(65536)
+            conn.sendall(CRLF.join(['HTTP/1.1 200 OK', 'Content-Length: %d' % len(self.body), CRLF]) + self.body)
+            conn.close()
+
+    def get(self):
+        channel, device = socket.socketpair()
+        self.assertTrue(Proxy.worker_pool.submit(Channel(channel)))
+        device.sendall(CRLF.join(["GET http://127.0.0.1:%d/ HTTP/1.1" % self.port, "Host: 127.0.0.1", CRLF]))
+        received = ''
+        while True:
+            data = device.recv(65536)
+            if not data: break
+            received += data
+        device.close()
+        return received
+
+    def wait_for(self, condition):
+        for i in range(300):
+            if condition(): return
+            time.sleep(0.01)
+        self.fail('timed out waiting for workers')
+
+    def test_proxied_in_workers(self):
+        self.assertTrue(isinstance(Proxy.worker_pool, Switchboard))
+        received = client_bytes_received.value
+        handoffs = worker_handoffs.value
+        allocated = Proxy.buffer_pool.allocated
+        for i in range(4):
+            self.assertTrue(self.get().endswith(CRLF * 2 + self.body))
+        self.assertEqual(worker_handoffs.value, handoffs + 4)
+        self.wait_for(lambda: sum([w.active for w in self.workers.processes]) == 0)
+        # relaying uses buffers of its own, the pool gauges are those of the workers
+        self.assertEqual(Proxy.buffer_pool.allocated, allocated)
+        self.assertEqual(self.workers.switchboard.buffers.in_use, 0)
+        # bytes are counted by the proxies in the workers and reported back
+        self.wait_for(lambda: client_bytes_received.value > received)
+
+    def test_restart(self):
+        restarts = worker_restarts.value
+        crashed = self.workers.processes[0]
+        pid = crashed.pid
+        os.kill(pid, signal.SIGKILL)
+        self.wait_for(lambda: worker_restarts.value == restarts + 1)
+        self.assertNotEqual(crashed.pid, pid)
+        # forked by the zygote, not by this multi-threaded process
+        self.assertRaises(OSError, os.waitpid, crashed.pid, os.WNOHANG)
+        for i in range(4):
+            self.assertTrue(self.get().endswith(self.body))
+
+    def test_close(self):
+        pids = [w.pid for w in self.workers.processes]
+        self.workers.close()
+        self.assertTrue(Proxy.worker_pool is self.pool)
+        self.assertRaises(OSError, os.kill, self.workers.zygote.pid, 0)
+        for pid in pids:
+            self.assertRaises(OSError, os.kill, pid, 0)